@@ -0,0 +1,2 @@
+\ir request_status.sql
+\ir request_status_maintenance.sql
\ No newline at end of file
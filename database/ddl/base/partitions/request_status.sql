@@ -0,0 +1,112 @@
+/*
+** SCHEMA: dr
+**
+** TABLE: request_status
+**
+** Converts request_status to a table partitioned by range of request_time,
+** one partition per month, named request_status_pYYYYMM, plus a default
+** partition for rows outside of them. The rows are copied into the new
+** table in this transaction, which locks request_status until it commits,
+** so run it when the lambdas are idle. Does nothing if request_status is
+** already partitioned. Run it after tables/init.sql, for example by
+** db_deploy with PARTITION_REQUEST_STATUS set to True.
+**
+** Unique keys of a partitioned table must include the partition key, so
+** request_status_pkey is (request_id, request_time), and
+** uq_reqstat_reqgidkey is (request_group_id, object_key, request_time).
+** requests_db reuses the request_time of the existing job when it records
+** one again, so that it still finds the conflict, when the lambdas have
+** PARTITION_REQUEST_STATUS set to True too. Its loads match existing jobs by
+** request_id, or request_group_id and object_key, alone.
+**
+** The job_status change trigger is made again on the new table.
+**
+** Partitions for the coming months are made, and old ones dropped or
+** detached, by requests_db.maintain_partitions(), with the functions of
+** request_status_maintenance.sql.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_partitions;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    DO $$
+    DECLARE
+        -- month starts, as UTC timestamps
+        part_month  timestamp;
+        last_month  timestamp;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'request_status'::regclass) = 'p' THEN
+            RAISE NOTICE 'request_status is already partitioned';
+            RETURN;
+        END IF;
+
+        ALTER TABLE request_status RENAME TO request_status_unpartitioned;
+
+        CREATE TABLE request_status
+            (LIKE request_status_unpartitioned
+             INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING COMMENTS)
+            PARTITION BY RANGE (request_time);
+
+        COMMENT ON TABLE request_status IS 'Disaster recovery jobs status table';
+
+        -- a partition for each month from the oldest request to three months from now
+        SELECT date_trunc('month', coalesce(min(request_time), now()) AT TIME ZONE 'UTC')
+          INTO part_month
+          FROM request_status_unpartitioned;
+        last_month := date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months';
+        WHILE part_month <= last_month LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF request_status FOR VALUES FROM (%L) TO (%L)',
+                           'request_status_p' || to_char(part_month, 'YYYYMM'),
+                           part_month AT TIME ZONE 'UTC',
+                           (part_month + interval '1 month') AT TIME ZONE 'UTC');
+            part_month := part_month + interval '1 month';
+        END LOOP;
+
+        CREATE TABLE request_status_default PARTITION OF request_status DEFAULT;
+
+        INSERT INTO request_status SELECT * FROM request_status_unpartitioned;
+
+        -- dropping the old table frees the names of its indexes and constraints
+        DROP TABLE request_status_unpartitioned;
+
+        ALTER TABLE request_status
+            ADD CONSTRAINT request_status_pkey PRIMARY KEY (request_id, request_time);
+
+        ALTER TABLE request_status
+            ADD CONSTRAINT uq_reqstat_reqgidkey UNIQUE (request_group_id, object_key, request_time);
+
+        -- the same indexes as tables/010_request_status.sql and 020_request_status_indexes.sql
+        CREATE INDEX idx_reqstat_reqgidlstupd
+             ON request_status USING btree (request_group_id, last_update_time);
+
+        CREATE INDEX idx_reqstat_keylstupd
+             ON request_status USING btree (object_key, last_update_time);
+
+        CREATE INDEX idx_reqstat_granidlstupd
+             ON request_status USING btree (granule_id, last_update_time);
+
+        CREATE INDEX idx_reqstat_lstupdreqid
+             ON request_status USING btree (last_update_time, request_id);
+
+        CREATE INDEX idx_reqstat_keylstupd_active
+             ON request_status USING btree (object_key, last_update_time)
+             WHERE job_status <> 'complete';
+
+        CREATE INDEX idx_reqstat_statlstupdreqid
+             ON request_status USING btree (job_status, last_update_time, request_id);
+
+        -- the trigger of tables/050_request_status_notify.sql
+        CREATE TRIGGER trg_reqstat_notify
+            AFTER UPDATE OF job_status ON request_status
+            FOR EACH ROW
+            WHEN (OLD.job_status IS DISTINCT FROM NEW.job_status)
+            EXECUTE PROCEDURE notify_request_status();
+    END
+    $$;
+
+COMMIT;
@@ -0,0 +1,90 @@
+/*
+** SCHEMA: dr
+**
+** TABLE: request_status
+**
+** The functions requests_db.maintain_partitions() makes and removes the
+** monthly partitions of request_status with. Making, dropping or detaching
+** a partition takes the owner of request_status, which the application
+** user, in dr_role, is not, so they are SECURITY DEFINER functions of dbo
+** that only do that, and only dr_role may execute them. The partitions they
+** make are owned by dbo, like the rest of the table, and get the grants of
+** schema/app.sql.
+**
+** create_request_status_partition(part_month) makes the partition for the
+** month of part_month, in UTC, and returns true, or returns false when
+** request_status_default has rows for that month. Returns true when the
+** partition already exists.
+**
+** remove_request_status_partition(part_name, detach) drops, or detaches,
+** a monthly partition of request_status and returns true, or returns false
+** when it still has an inprogress job.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_maintenance;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    CREATE OR REPLACE FUNCTION create_request_status_partition(part_month timestamp with time zone)
+        RETURNS boolean AS $$
+    DECLARE
+        -- month starts, as UTC timestamps
+        part_start  timestamp := date_trunc('month', part_month AT TIME ZONE 'UTC');
+        part_end    timestamp := part_start + interval '1 month';
+        part_name   text := 'request_status_p' || to_char(part_start, 'YYYYMM');
+    BEGIN
+        IF to_regclass(part_name) IS NOT NULL THEN
+            RETURN true;
+        END IF;
+        -- a partition can't be made while the default partition has rows for it
+        IF to_regclass('request_status_default') IS NOT NULL THEN
+            IF EXISTS (SELECT 1
+                         FROM request_status_default
+                        WHERE request_time >= part_start AT TIME ZONE 'UTC'
+                          AND request_time < part_end AT TIME ZONE 'UTC') THEN
+                RETURN false;
+            END IF;
+        END IF;
+        EXECUTE format('CREATE TABLE %I PARTITION OF request_status FOR VALUES FROM (%L) TO (%L)',
+                       part_name, part_start AT TIME ZONE 'UTC', part_end AT TIME ZONE 'UTC');
+        RETURN true;
+    END
+    $$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = dr, pg_temp;
+
+    CREATE OR REPLACE FUNCTION remove_request_status_partition(part_name text, detach boolean)
+        RETURNS boolean AS $$
+    DECLARE
+        active  boolean;
+    BEGIN
+        IF part_name !~ '^request_status_p[0-9]{6}$'
+           OR NOT EXISTS (SELECT 1
+                            FROM pg_inherits
+                           WHERE inhparent = 'request_status'::regclass
+                             AND inhrelid = to_regclass(part_name)) THEN
+            RAISE EXCEPTION '% is not a monthly partition of request_status', part_name;
+        END IF;
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE job_status = %L)',
+                       part_name, 'inprogress')
+           INTO active;
+        IF active THEN
+            RETURN false;
+        END IF;
+        IF detach THEN
+            EXECUTE format('ALTER TABLE request_status DETACH PARTITION %I', part_name);
+        ELSE
+            EXECUTE format('DROP TABLE %I', part_name);
+        END IF;
+        RETURN true;
+    END
+    $$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = dr, pg_temp;
+
+    REVOKE ALL ON FUNCTION create_request_status_partition(timestamp with time zone) FROM PUBLIC;
+    REVOKE ALL ON FUNCTION remove_request_status_partition(text, boolean) FROM PUBLIC;
+    GRANT EXECUTE ON FUNCTION create_request_status_partition(timestamp with time zone) TO dr_role;
+    GRANT EXECUTE ON FUNCTION remove_request_status_partition(text, boolean) TO dr_role;
+
+COMMIT;
@@ -64,6 +64,9 @@ BEGIN;
     CREATE INDEX idx_reqstat_granidlstupd
          ON request_status USING btree (granule_id, last_update_time);
 
+    -- the keyset pagination and job_status indexes are in
+    -- 020_request_status_indexes.sql
+
     -- Additional Grants
 
 COMMIT;
@@ -0,0 +1,40 @@
+/*
+** SCHEMA: dr
+** 
+** TABLE: request_status
+**
+** Indexes for keyset pagination and for the queries that filter on
+** job_status. Every statement is IF [NOT] EXISTS, so this runs on a new
+** database after 010_request_status.sql, and on an existing one where
+** request_status is already there.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_indexes;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    -- keyset pagination, newest update first, of all requests
+    CREATE INDEX IF NOT EXISTS idx_reqstat_lstupdreqid
+         ON request_status USING btree (last_update_time, request_id);
+
+    -- the jobs that are not complete, by object_key, newest update first.
+    -- get_active_jobs_by_object_keys reads only these, and most of the
+    -- history is complete, so the index stays small.
+    CREATE INDEX IF NOT EXISTS idx_reqstat_keylstupd_active
+         ON request_status USING btree (object_key, last_update_time)
+         WHERE job_status <> 'complete';
+
+    -- get_jobs_by_status and its keyset pages, in last_update_time, request_id
+    -- order. Only the key columns are indexed: an index row that held the
+    -- text columns, err_msg or object_key, could pass the btree row size
+    -- limit, and then the insert or update of the job would fail.
+    DROP INDEX IF EXISTS idx_reqstat_statlstupdreqid_cov;
+
+    CREATE INDEX IF NOT EXISTS idx_reqstat_statlstupdreqid
+         ON request_status USING btree (job_status, last_update_time, request_id);
+
+COMMIT;
@@ -0,0 +1,67 @@
+/*
+** SCHEMA: dr
+**
+** TABLE: request_status
+**
+** A job is unique by (request_group_id, object_key), so that a retried
+** restore request updates its job instead of adding another one, see
+** requests_db.submit_requests(on_conflict=...).
+**
+** The duplicates that retries left before then are moved, all but the newest
+** job of each, to request_status_duplicates, where they can be looked over
+** and dropped, and their number is reported in a NOTICE. Does nothing once
+** uq_reqstat_reqgidkey exists, so the table is only scanned for them once.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_natural_key;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    DO $$
+    DECLARE
+        moved  bigint;
+    BEGIN
+        IF to_regclass('uq_reqstat_reqgidkey') IS NOT NULL THEN
+            RAISE NOTICE 'uq_reqstat_reqgidkey already exists';
+            RETURN;
+        END IF;
+
+        CREATE TEMP TABLE request_status_dup_ids ON COMMIT DROP AS
+            SELECT request_id
+              FROM (SELECT request_id,
+                           row_number() OVER (PARTITION BY request_group_id, object_key
+                                              ORDER BY last_update_time desc, request_id desc)
+                               AS newest
+                      FROM request_status) jobs
+             WHERE newest > 1;
+
+        IF EXISTS (SELECT 1 FROM request_status_dup_ids) THEN
+            CREATE TABLE IF NOT EXISTS request_status_duplicates
+                (LIKE request_status INCLUDING DEFAULTS,
+                 moved_time  timestamp with time zone NOT NULL DEFAULT now());
+
+            COMMENT ON TABLE request_status_duplicates
+                IS 'Duplicate jobs moved out of request_status by 030_request_status_natural_key.sql';
+
+            WITH dups AS (
+                DELETE FROM request_status
+                 WHERE request_id IN (SELECT request_id FROM request_status_dup_ids)
+                RETURNING *
+            )
+            INSERT INTO request_status_duplicates
+            SELECT dups.*, now() FROM dups;
+
+            GET DIAGNOSTICS moved = ROW_COUNT;
+            RAISE NOTICE 'moved % duplicate jobs to request_status_duplicates', moved;
+        END IF;
+
+        CREATE UNIQUE INDEX uq_reqstat_reqgidkey
+             ON request_status USING btree (request_group_id, object_key);
+    END
+    $$;
+
+COMMIT;
@@ -0,0 +1,33 @@
+/*
+** SCHEMA: dr
+** 
+** TABLE: request_status
+**
+** Makes the (request_group_id, object_key) unique index a constraint, so
+** that requests_db can name its ON CONFLICT arbiter, uq_reqstat_reqgidkey,
+** by constraint. The name is the same whether or not request_status is
+** partitioned, see partitions/request_status.sql, though the columns are
+** not. Finds nothing to do when it has already run.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_constraints;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1
+                         FROM pg_constraint
+                        WHERE conname = 'uq_reqstat_reqgidkey'
+                          AND conrelid = 'request_status'::regclass) THEN
+            ALTER TABLE request_status
+                ADD CONSTRAINT uq_reqstat_reqgidkey UNIQUE USING INDEX uq_reqstat_reqgidkey;
+        END IF;
+    END
+    $$;
+
+COMMIT;
@@ -0,0 +1,43 @@
+/*
+** SCHEMA: dr
+** 
+** TABLE: request_status
+**
+** Sends a NOTIFY on the request_status channel when the job_status of a job
+** changes, so that a waiter, see requests_db.watch_status_changes(), hears
+** of it as the update commits rather than by polling the table. The payload
+** is a json object with the request_id, request_group_id, job_status and
+** last_update_time of the job. Only updates that change job_status notify,
+** so bulk loads of new jobs add nothing to the notification queue.
+**
+** partitions/request_status.sql makes the trigger again on the partitioned
+** table.
+*/
+
+-- Start a transaction
+BEGIN;
+    -- Set Save point
+    SAVEPOINT request_status_notify;
+
+    -- Set search path
+    SET search_path TO dr, public;
+
+    CREATE OR REPLACE FUNCTION notify_request_status() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('request_status',
+                          json_build_object('request_id', NEW.request_id,
+                                            'request_group_id', NEW.request_group_id,
+                                            'job_status', NEW.job_status,
+                                            'last_update_time', NEW.last_update_time)::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_reqstat_notify ON request_status;
+    CREATE TRIGGER trg_reqstat_notify
+        AFTER UPDATE OF job_status ON request_status
+        FOR EACH ROW
+        WHEN (OLD.job_status IS DISTINCT FROM NEW.job_status)
+        EXECUTE PROCEDURE notify_request_status();
+
+COMMIT;
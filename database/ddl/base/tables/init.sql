@@ -1 +1,5 @@
-\ir 010_request_status.sql
\ No newline at end of file
+\ir 010_request_status.sql
+\ir 020_request_status_indexes.sql
+\ir 030_request_status_natural_key.sql
+\ir 040_request_status_constraints.sql
+\ir 050_request_status_notify.sql
\ No newline at end of file
@@ -22,6 +22,7 @@ module "orca" {
   postgres_user_pw = var.database_app_user_pw
   database_name = var.database_name
   database_app_user = var.database_app_user
+  database_reader_host = var.database_reader_host
   ddl_dir = var.ddl_dir
   drop_database = var.drop_database
   platform = var.platform
@@ -139,9 +139,10 @@ resource "aws_lambda_function" "request_status" {
 
   environment {
     variables = {
-      DATABASE_PORT = var.database_port
-      DATABASE_NAME = var.database_name
-      DATABASE_USER = var.database_app_user
+      DATABASE_PORT        = var.database_port
+      DATABASE_NAME        = var.database_name
+      DATABASE_USER        = var.database_app_user
+      DATABASE_READER_HOST = var.database_reader_host
     }
   }
 }
@@ -24,6 +24,11 @@ variable "database_name" {
 
 variable "database_app_user" {}
 
+variable "database_reader_host" {
+  default     = ""
+  description = "Optional read replica endpoint for the read-only request_status queries."
+}
+
 
 variable "ddl_dir" {
   default = "ddl/"
@@ -18,6 +18,7 @@ module "orca_lambdas" {
   database_port = var.database_port
   database_name = var.database_name
   database_app_user = var.database_app_user
+  database_reader_host = var.database_reader_host
   ddl_dir = var.ddl_dir
   drop_database = var.drop_database
   platform = var.platform
@@ -63,7 +63,8 @@ module "dr_recovery_workflow" {
             "FullMessage": true
           },
           "task_config": {
-            "glacier-bucket": "{$.meta.buckets.glacier.name}"
+            "glacier-bucket": "{$.meta.buckets.glacier.name}",
+            "request_group_key": "{$.cumulus_meta.execution_name}"
           }
         }
       },
@@ -5,8 +5,8 @@ Description:  Lambda function that copies files from one s3 bucket
 to another s3 bucket.
 """
 
+import asyncio
 import os
-import time
 import logging
 import boto3
 from botocore.exceptions import ClientError
@@ -23,7 +23,7 @@ def task(records, retries, retry_sleep_secs):
 
     This task will call copy_object for each file. A copy will be tried
     up to {retries} times if it fails, waiting {retry_sleep_secs}
-    between each attempt.
+    between each attempt. The work is done by copy_files in an event loop.
 
         Args:
             records (dict): passed through from the handler
@@ -53,123 +53,167 @@ def task(records, retries, retry_sleep_secs):
             CopyRequestError: Thrown if there are errors with the input records or the copy failed.
     """
     files = get_files_from_records(records)
-    attempt = 1
     s3 = boto3.client('s3')  # pylint: disable-msg=invalid-name
+    return asyncio.run(copy_files(s3, files, retries, retry_sleep_secs))
+
+async def copy_files(s3, files, retries, retry_sleep_secs):  # pylint: disable-msg=invalid-name
+    """
+    Copies the files, retrying the ones that failed, and records the result of
+    each attempt in the database.
+
+    In each attempt the jobs of the files that don't have one yet are looked
+    up in one query, and then the files are copied concurrently. The database
+    calls run on the event loop while the copies, which block, run in the
+    default executor, so the database I/O overlaps with the s3 I/O.
+
+        Args:
+            s3 (object): An instance of boto3 s3 client
+            files (list(dict)): The files from get_files_from_records
+            retries (number): The number of attempts to retry a failed copy.
+            retry_sleep_secs (number): The number of seconds
+                to sleep between retry attempts.
+
+        Returns:
+            files: The input list, see task for the keys
+    """
+    attempt = 1
     while attempt <= retries:
-        for afile in files:
-            if not afile['success']:
-                key = afile['source_key']
-                try:
-                    try:
-                        afile['request_id']
-                    except KeyError:
-                        job = find_job_in_db(key)
-                        if job:
-                            afile['request_id'] = job['request_id']
-                            afile['target_bucket'] = job['archive_bucket_dest']
-                        else:
-                            continue
-                    err_msg = copy_object(s3, afile['source_bucket'], afile['source_key'],
-                                          afile['target_bucket'])
-                    try:
-                        afile = update_status_in_db(afile, attempt, err_msg)
-                    except requests_db.DatabaseError:
-                        try:
-                            time.sleep(30)
-                            afile = update_status_in_db(afile, attempt, err_msg)
-                        except requests_db.DatabaseError:
-                            continue
-                except requests_db.DatabaseError:
-                    continue
+        afiles = [afile for afile in files if not afile['success']]
+        await add_jobs_to_files(afiles)
+        copied = await asyncio.gather(*[copy_file(s3, afile) for afile in afiles
+                                        if 'request_id' in afile])
+        if copied:
+            try:
+                await update_status_in_db(copied, attempt)
+            except requests_db.DatabaseError:
+                pass
 
         attempt = attempt + 1
         if attempt <= retries:
-            time.sleep(retry_sleep_secs)
+            await asyncio.sleep(retry_sleep_secs)
 
     return files
 
-def find_job_in_db(key):
+async def add_jobs_to_files(afiles):
     """
-    Finds the active job for the file in the database.
+    Looks up the jobs of the files that don't have one yet, and adds the
+    request_id and target_bucket of each job found to its file. A file
+    whose job isn't found, or can't be read, is left as it is.
 
         Args:
-            key (string): The object key for the file to find in the db
+            afiles (list(dict)): Files from get_files_from_records
+    """
+    new_files = [afile for afile in afiles if 'request_id' not in afile]
+    if not new_files:
+        return
+    try:
+        jobs = await find_jobs_in_db([afile['source_key'] for afile in new_files])
+    except requests_db.DatabaseError:
+        return
+    for afile in new_files:
+        job = jobs.get(afile['source_key'])
+        if job:
+            afile['request_id'] = job['request_id']
+            afile['target_bucket'] = job['archive_bucket_dest']
+
+async def copy_file(s3, afile):  # pylint: disable-msg=invalid-name
+    """
+    Copies a file to the archive bucket of its job.
+
+        Args:
+            s3 (object): An instance of boto3 s3 client
+            afile (dict): A file from get_files_from_records, with the
+                request_id and target_bucket of its job
 
         Returns:
-            job (dict): The job related to the restore request.
+            afile: The input dict, with the result of the copy in 'success'
+                and 'err_msg'.
+    """
+    err_msg = await asyncio.get_running_loop().run_in_executor(
+        None, copy_object, s3, afile['source_bucket'], afile['source_key'],
+        afile['target_bucket'])
+    if err_msg:
+        afile['err_msg'] = err_msg
+    else:
+        afile['success'] = True
+        afile['err_msg'] = ''
+    return afile
+
+async def find_jobs_in_db(keys):
+    """
+    Finds the active jobs for the files in the database, in one query.
+
+        Args:
+            keys (list(string)): The object keys for the files to find in the db
+
+        Returns:
+            dict: The job related to the restore request, for each key that
+                has an active job.
     """
     try:
-        request_id = None
-        jobs = requests_db.get_jobs_by_object_key(key)
-        for job in jobs:
-            if job["job_status"] != "complete":
-                request_id = job['request_id']
-                break
-        if not request_id:
-            log_msg = ("Failed to update request status in database. "
-                       f"No incomplete entry found for object_key: {key}")
-            logging.error(log_msg)
-            job = None
+        # the jobs are about to be updated, so read them from the primary
+        jobs = await requests_db.get_active_jobs_by_object_keys_async(keys, use_primary=True)
     except requests_db.DatabaseError as err:
-        logging.error(f"Failed to read request from database. "
-                      f"key: {key} "
+        logging.error(f"Failed to read requests from database. "
+                      f"keys: {keys} "
                       f"Err: {str(err)}")
         raise
-    return job
+    for key in keys:
+        if key not in jobs:
+            log_msg = ("Failed to update request status in database. "
+                       f"No incomplete entry found for object_key: {key}")
+            logging.error(log_msg)
+    return jobs
 
-def update_status_in_db(afile, attempt, err_msg):
+async def update_status_in_db(afiles, attempt):
     """
-    Updates the status for the job in the database.
+    Updates the status for the jobs of the files copied in an attempt.
+
+    The statuses of all the files are written to the database in one statement.
 
         Args:
-            afile: An input dict with keys for:
+            afiles (list(dict)): The files copied in this attempt, each a dict with keys for:
                 'request_id' (string): The request_id of the database entry to update.
                 'source_key' (string): The filename of the restored file
                 'source_bucket' (string): The location of the restored file
                 'target_bucket' (string): the archive bucket the file was copied to.
-            attempt (number): The attempt number for the copy
-            err_msg (string): None, or the error message from the copy command
-
-        Returns:
-            afile: The input dict with additional keys for:
                 'success' (boolean): True, if the copy was successful,
                     otherwise False.
                 'err_msg' (string): when success is False, this will contain
                     the error message from the copy error
+            attempt (number): The attempt number for the copy
 
-            Example:  [{'request_id': '', 'source_key': 'file1.xml',
-                          'source_bucket': 'my-dr-fake-glacier-bucket',
-                          'target_bucket': 'unittest_xml_bucket', 'success': True,
-                          'err_msg': ''},
-                      {'request_id': '', 'source_key': 'file2.txt',
-                          'source_bucket': 'my-dr-fake-glacier-bucket',
-                          'target_bucket': 'unittest_txt_bucket', 'success': True,
-                          'err_msg': ''}]
+        Returns:
+            afiles: The input list
+
+        Raises:
+            requests_db.DatabaseError: An error occurred updating the jobs.
     """
-    old_status = ""
-    new_status = ""
-    try:
-        if err_msg:
-            afile['err_msg'] = err_msg
-            new_status = "error"
-            logging.error(f"Attempt {attempt}. Error copying file {afile['source_key']}"
-                          f" from {afile['source_bucket']} to {afile['target_bucket']}."
-                          f" msg: {err_msg}")
-            requests_db.update_request_status_for_job(afile['request_id'], new_status, err_msg)
-        else:
-            afile['success'] = True
-            afile['err_msg'] = ''
-            new_status = "complete"
+    updates = []
+    for afile in afiles:
+        if afile['success']:
             logging.info(f"Attempt {attempt}. Success copying file "
                          f"{afile['source_key']} from {afile['source_bucket']} "
                          f"to {afile['target_bucket']}.")
-            requests_db.update_request_status_for_job(afile['request_id'], new_status)
+            updates.append((afile['request_id'], "complete"))
+        else:
+            logging.error(f"Attempt {attempt}. Error copying file {afile['source_key']}"
+                          f" from {afile['source_bucket']} to {afile['target_bucket']}."
+                          f" msg: {afile['err_msg']}")
+            updates.append((afile['request_id'], "error", afile['err_msg']))
+    try:
+        updated = await requests_db.update_request_status_for_jobs_async(updates)
     except requests_db.DatabaseError as err:
+        keys = [afile['source_key'] for afile in afiles]
         logging.error(f"Failed to update request status in database. "
-                      f"key: {afile['source_key']} old status: {old_status} "
-                      f"new status: {new_status}. Err: {str(err)}")
+                      f"keys: {keys}. Err: {str(err)}")
         raise
-    return afile
+    for afile in afiles:
+        if not updated.get(afile['request_id'], True):
+            logging.error(f"Failed to update request status in database. "
+                          f"No entry found for request_id: {afile['request_id']} "
+                          f"key: {afile['source_key']}")
+    return afiles
 
 def get_files_from_records(records):
     """
@@ -232,7 +276,7 @@ def copy_object(s3_cli, src_bucket_name, src_object_name,
         return str(ex)
     return None
 
-def handler(event, context):      #pylint: disable-msg=unused-argument
+def handler(event, context):
     """Lambda handler. Copies a file from it's temporary s3 bucket to the s3 archive.
 
     If the copy for a file in the request fails, the lambda
@@ -247,6 +291,11 @@ def handler(event, context):      #pylint: disable-msg=unused-argument
             DATABASE_PORT (string): the database port. The standard is 5432.
             DATABASE_NAME (string): the name of the database.
             DATABASE_USER (string): the name of the application user.
+            DATABASE_RETRY_DEADLINE_SECS (number, optional, default = 20): How long to
+                keep retrying a database call that failed with a transient error.
+            DATABASE_DEADLINE_MARGIN_SECS (number, optional, default = 3): A database
+                call that would still be running this many seconds before the lambda
+                times out is cancelled, so that the result of each file is still reported.
 
         Parameter Store:
                 drdb-user-pass (string): the password for the application user (DATABASE_USER).
@@ -311,7 +360,8 @@ def handler(event, context):      #pylint: disable-msg=unused-argument
 
     logging.debug(f'event: {event}')
     records = event["Records"]
-    result = task(records, retries, retry_sleep_secs)
+    with requests_db.deadline(context):
+        result = task(records, retries, retry_sleep_secs)
     for afile in result:
         #if any file failed, the function will fail
         if not afile['success']:
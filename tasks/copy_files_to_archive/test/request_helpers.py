@@ -12,6 +12,7 @@ import boto3
 import psycopg2
 import psycopg2.extras
 
+import database
 import requests_db
 
 #import restore_requests
@@ -73,6 +74,13 @@ def mock_ssm_get_parameter(n_times):
         loop = loop + 1
     ssm_cli = boto3.client('ssm')
     ssm_cli.get_parameter = Mock(side_effect=params)
+    ssm_values = {"drdb-host": os.environ['DATABASE_HOST'],
+                  "drdb-user-pass": os.environ['DATABASE_PW']}
+    ssm_cli.get_parameters = Mock(side_effect=lambda Names, WithDecryption: {
+        "Parameters": [{"Name": name, "Value": ssm_values[name]} for name in Names],
+        "InvalidParameters": []})
+    database.invalidate_db_connect_info()
+    database._SSM_CLIENT = ssm_cli         #pylint: disable-msg=protected-access
 
 def create_handler_event():
     """
@@ -209,6 +217,20 @@ def create_select_requests(request_ids):
     return qresult, exp_result
 
 
+def create_active_jobs(request_id, object_keys):
+    """
+    creates the rows read for the active jobs of object_keys, each a copy of
+    the job with request_id
+    """
+    _, exp_result = create_select_requests([request_id])
+    rows = []
+    for object_key in object_keys:
+        row = psycopg2.extras.RealDictRow(exp_result[0])
+        row['object_key'] = object_key
+        rows.append(row)
+    return rows
+
+
 def create_insert_request(request_id,          #pylint: disable-msg=too-many-arguments
                           request_group_id, granule_id, object_key, job_type,
                           restore_bucket_dest, job_status, request_time,
@@ -3,21 +3,22 @@ Name: test_copy_files_to_archive.py
 
 Description:  Unit tests for copy_files_to_archive.py.
 """
+import asyncio
 import os
 import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 
 import boto3
-import database
+import async_database
 import requests_db
 from botocore.exceptions import ClientError
 
 import copy_files_to_archive
-from request_helpers import (REQUEST_ID4, REQUEST_ID7,
+from request_helpers import (REQUEST_ID7,
                              PROTECTED_BUCKET,
                              create_copy_event2, mock_ssm_get_parameter,
-                             create_copy_handler_event, create_select_requests)
+                             create_copy_handler_event, create_active_jobs)
 
 class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-attributes
     """
@@ -38,12 +39,12 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
 
         self.exp_file_key1 = 'dr-glacier/MOD09GQ.A0219114.N5aUCG.006.0656338553321.txt'
         self.handler_input_event = create_copy_handler_event()
-        self.mock_single_query = database.single_query
-        self.mock_time_sleep = time.sleep
+        self.mock_single_query = async_database.single_query
+        self.mock_asyncio_sleep = asyncio.sleep
 
     def tearDown(self):
-        time.sleep = self.mock_time_sleep
-        database.single_query = self.mock_single_query
+        asyncio.sleep = self.mock_asyncio_sleep
+        async_database.single_query = self.mock_single_query
         boto3.client = self.mock_boto3_client
         try:
             del os.environ['COPY_RETRY_SLEEP_SECS']
@@ -65,14 +66,13 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         s3_cli = boto3.client('s3')
         s3_cli.copy_object = Mock(side_effect=[None])
         exp_upd_result = []
-        exp_request_ids = [REQUEST_ID7]
-        _, exp_result = create_select_requests(exp_request_ids)
-        database.single_query = Mock(side_effect=[exp_result, exp_upd_result])
+        exp_result = create_active_jobs(REQUEST_ID7, [self.exp_file_key1])
+        async_database.single_query = AsyncMock(side_effect=[exp_result, exp_upd_result])
         mock_ssm_get_parameter(2)
         result = copy_files_to_archive.handler(self.handler_input_event, None)
         os.environ['COPY_RETRIES'] = '2'
         os.environ['COPY_RETRY_SLEEP_SECS'] = '1'
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.copy_object.assert_called_with(Bucket=self.exp_target_bucket,
                                               CopySource={'Bucket': self.exp_src_bucket,
                                                           'Key': self.exp_file_key1},
@@ -84,7 +84,7 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
                        "target_bucket": self.exp_target_bucket,
                        "err_msg": ""}]
         self.assertEqual(exp_result, result)
-        database.single_query.assert_called()
+        async_database.single_query.assert_called()
 
     def test_handler_db_update_err(self):
         """
@@ -93,15 +93,14 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         boto3.client = Mock()
         s3_cli = boto3.client('s3')
         s3_cli.copy_object = Mock(side_effect=[None])
-        exp_request_ids = [REQUEST_ID7]
-        _, exp_result = create_select_requests(exp_request_ids)
-        time.sleep = Mock(side_effect=None)
+        exp_result = create_active_jobs(REQUEST_ID7, [self.exp_file_key1])
+        asyncio.sleep = AsyncMock(side_effect=None)
         exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
-        database.single_query = Mock(
-            side_effect=[exp_result, requests_db.DatabaseError(exp_err),
-                         requests_db.DatabaseError(exp_err)])
-        mock_ssm_get_parameter(3)
+        async_database.single_query = AsyncMock(
+            side_effect=[exp_result, requests_db.DatabaseError(exp_err)])
+        mock_ssm_get_parameter(2)
         result = copy_files_to_archive.handler(self.handler_input_event, None)
+        self.assertEqual(2, async_database.single_query.await_count)
         exp_result = [{'success': True, 'source_bucket': 'my-dr-fake-glacier-bucket',
                        'source_key': self.exp_file_key1,
                        'request_id': REQUEST_ID7,
@@ -115,11 +114,9 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         boto3.client = Mock()
         s3_cli = boto3.client('s3')
         s3_cli.copy_object = Mock(side_effect=[None])
-        exp_request_ids = [REQUEST_ID7]
-        _, exp_result = create_select_requests(exp_request_ids)
-        time.sleep = Mock(side_effect=None)
+        asyncio.sleep = AsyncMock(side_effect=None)
         exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
-        database.single_query = Mock(
+        async_database.single_query = AsyncMock(
             side_effect=[requests_db.DatabaseError(exp_err),
                          requests_db.DatabaseError(exp_err)])
         mock_ssm_get_parameter(2)
@@ -139,10 +136,8 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         boto3.client = Mock()
         s3_cli = boto3.client('s3')
         s3_cli.copy_object = Mock(side_effect=[None])
-        exp_request_ids = [REQUEST_ID7]
-        _, exp_result = create_select_requests(exp_request_ids)
-        time.sleep = Mock(side_effect=None)
-        database.single_query = Mock(side_effect=[[], []])
+        asyncio.sleep = AsyncMock(side_effect=None)
+        async_database.single_query = AsyncMock(side_effect=[[], []])
         mock_ssm_get_parameter(2)
         try:
             copy_files_to_archive.handler(self.handler_input_event, None)
@@ -163,16 +158,17 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         s3_cli = boto3.client('s3')
         s3_cli.copy_object = Mock(side_effect=[None, None])
         exp_upd_result = []
-        exp_request_ids = [REQUEST_ID4, REQUEST_ID7]
-        _, exp_result = create_select_requests(exp_request_ids)
-        database.single_query = Mock(side_effect=[exp_result, exp_upd_result,
-                                                  exp_result, exp_upd_result])
+        exp_result = create_active_jobs(REQUEST_ID7, [self.exp_file_key1, exp_file_key])
+        async_database.single_query = AsyncMock(side_effect=[exp_result, exp_upd_result])
         mock_ssm_get_parameter(4)
         exp_rec_2 = create_copy_event2()
         self.handler_input_event["Records"].append(exp_rec_2)
         result = copy_files_to_archive.handler(self.handler_input_event, None)
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
+        self.assertEqual(2, async_database.single_query.call_count)
+        self.assertEqual(([self.exp_file_key1, exp_file_key],),
+                         async_database.single_query.call_args_list[0][0][2])
         exp_result = [{"success": True, "source_bucket": self.exp_src_bucket,
                        "source_key": self.exp_file_key1,
                        "request_id": REQUEST_ID7,
@@ -216,26 +212,23 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
                     "the copy_object operation: Unknown'}]"
         exp_upd_result = []
 
-        exp_request_ids = [REQUEST_ID7, REQUEST_ID4]
-        _, exp_result = create_select_requests(exp_request_ids)
+        exp_result = create_active_jobs(REQUEST_ID7, [self.exp_file_key1])
 
-        database.single_query = Mock(side_effect=[exp_result,
-                                                  exp_result,
+        async_database.single_query = AsyncMock(side_effect=[exp_result,
                                                   exp_upd_result,
-                                                  exp_result,
                                                   exp_upd_result])
-        mock_ssm_get_parameter(5)
+        mock_ssm_get_parameter(3)
         try:
             copy_files_to_archive.handler(self.handler_input_event, None)
             self.fail("expected CopyRequestError")
         except copy_files_to_archive.CopyRequestError as ex:
             self.assertEqual(exp_error, str(ex))
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.copy_object.assert_called_with(Bucket=self.exp_target_bucket,
                                               CopySource={'Bucket': self.exp_src_bucket,
                                                           'Key': self.exp_file_key1},
                                               Key=self.exp_file_key1)
-        database.single_query.assert_called()
+        async_database.single_query.assert_called()
 
     def test_handler_one_file_retry2_success(self):
         """
@@ -249,18 +242,16 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
         s3_cli.copy_object = Mock(side_effect=[ClientError({'Error': {'Code': 'AccessDenied'}},
                                                            'copy_object'),
                                                None])
-        exp_request_ids = [REQUEST_ID7, REQUEST_ID4]
-        _, exp_result = create_select_requests(exp_request_ids)
+        exp_result = create_active_jobs(REQUEST_ID7, [self.exp_file_key1])
         exp_upd_result = []
-        database.single_query = Mock(side_effect=[exp_result,
+        async_database.single_query = AsyncMock(side_effect=[exp_result,
                                                   exp_upd_result,
-                                                  exp_result,
                                                   exp_upd_result])
-        mock_ssm_get_parameter(4)
+        mock_ssm_get_parameter(3)
         result = copy_files_to_archive.handler(self.handler_input_event, None)
         os.environ['COPY_RETRIES'] = '2'
         os.environ['COPY_RETRY_SLEEP_SECS'] = '1'
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         exp_result = [{"success": True, "source_bucket": self.exp_src_bucket,
                        "source_key": self.exp_file_key1,
                        "request_id": REQUEST_ID7,
@@ -271,7 +262,7 @@ class TestCopyFiles(unittest.TestCase):  #pylint: disable-msg=too-many-instance-
                                               CopySource={'Bucket': self.exp_src_bucket,
                                                           'Key': self.exp_file_key1},
                                               Key=self.exp_file_key1)
-        database.single_query.assert_called()
+        async_database.single_query.assert_called()
 
     def test_handler_no_object_key_in_event(self):
         """
@@ -3,6 +3,7 @@ Name: test_copy_files_to_archive.py
 
 Description:  Unit tests for copy_files_to_archive.py.
 """
+import asyncio
 import os
 import time
 import unittest
@@ -163,7 +164,7 @@ class TestCopyFilesPostgres(unittest.TestCase):   #pylint: disable-msg=too-many-
         result = copy_files_to_archive.handler(self.handler_input_event, None)
         os.environ['COPY_RETRIES'] = '2'
         os.environ['COPY_RETRY_SLEEP_SECS'] = '1'
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         exp_result = [{"success": True,
                        "source_bucket": self.exp_src_bucket,
                        "source_key": self.exp_file_key1,
@@ -194,7 +195,7 @@ class TestCopyFilesPostgres(unittest.TestCase):   #pylint: disable-msg=too-many-
         self.assertEqual("inprogress", row[0]['job_status'])
         result = copy_files_to_archive.handler(self.handler_input_event, None)
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         exp_result = [{"success": True, "source_bucket": self.exp_src_bucket,
                        "source_key": self.exp_file_key1,
                        "request_id": REQUEST_ID3,
@@ -265,15 +266,15 @@ class TestCopyFilesPostgres(unittest.TestCase):   #pylint: disable-msg=too-many-
         row = requests_db.get_job_by_request_id(REQUEST_ID4)
         self.assertEqual("complete", row[0]['job_status'])
 
-    def test_find_job_in_db(self):
+    def test_find_jobs_in_db(self):
         """
-        Test reading job from db not found.
+        Test reading jobs from db not found.
         """
         key = "nofilefound"
         boto3.client = Mock()
         mock_ssm_get_parameter(1)
-        job = copy_files_to_archive.find_job_in_db(key)
-        self.assertEqual(None, job)
+        jobs = asyncio.run(copy_files_to_archive.find_jobs_in_db([key]))
+        self.assertEqual({}, jobs)
 
     def test_handler_one_file_fail_3x(self):
         """
@@ -77,6 +77,7 @@ def task(event, context):    #pylint: disable-msg=unused-argument
     status = create_schema(con)
     con.close()
     status = create_tables()
+    status = partition_tables()
 
     status = log_status("database ddl execution complete")
     return status
@@ -207,6 +208,36 @@ def create_tables():
             status = log_status(f"table in {sql_file} already exists")
     return status
 
+def partition_tables():
+    """
+    Partitions the request_status table by month of request_time, when the
+    PARTITION_REQUEST_STATUS env var is True, and makes the functions that
+    the application user maintains the partitions with. Does nothing to the
+    table if it is already partitioned.
+
+        Returns:
+            string: description of status of partition tables.
+
+        Raises:
+            DatabaseError: An error occurred.
+    """
+    try:
+        partition = os.environ["PARTITION_REQUEST_STATUS"]
+    except KeyError:
+        partition = "False"
+    if partition != "True":
+        return log_status("request_status partitioning not requested")
+    con = get_db_connnection()
+    cur = get_cursor(con)
+    sql_stmt = """SET SESSION AUTHORIZATION dbo;"""
+    status = execute_sql(cur, sql_stmt, "auth dbo")
+    sql_file = f"partitions{SEP}request_status.sql"
+    status = execute_sql_from_file(cur, sql_file, f"partition table in {sql_file}")
+    sql_file = f"partitions{SEP}request_status_maintenance.sql"
+    status = execute_sql_from_file(cur, sql_file, f"partition functions in {sql_file}")
+    con.close()
+    return status
+
 def get_files_in_dir(directory):
     """
     Returns a list of all the filenames in the given directory.
@@ -332,6 +363,10 @@ def execute_sql_from_file(cur, sql_file, activity):
         status = log_status(f"{activity} started")
         sql_path = f"{ddl_dir}{sql_file}"
         database.query_from_file(cur, sql_path)
+        # a file reports what it did, e.g. the duplicates it moved, with NOTICEs
+        for notice in cur.connection.notices:
+            log_status(notice.strip())
+        del cur.connection.notices[:]
         status = log_status(f"{activity} completed")
     except FileNotFoundError as fnf:
         _LOG.exception(f"DbError: {str(fnf)}")
@@ -346,7 +381,8 @@ def execute_sql_from_file(cur, sql_file, activity):
 
 def handler(event, context):            #pylint: disable-msg=unused-argument
     """
-    This task will create the database, roles, users, schema, and tables.
+    This task will create the database, roles, users, schema, and tables,
+    and partition the tables if requested.
 
         Environment Vars:
             DATABASE_PORT (string): the database port. The standard is 5432.
@@ -354,6 +390,9 @@ def handler(event, context):            #pylint: disable-msg=unused-argument
             DATABASE_USER (string): the name of the application user.
             DROP_DATABASE (bool, optional, default is False): When true, will
                 execute a DROP DATABASE command.
+            PARTITION_REQUEST_STATUS (bool, optional, default is False): When true,
+                request_status is partitioned by month of request_time, see
+                database/ddl/base/partitions/request_status.sql.
             PLATFORM (string): 'onprem' or 'AWS'
 
         Parameter Store:
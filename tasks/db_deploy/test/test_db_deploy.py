@@ -85,6 +85,34 @@ class TestDbDeploy(unittest.TestCase):
         except DatabaseError as err:
             self.fail(str(err))
 
+    def test_task_partitioned(self):
+        """
+        Test db_deploy task partitioning request_status, which does nothing
+        when it is run again
+        """
+        handler_input_event = {}
+        boto3.client = Mock()
+        self.mock_ssm_get_parameter(2)
+        expected = "database ddl execution complete"
+        os.environ["DROP_DATABASE"] = "False"
+        os.environ["PARTITION_REQUEST_STATUS"] = "True"
+        try:
+            for _ in range(2):
+                result = db_deploy.task(handler_input_event, None)
+                self.assertEqual(expected, result)
+            con = db_deploy.get_db_connnection()
+            cur = db_deploy.get_cursor(con)
+            cur.execute("""SELECT relkind FROM pg_class
+                           WHERE oid = 'dr.request_status'::regclass""")
+            self.assertEqual("p", cur.fetchone()[0])
+            con.close()
+        except DatabaseError as err:
+            self.fail(str(err))
+        finally:
+            del os.environ["PARTITION_REQUEST_STATUS"]
+        self.assertEqual("request_status partitioning not requested",
+                         db_deploy.partition_tables())
+
     def test_task_no_drop_platform_aws(self):
         """
         Test db_deploy task local with platform=AWS
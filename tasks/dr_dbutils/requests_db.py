@@ -1,17 +1,100 @@
 """
 This module exists to keep all database specific code for the request_status
 table in a single place.
+
+The functions that read and write request_status take an optional session,
+made by transaction(), to run several of them in one transaction.
+
+When the DATABASE_READER_HOST env var names a read replica, the read-only
+functions query it instead of the primary, unless they are given a session or
+use_primary=True. A replica can lag the primary slightly, so callers that must
+see their own recent writes should pass use_primary=True.
+
+Calls made in a deadline() block raise DatabaseTimeout, rather than run on,
+when they would go past the deadline, such as the end of a lambda invocation.
+
+The statements run most often, inserting a job, updating its status, and
+reading jobs by object_key or request_group_id, are run as prepared statements,
+see database.multi_query(). Set DATABASE_PREPARED_STATEMENTS to false when
+connecting through a proxy that pools connections by transaction.
+
+Lookups of a job by request_id, and of the active job of an object_key, can be
+cached in the process, see get_job_cache(). The cache is off unless
+DATABASE_JOB_CACHE_SIZE is set.
+
+request_status may be partitioned by month of request_time, see
+database/ddl/base/partitions/request_status.sql. The functions work the same
+either way, and maintain_partitions() makes and removes the partitions. Set
+PARTITION_REQUEST_STATUS to True, as for db_deploy, when it is partitioned, so
+that a job recorded again is found across the partitions.
+
+Waiters can hear of job_status changes as they are committed, rather than poll
+request_status, with watch_status_changes(), from the NOTIFY sent by the
+trigger of database/ddl/base/tables/050_request_status_notify.sql.
 """
+import base64
+import collections
+import copy
+import csv
+import gzip
+import io
 import json
 import logging
+import os
+import threading
+import time
 import uuid
 import datetime
+from contextlib import contextmanager
 import dateutil.parser
+import async_database
 import database
-from database import DbError
+from database import DbError, QueryTimeout
 
 LOGGER = logging.getLogger(__name__)
 
+# the process's JobCache, made by get_job_cache(). kept at module level so
+# that it survives across warm lambda invocations.
+_JOB_CACHE = None
+
+# the request_status columns, in the order of build_insert_params()
+REQUEST_COLUMNS = ("request_id", "request_group_id", "granule_id", "object_key", "job_type",
+                   "restore_bucket_dest", "archive_bucket_dest", "job_status",
+                   "request_time", "last_update_time", "err_msg")
+
+# the RETURNING list of the *_returning writes, which give back the rows as written
+_RETURNING_COLUMNS = ", ".join(REQUEST_COLUMNS)
+
+# the partition DDL waits at most this long for the lock on request_status,
+# rather than queue the lambdas' statements up behind it. it is set in the
+# same round trip as the DDL, see database.multi_batch_query()
+_PARTITION_LOCK_TIMEOUT_SQL = "SET LOCAL lock_timeout = '5s'"
+
+# locks the request_group_id and object_key of each job that submit_request
+# and submit_requests insert into a partitioned request_status, until the
+# transaction ends, so that two inserts of the same job run one after the
+# other. The locks are taken in order of the keys, so that two inserts of
+# the same jobs can't deadlock. Postgres evaluates the select list after the
+# ORDER BY sort, so that is the order the locks are taken in.
+_LOCK_JOBS_SQL = """
+    SELECT pg_advisory_xact_lock(hashtextextended(job_key, 0))
+    FROM (
+        SELECT DISTINCT request_group_id::text || '/' || object_key AS job_key
+        FROM unnest(%s::uuid[], %s::text[]) AS job (request_group_id, object_key)
+    ) AS jobs
+    ORDER BY job_key
+    """
+
+# the channel the request_status trigger sends job_status changes on, see
+# database/ddl/base/tables/050_request_status_notify.sql
+STATUS_CHANNEL = "request_status"
+
+# a job's last_update_time is set before its update commits, so after a
+# reconnect watch_status_changes() rereads from this long before the newest
+# change it saw, and remembers this many changes to not yield them twice
+_WATCH_OVERLAP_SECS = 60
+_WATCH_SEEN_SIZE = 10000
+
 
 class BadRequestError(Exception):
     """
@@ -29,6 +112,11 @@ class DatabaseError(Exception):
     Exception to be raised when there's a database error.
     """
 
+class DatabaseTimeout(DatabaseError):
+    """
+    Exception to be raised when a database call runs into its deadline.
+    """
+
 def get_utc_now_iso():
     """
     Returns the current utc timestamp as a string in isoformat
@@ -47,7 +135,8 @@ def request_id_generator():
 
 def get_dbconnect_info():
     """
-    Gets the dbconnection info
+    Gets the dbconnection info. The optional DATABASE_READER_HOST env var
+    is returned as db_reader_host.
     """
     dbconnect_info = {}
     db_params = {}
@@ -57,17 +146,487 @@ def get_dbconnect_info():
     db_params["db_user"] = {"env": "DATABASE_USER"}
     db_params["db_pw"] = {"ssm": "drdb-user-pass"}
     dbconnect_info = database.read_db_connect_info(db_params)
+    if os.environ.get("DATABASE_READER_HOST"):
+        dbconnect_info["db_reader_host"] = os.environ["DATABASE_READER_HOST"]
     return dbconnect_info
 
-def submit_request(data):
+def get_reader_dbconnect_info(use_primary=False):
+    """
+    Gets the dbconnection info for the read-only functions, which is the read
+    replica's if there is one and use_primary is False.
+    """
+    dbconnect_info = get_dbconnect_info()
+    if use_primary:
+        return dbconnect_info
+    return database.reader_connect_info(dbconnect_info)
+
+class Session:
+    """
+    A unit of work. The requests_db functions that are given a session run
+    their statements on its connection, and nothing they do is committed
+    until the session ends. Sessions are made by transaction().
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def query(self, sql, params=None, prepare_as=None):
+        """
+        Runs a statement in the session and returns a list of the rows. A
+        statement given a name in prepare_as is run as that prepared statement.
+        """
+        return database.multi_query(sql, params, self.cursor, prepare_as)
+
+    def values_query(self, sql, params_list):
+        """
+        Runs a statement with a single VALUES %s placeholder for all of the
+        tuples in params_list in the session, and returns a list of the rows.
+        """
+        return database.multi_values_query(sql, params_list, self.cursor)
+
+    def batch_query(self, statements, page_size=100):
+        """
+        Runs a list of (sql, params) statements in the session, sending up to
+        page_size of them in each round trip, and returns a list with the rows
+        of each statement, or None for one that doesn't return rows.
+        """
+        return database.multi_batch_query(statements, self.cursor, page_size)
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Loads rows into a table with COPY in the session, and returns the
+        number of rows loaded.
+        """
+        return database.copy_rows(table, columns, rows, self.cursor)
+
+class JobCache:
+    """
+    A least recently used cache of job lookups, of up to max_size entries
+    that expire ttl_secs after they were read. The writes made by this module
+    invalidate the entries they change. Writes made by other processes are
+    seen once the entries expire.
+    """
+
+    def __init__(self, max_size, ttl_secs):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        # values by key, as (value, expires), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+
+    def get(self, key):
+        """
+        Returns a copy of the cached value for the key, or None if it isn't
+        cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] <= time.monotonic():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return copy.deepcopy(entry[0])
+
+    def put(self, key, value):
+        """
+        Caches a copy of the value for the key, evicting the least recently
+        used entries past max_size.
+        """
+        with self._lock:
+            self._entries[key] = (copy.deepcopy(value), time.monotonic() + self.ttl_secs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def invalidate(self, request_ids=(), object_keys=()):
+        """
+        Forgets the jobs with the request_ids, and the active jobs of the
+        object_keys.
+        """
+        request_ids = {str(request_id) for request_id in request_ids}
+        keys = ({("request_id", request_id) for request_id in request_ids}
+                | {("active", object_key) for object_key in object_keys})
+        with self._lock:
+            for key, (value, _) in list(self._entries.items()):
+                if key in keys or (key[0] == "active" and value["request_id"] in request_ids):
+                    del self._entries[key]
+                    self.stats["invalidated"] += 1
+
+    def clear(self):
+        """
+        Forgets all of the cached values.
+        """
+        with self._lock:
+            self.stats["invalidated"] += len(self._entries)
+            self._entries.clear()
+
+def get_job_cache():
+    """
+    Returns the process's JobCache, or None when caching is off. The cache is
+    read through by get_job_by_request_id() and get_active_jobs_by_object_keys(),
+    and their async counterparts, when they aren't given a session. It is sized
+    by these env vars, which are read when it is first made:
+        DATABASE_JOB_CACHE_SIZE (default 0, off): the most jobs to cache
+        DATABASE_JOB_CACHE_TTL_SECS (default 30): how long a job is cached
+
+    Only jobs read from the primary are cached, so that a lagging read replica
+    can't undo an invalidation. A cached job is returned even with
+    use_primary=True, since it is never older than the TTL.
+    """
+    global _JOB_CACHE           #pylint: disable-msg=global-statement
+    if _JOB_CACHE is None:
+        max_size = int(os.environ.get("DATABASE_JOB_CACHE_SIZE", 0))
+        if max_size <= 0:
+            return None
+        _JOB_CACHE = JobCache(max_size, float(os.environ.get("DATABASE_JOB_CACHE_TTL_SECS", 30)))
+    return _JOB_CACHE
+
+def get_job_cache_stats():
+    """
+    Returns the job cache's hit, miss, expired, evicted and invalidated
+    counters and its current size, or None when caching is off.
+    """
+    cache = get_job_cache()
+    if cache is None:
+        return None
+    with cache._lock:           #pylint: disable-msg=protected-access
+        return dict(cache.stats, size=len(cache._entries))    #pylint: disable-msg=protected-access
+
+def reset_job_cache():
+    """
+    Forgets the job cache, so that the next lookup makes a new one from the
+    env vars.
+    """
+    global _JOB_CACHE           #pylint: disable-msg=global-statement
+    _JOB_CACHE = None
+
+def _read_cache(session):
+    """
+    Returns the job cache for a read, or None if the read must go to the
+    database, as it must in a session.
+    """
+    return None if session else get_job_cache()
+
+def _reads_primary(use_primary):
+    """
+    Returns True if the reads made with use_primary go to the primary.
+    """
+    return use_primary or not os.environ.get("DATABASE_READER_HOST")
+
+def _invalidate_jobs(request_ids=(), object_keys=()):
+    """
+    Forgets the cached jobs that a write has changed.
+    """
+    if _JOB_CACHE is not None:
+        _JOB_CACHE.invalidate(request_ids, object_keys)
+
+@contextmanager
+def deadline(context=None, secs=None):
+    """
+    Sets a deadline for the calls made in the block, which then raise
+    DatabaseTimeout rather than run on past it. The deadline is the lambda
+    context's remaining time less DATABASE_DEADLINE_MARGIN_SECS (default 3),
+    which leaves the handler time to report what it got done, or secs from
+    now, whichever is earlier. For example:
+
+        with requests_db.deadline(context):
+            jobs = requests_db.get_all_requests()
+
+    Statements get a statement_timeout, and new connections a connect_timeout,
+    of the time left.
+    """
+    with database.query_deadline(database.deadline_from_context(context)):
+        with database.query_deadline(None if secs is None else time.monotonic() + secs):
+            yield
+
+@contextmanager
+def transaction():
+    """
+    Yields a Session, so that several reads and writes share one connection
+    and one transaction. For example, to find a job and then update it:
+
+        with requests_db.transaction() as session:
+            job = requests_db.get_job_by_request_id(request_id, session=session)
+            requests_db.update_request_status_for_job(request_id, "complete",
+                                                      session=session)
+
+    The transaction is committed when the block ends, or rolled back if it
+    raises, in which case the exception is re-raised as it is.
+
+    Raises DatabaseError if a connection can't be made or the commit fails.
+    """
+    try:
+        dbconnect_info = get_dbconnect_info()
+        with database.transaction(dbconnect_info) as cursor:
+            yield Session(cursor)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+def _database_error(err):
+    """
+    Returns the DatabaseError to raise for a DbError, a DatabaseTimeout if
+    the DbError is a QueryTimeout.
+    """
+    if isinstance(err, QueryTimeout):
+        return DatabaseTimeout(str(err))
+    return DatabaseError(str(err))
+
+def _submit_error(err):
+    """
+    Returns the exception to raise for a DbError from an insert of
+    submit_request or submit_requests, a BadRequestError if it is a
+    duplicate of a job's request_group_id and object_key. The error names
+    the key rather than uq_reqstat_reqgidkey when request_status is
+    partitioned, as it comes from the index of a partition.
+    """
+    if "Key (request_group_id, object_key" in str(err):
+        return BadRequestError("A job for this request_group_id and object_key already "
+                               "exists, submit it with on_conflict 'skip' or 'update'")
+    return _database_error(err)
+
+def _single_query(sql, params, session=None, prepare_as=None):
+    """
+    Runs a statement in the session if there is one, or else in a
+    transaction of its own, and returns a list of the rows. A statement
+    given a name in prepare_as is run as that prepared statement.
+    """
+    if session:
+        return session.query(sql, params, prepare_as)
+    return database.single_query(sql, get_dbconnect_info(), params, prepare_as=prepare_as)
+
+def _read_query(sql, params, session=None, use_primary=False, prepare_as=None):
+    """
+    The _single_query() for read-only statements, which run on the read
+    replica if there is one, unless there is a session or use_primary is True.
+    """
+    if session:
+        return session.query(sql, params, prepare_as)
+    return database.single_query(sql, get_reader_dbconnect_info(use_primary), params,
+                                 prepare_as=prepare_as)
+
+def _values_query(sql, params_list, session=None):
+    """
+    The values_query() counterpart of _single_query().
+    """
+    if session:
+        return session.values_query(sql, params_list)
+    return database.values_query(sql, get_dbconnect_info(), params_list)
+
+def submit_request(data, session=None, on_conflict=None):
     """
     Takes the provided request data (as a dict) and attempts to update the
     database with a new request.
 
-    Raises BadRequestError if there is a problem with the input.
+    A job is unique by its request_group_id and object_key. When there is
+    already a job for them, on_conflict "skip" leaves it as it is, "update"
+    updates it with the data, unless it is already complete or error, and
+    None, the default, raises BadRequestError.
+
+    Returns the request_id of the job, which is the existing job's when it
+    was updated, or None when it was skipped or left as it was.
+
+    Raises BadRequestError if there is a problem with the input, or if
+    on_conflict is None and there is already a job for its request_group_id
+    and object_key.
     """
-    # build and run the insert
-    sql = """
+    rows = _submit_request(data, session, on_conflict, "request_id")
+    if not on_conflict:
+        return data["request_id"]
+    return str(rows[0]["request_id"]) if rows else None
+
+def submit_request_returning(data, session=None, on_conflict=None):
+    """
+    The submit_request() that returns the job as it was written, in a list
+    like that of get_job_by_request_id(), or an empty list when it was
+    skipped. The row comes back from the insert, with RETURNING, so there is
+    no need to read the job again, and its times are as the server stored
+    them. on_conflict and the errors are as for submit_request().
+    """
+    return result_to_json(_submit_request(data, session, on_conflict, _RETURNING_COLUMNS))
+
+def _submit_request(data, session, on_conflict, returning):
+    """
+    Runs the insert of submit_request(), returning the returning columns of
+    the job, and returns the rows.
+    """
+    sql = _insert_sql("(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", on_conflict, returning)
+    prepare_as = "request_status_insert"
+    if on_conflict:
+        prepare_as = f"request_status_insert_{on_conflict}"
+    if returning == _RETURNING_COLUMNS:
+        prepare_as += "_returning"
+    params = build_insert_params(data)
+    try:
+        if _partitioned():
+            with _submit_session(session) as submit_session:
+                submit_session.query(_LOCK_JOBS_SQL, _lock_jobs_params([params]))
+                rows = submit_session.query(sql, params, prepare_as)
+        else:
+            rows = _single_query(sql, params, session, prepare_as=prepare_as)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _submit_error(err)
+    _invalidate_jobs([row["request_id"] for row in rows], [data["object_key"]])
+    return rows
+
+def submit_requests(data_list, session=None, on_conflict=None):
+    """
+    Takes a list of request data dicts, validated the same way as by
+    submit_request, and inserts all of them in one transaction with a
+    multi-row insert. on_conflict is as for submit_request. With "update",
+    if a request_group_id and object_key are in the list more than once,
+    the last one is the one applied.
+
+    Returns a list of the request_ids that were inserted or updated.
+
+    Raises BadRequestError if there is a problem with any of the input, or
+    if on_conflict is None and there is already a job for a request_group_id
+    and object_key in it, in which case nothing is inserted.
+    """
+    return [str(row["request_id"]) for row in
+            _submit_requests(data_list, session, on_conflict, "request_id")]
+
+def submit_requests_returning(data_list, session=None, on_conflict=None):
+    """
+    The submit_requests() that returns the jobs as they were written, a dict
+    for each job inserted or updated, from the RETURNING of the insert, with
+    their times as the server stored them. on_conflict and the errors are
+    as for submit_requests().
+    """
+    return result_to_json(_submit_requests(data_list, session, on_conflict,
+                                           _RETURNING_COLUMNS))
+
+def _submit_requests(data_list, session, on_conflict, returning):
+    """
+    Runs the insert of submit_requests(), returning the returning columns of
+    the jobs, and returns the rows.
+    """
+    if not data_list:
+        return []
+
+    sql, params_list = _submit_requests_query(data_list, on_conflict, returning)
+    try:
+        if _partitioned():
+            with _submit_session(session) as submit_session:
+                submit_session.query(_LOCK_JOBS_SQL, _lock_jobs_params(params_list))
+                rows = submit_session.values_query(sql, params_list)
+        else:
+            rows = _values_query(sql, params_list, session)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _submit_error(err)
+    _invalidate_jobs([row["request_id"] for row in rows], [params[3] for params in params_list])
+    return rows
+
+async def submit_requests_async(data_list, on_conflict=None):
+    """
+    The asynchronous submit_requests(), for callers running in an event loop.
+    """
+    if not data_list:
+        return []
+
+    sql, params_list = _submit_requests_query(data_list, on_conflict)
+    try:
+        dbconnect_info = get_dbconnect_info()
+        if _partitioned():
+            async with async_database.transaction(dbconnect_info) as cursor:
+                await cursor.query(_LOCK_JOBS_SQL, _lock_jobs_params(params_list))
+                rows = await cursor.values_query(sql, params_list)
+        else:
+            rows = await async_database.values_query(sql, dbconnect_info, params_list)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _submit_error(err)
+    _invalidate_jobs([row["request_id"] for row in rows], [params[3] for params in params_list])
+    return [str(row["request_id"]) for row in rows]
+
+def _submit_requests_query(data_list, on_conflict, returning="request_id"):
+    """
+    Validates the request data dicts for submit_requests, and returns the
+    sql and params_list that insert them.
+    """
+    params_list = [build_insert_params(data) for data in data_list]
+    if on_conflict == "update":
+        # a job can only be updated once by one statement, use its last data
+        by_natural_key = {}
+        for params in params_list:
+            by_natural_key[(str(params[1]), params[3])] = params
+        params_list = list(by_natural_key.values())
+    return _submit_requests_sql(on_conflict, returning), params_list
+
+def _submit_requests_sql(on_conflict=None, returning="request_id"):
+    """
+    Returns the multi-row insert used by submit_requests.
+    """
+    return _insert_sql("%s", on_conflict, returning)
+
+def _partitioned():
+    """
+    Returns True when the PARTITION_REQUEST_STATUS env var is True, as it is
+    for db_deploy when it partitions request_status, see
+    database/ddl/base/partitions/request_status.sql.
+    """
+    return os.environ.get("PARTITION_REQUEST_STATUS", "False") == "True"
+
+@contextmanager
+def _submit_session(session):
+    """
+    Yields the session if there is one, or else a Session of a transaction
+    of its own, so that the jobs stay locked until the insert commits. A
+    DbError is raised as it is, for _submit_error().
+    """
+    if session:
+        yield session
+        return
+    with database.transaction(get_dbconnect_info()) as cursor:
+        yield Session(cursor)
+
+def _lock_jobs_params(params_list):
+    """
+    Returns the params of _LOCK_JOBS_SQL, the request_group_ids and
+    object_keys of the jobs of the build_insert_params() tuples in params_list.
+    """
+    return ([str(params[1]) for params in params_list],
+            [params[3] for params in params_list])
+
+def _insert_sql(values, on_conflict, returning="request_id"):
+    """
+    Returns the insert, of the jobs in the VALUES list values, with the
+    on_conflict clause, if there is one, for submit_request and
+    submit_requests, returning the returning columns of the inserted and
+    updated jobs.
+
+    When request_status is partitioned by request_time, uq_reqstat_reqgidkey
+    includes it, see database/ddl/base/partitions/request_status.sql, so a
+    job is recorded with the request_time of the existing job for its
+    request_group_id and object_key, if there is one, to conflict with it,
+    or else the earliest request_time of the jobs for them in values, so
+    that they conflict with each other. The jobs must be locked by _LOCK_JOBS_SQL first, in the same transaction,
+    so that the lookup sees a job that a concurrent insert committed, rather
+    than both adding it in different partitions.
+    """
+    if not _partitioned():
+        return f"""
+        INSERT INTO request_status (
+            request_id, request_group_id, granule_id,
+            object_key, job_type,
+            restore_bucket_dest,
+            archive_bucket_dest,
+            job_status, request_time, last_update_time,
+            err_msg
+        ) VALUES {values}
+        {_on_conflict_sql(on_conflict)}
+        RETURNING {returning}
+        """
+    return f"""
         INSERT INTO request_status (
             request_id, request_group_id, granule_id,
             object_key, job_type,
@@ -75,17 +634,366 @@ def submit_request(data):
             archive_bucket_dest,
             job_status, request_time, last_update_time,
             err_msg
-      
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s
         )
+        SELECT
+            incoming.request_id::uuid, incoming.request_group_id::uuid, incoming.granule_id,
+            incoming.object_key, incoming.job_type,
+            incoming.restore_bucket_dest,
+            incoming.archive_bucket_dest,
+            incoming.job_status,
+            coalesce(existing.request_time,
+                     min(incoming.request_time::timestamptz) OVER (
+                         PARTITION BY incoming.request_group_id, incoming.object_key)),
+            incoming.last_update_time::timestamptz,
+            incoming.err_msg
+        FROM (VALUES {values}) AS incoming (
+            request_id, request_group_id, granule_id,
+            object_key, job_type,
+            restore_bucket_dest,
+            archive_bucket_dest,
+            job_status, request_time, last_update_time,
+            err_msg
+        )
+        LEFT JOIN LATERAL (
+            SELECT request_time
+            FROM request_status
+            WHERE request_group_id = incoming.request_group_id::uuid
+                and object_key = incoming.object_key
+            ORDER BY request_time
+            LIMIT 1
+        ) AS existing ON true
+        {_on_conflict_sql(on_conflict)}
+        RETURNING {returning}
         """
+
+def _on_conflict_sql(on_conflict):
+    """
+    Returns the ON CONFLICT clause, on the uq_reqstat_reqgidkey constraint
+    on the (request_group_id, object_key) of a job, for _insert_sql, or no
+    clause if on_conflict is None. "update" only updates a job that is still
+    inprogress, so that a retry doesn't undo a job that has finished.
+
+    Raises BadRequestError if on_conflict is not None, "skip" or "update".
+    """
+    if on_conflict is None:
+        return ""
+    if on_conflict == "skip":
+        action = "NOTHING"
+    elif on_conflict == "update":
+        action = """UPDATE SET
+            job_type = EXCLUDED.job_type,
+            restore_bucket_dest = EXCLUDED.restore_bucket_dest,
+            archive_bucket_dest = EXCLUDED.archive_bucket_dest,
+            job_status = EXCLUDED.job_status,
+            last_update_time = EXCLUDED.last_update_time,
+            err_msg = EXCLUDED.err_msg
+        WHERE request_status.job_status NOT IN ('complete', 'error')"""
+    else:
+        raise BadRequestError(f"on_conflict must be 'skip' or 'update', not '{on_conflict}'")
+    return f"""
+        ON CONFLICT ON CONSTRAINT uq_reqstat_reqgidkey DO {action}"""
+
+def load_requests(data_iter, on_conflict="skip", session=None):
+    """
+    Bulk loads request data dicts, with the same keys as for submit_request,
+    into request_status. The rows are streamed with COPY into a temporary
+    staging table, so they are never all in memory, and then merged into
+    request_status in one statement.
+
+        Args:
+            data_iter (iterable(dict)): The requests to load. request_time
+                and last_update_time may be datetimes or iso format strings,
+                and default to now.
+            on_conflict (string): What to do with a request that is already
+                in request_status, by its request_id, or by its
+                request_group_id and object_key: "skip" it, or "update" the
+                existing job, which keeps its request_id, request_group_id
+                and object_key. If a request is loaded more than once, its
+                first row is the one kept with "skip", its last with "update".
+            session (Session): Optional, see transaction(). Without one, the
+                load runs in a transaction of its own.
+
+        Returns:
+            dict: The number of rows "loaded" into the staging table, and
+                the number of requests "inserted" and "updated".
+
+        Raises:
+            BadRequestError: A row is missing a key, or on_conflict is not
+                valid. Nothing is loaded.
+            DatabaseError: An error occurred loading the rows.
+    """
+    if on_conflict not in ("skip", "update"):
+        raise BadRequestError(f"on_conflict must be 'skip' or 'update', not '{on_conflict}'")
+
+    if session is None:
+        with transaction() as load_session:
+            return load_requests(data_iter, on_conflict, load_session)
+
+    now = get_utc_now_iso()
+    try:
+        session.query("DROP TABLE IF EXISTS pg_temp.request_status_load")
+        session.query("""
+            CREATE TEMP TABLE request_status_load
+                (LIKE request_status INCLUDING DEFAULTS, load_seq bigserial)
+                ON COMMIT DROP
+            """)
+        loaded = session.copy_rows("request_status_load", REQUEST_COLUMNS,
+                                   (_load_params(data, now) for data in data_iter))
+        rows = session.query(_merge_load_sql(on_conflict))
+    except DbError as err:
+        LOGGER.exception(f"DbError loading requests: {str(err)}")
+        raise _database_error(err)
+    if _JOB_CACHE is not None:
+        _JOB_CACHE.clear()
+
+    return {"loaded": loaded, "inserted": rows[0]["inserted"], "updated": rows[0]["updated"]}
+
+def _load_params(data, now):
+    """
+    Returns the row for loading a request data dict with load_requests. Unlike
+    build_insert_params the times are not parsed here, the database does it.
+    """
+    try:
+        return (
+            data["request_id"],
+            data["request_group_id"],
+            data["granule_id"],
+            data["object_key"],
+            data["job_type"],
+            data.get("restore_bucket_dest"),
+            data.get("archive_bucket_dest"),
+            data["job_status"],
+            data.get("request_time") or now,
+            data.get("last_update_time") or now,
+            data.get("err_msg"),
+        )
+    except KeyError as err:
+        raise BadRequestError(f"Missing {str(err)} in input data")
+
+def _merge_load_sql(on_conflict):
+    """
+    Returns the sql that merges the staged rows into request_status, and
+    counts the inserted and updated rows.
+
+    Each staged row is matched to the existing job with its request_id, or
+    else to the one with its request_group_id and object_key, so that a row
+    that duplicates a job by either key is skipped or updates that job,
+    rather than failing the load on a unique constraint. Only one row is
+    merged for each request_id, natural key and job, the first with "skip"
+    and the last with "update". The rows that match no job are inserted,
+    skipping any that a concurrent insert has just added.
+    """
+    columns = ", ".join(REQUEST_COLUMNS)
+    order = "DESC" if on_conflict == "update" else "ASC"
+    merged = f"""
+        WITH staged AS (
+            SELECT DISTINCT ON (request_group_id, object_key) *
+            FROM (
+                SELECT DISTINCT ON (request_id) *
+                FROM request_status_load
+                ORDER BY request_id, load_seq {order}
+            ) by_request_id
+            ORDER BY request_group_id, object_key, load_seq {order}
+        ),
+        matched AS (
+            SELECT DISTINCT ON (coalesce(by_id.request_id, by_key.request_id, staged.request_id))
+                staged.*, coalesce(by_id.request_id, by_key.request_id) AS job_id
+            FROM staged
+            LEFT JOIN request_status by_id ON by_id.request_id = staged.request_id
+            LEFT JOIN request_status by_key
+                ON by_key.request_group_id = staged.request_group_id
+                AND by_key.object_key = staged.object_key
+            ORDER BY coalesce(by_id.request_id, by_key.request_id, staged.request_id),
+                staged.load_seq {order}
+        ),
+        inserted AS (
+            INSERT INTO request_status ({columns})
+            SELECT {columns}
+            FROM matched
+            WHERE job_id IS NULL
+            ORDER BY load_seq
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )"""
+    if on_conflict != "update":
+        return merged + """
+        SELECT (SELECT count(*) FROM inserted) AS inserted, 0 AS updated
+        """
+    # a job keeps its request_id, request_group_id and object_key
+    updates = ", ".join(f"{column} = matched.{column}" for column in REQUEST_COLUMNS
+                        if column not in ("request_id", "request_group_id", "object_key"))
+    return merged + f""",
+        updated AS (
+            UPDATE request_status
+            SET {updates}
+            FROM matched
+            WHERE request_status.request_id = matched.job_id
+            RETURNING 1
+        )
+        SELECT
+            (SELECT count(*) FROM inserted) AS inserted,
+            (SELECT count(*) FROM updated) AS updated
+        """
+
+def load_requests_file(path, on_conflict="skip", session=None):
+    """
+    Bulk loads requests from a JSONL file, with one request data dict per
+    line, or from a CSV file with a header line of request_status column
+    names, with load_requests(). The format comes from the file name, which
+    may end in .jsonl or .csv, optionally followed by .gz. The file is read
+    a line at a time as the rows are loaded. Empty CSV values are loaded
+    as NULL.
+
+    Returns and raises the same as load_requests().
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(".jsonl") or name.endswith(".json"):
+        data_iter = _read_jsonl(path)
+    elif name.endswith(".csv"):
+        data_iter = _read_csv(path)
+    else:
+        raise BadRequestError(f"Unknown file format for {path}, expected .jsonl or .csv")
+    return load_requests(data_iter, on_conflict, session)
+
+def _open_text(path, mode="r"):
+    """
+    Opens a text file for reading, or writing with mode "w", compressing it
+    if its name ends in .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+def _read_jsonl(path):
+    """
+    Yields the dict on each non-blank line of a JSONL file.
+    """
+    with _open_text(path) as jsonl_file:
+        for line in jsonl_file:
+            if line.strip():
+                yield json.loads(line)
+
+def _read_csv(path):
+    """
+    Yields each row of a CSV file as a dict, with None for empty values.
+    """
+    with _open_text(path) as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield {key: value if value != "" else None for key, value in row.items()}
+
+def export_requests(target, file_format=None,   #pylint: disable-msg=too-many-arguments
+                    statuses=None, start_time=None, end_time=None, itersize=None,
+                    use_primary=False):
+    """
+    Writes the requests, optionally filtered by status and request_time, to
+    a file as JSONL, with one request dict per line, or as CSV, with a header
+    line of request_status column names, the formats load_requests_file()
+    reads. The rows are streamed from the database to the file, so memory
+    use stays the same however many there are. CSV is written with
+    COPY TO STDOUT, JSONL from a server side cursor read itersize rows at
+    a time.
+
+        Args:
+            target (string or file): A file name, which gives the format,
+                .jsonl or .csv, and is gzipped if it ends in .gz, or a binary
+                file object, such as an S3 upload, to write gzipped data to.
+            file_format (string): "jsonl" or "csv", required when target is
+                a file object.
+            statuses (list(string)): Optional, the job_status values to export.
+            start_time (string): Optional, export the requests made at or
+                after this time.
+            end_time (string): Optional, export the requests made before this time.
+            itersize (int): The rows read at a time for JSONL.
+            use_primary (bool): Read from the primary, not the read replica.
+
+        Returns:
+            dict: The number of "rows" written, the "secs" taken and the
+                "rows_per_sec".
+
+        Raises:
+            BadRequestError: The format, statuses or a time is not valid.
+            DatabaseError: An error occurred reading the requests. The file
+                holds the rows written before it.
+    """
+    if isinstance(target, str):
+        name = target[:-3] if target.endswith(".gz") else target
+        file_format = file_format or name.rsplit(".", 1)[-1]
+    if file_format == "json":
+        file_format = "jsonl"
+    if file_format not in ("jsonl", "csv"):
+        raise BadRequestError(f"Unknown export format {file_format}, expected jsonl or csv")
+    sql, params = _export_query(statuses, start_time, end_time)
+
+    stats = {"rows": 0, "secs": 0.0, "rows_per_sec": 0.0}
+    start = time.perf_counter()
+    out = (_open_text(target, "w") if isinstance(target, str)
+           else io.TextIOWrapper(gzip.GzipFile(fileobj=target, mode="wb"),
+                                 encoding="utf-8", newline=""))
+    try:
+        if file_format == "csv":
+            try:
+                stats["rows"] = database.copy_query(
+                    sql, get_reader_dbconnect_info(use_primary), out, params)
+            except DbError as err:
+                LOGGER.exception(f"DbError exporting requests: {str(err)}")
+                raise _database_error(err)
+        else:
+            for job in _stream_rows(sql, params, itersize, "dict", use_primary):
+                out.write(json.dumps(job) + "\n")
+                stats["rows"] += 1
+    finally:
+        if isinstance(target, str):
+            out.close()
+        else:
+            # closes the gzip stream, leaving the caller's file open
+            out.flush()
+            out.detach().close()
+        stats["secs"] = round(time.perf_counter() - start, 3)
+        if stats["secs"]:
+            stats["rows_per_sec"] = round(stats["rows"] / stats["secs"], 1)
+        LOGGER.info(f"exported {stats['rows']} requests as {file_format} "
+                    f"in {stats['secs']}s, {stats['rows_per_sec']} rows/s")
+    return stats
+
+def _export_query(statuses, start_time, end_time):
+    """
+    Returns the sql and params for selecting the requests to export. The
+    rows are not sorted, so that they can be sent as they are read.
+    """
+    conditions = []
+    params = []
+    if statuses:
+        if isinstance(statuses, str):
+            statuses = [statuses]
+        statuses = list(statuses)
+        if any(status not in ("inprogress", "complete", "error") for status in statuses):
+            raise BadRequestError(
+                f"statuses must be 'inprogress', 'complete' and/or 'error', not {statuses}")
+        conditions.append("job_status = ANY(%s)")
+        params.append(statuses)
+    for value, condition in ((start_time, "request_time >= %s"),
+                             (end_time, "request_time < %s")):
+        if value:
+            try:
+                params.append(dateutil.parser.parse(value).isoformat())
+            except (TypeError, ValueError, OverflowError) as err:
+                raise BadRequestError(f"Invalid time {value}: {str(err)}")
+            conditions.append(condition)
+    sql = f"SELECT {', '.join(REQUEST_COLUMNS)} FROM request_status"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql, tuple(params)
+
+def build_insert_params(data):
+    """
+    Validates the provided request data (as a dict), filling in the optional
+    values, and returns the parameters for inserting it into request_status.
+
+    Raises BadRequestError if there is a problem with the input.
+    """
     # date might be provided, if not use current utc date
     date = get_utc_now_iso()
 
-    #data["request_id"] = request_id
-
     if "request_time" in data:
         rq_date = dateutil.parser.parse(data["request_time"])
     else:
@@ -121,19 +1029,56 @@ def submit_request(data):
         )
     except KeyError as err:
         raise BadRequestError(f"Missing {str(err)} in input data")
+    return params
+
+def get_job_by_request_id(request_id, session=None, use_primary=False):
+    """
+    Reads a row from request_status by request_id, or from the job cache,
+    see get_job_cache().
+    """
+    cache = _read_cache(session)
+    result = cache.get(("request_id", str(request_id))) if cache else None
+    if result is not None:
+        return result
+
     try:
-        dbconnect_info = get_dbconnect_info()
-        database.single_query(sql, dbconnect_info, params)
+        rows = _read_query(_job_by_request_id_sql(), (request_id,), session, use_primary)
+        result = result_to_json(rows)
     except DbError as err:
         LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
-    return data["request_id"]
+        raise _database_error(err)
 
-def get_job_by_request_id(request_id):
+    if cache and result and _reads_primary(use_primary):
+        cache.put(("request_id", str(request_id)), result)
+    return result
+
+async def get_job_by_request_id_async(request_id, use_primary=False):
     """
-    Reads a row from request_status by request_id.
+    The asynchronous get_job_by_request_id(), for callers running in an event loop.
     """
-    sql = """
+    cache = get_job_cache()
+    result = cache.get(("request_id", str(request_id))) if cache else None
+    if result is not None:
+        return result
+
+    try:
+        dbconnect_info = get_reader_dbconnect_info(use_primary)
+        rows = await async_database.single_query(_job_by_request_id_sql(), dbconnect_info,
+                                                 (request_id,))
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    if cache and result and _reads_primary(use_primary):
+        cache.put(("request_id", str(request_id)), result)
+    return result
+
+def _job_by_request_id_sql():
+    """
+    Returns the sql for reading a row from request_status by request_id.
+    """
+    return """
         SELECT
             request_id,
             request_group_id,
@@ -151,21 +1096,73 @@ def get_job_by_request_id(request_id):
         WHERE
             request_id = %s
         """
+
+def get_jobs_by_granule_id(granule_id, session=None, use_primary=False):
+    """
+    Reads rows from request_status by granule_id.
+    """
+    sql = """
+        SELECT
+            request_id,
+            request_group_id,
+            granule_id,
+            object_key,
+            job_type,
+            restore_bucket_dest,
+            archive_bucket_dest,
+            job_status,
+            request_time,
+            last_update_time,
+            err_msg
+        FROM
+            request_status
+        WHERE
+            granule_id = %s
+        ORDER BY last_update_time desc
+        """
+    try:
+        rows = _read_query(sql, (granule_id,), session, use_primary)
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    return result
+
+def get_jobs_by_object_key(object_key, session=None, use_primary=False):
+    """
+    Reads rows from request_status by object_key.
+    """
     try:
-        dbconnect_info = get_dbconnect_info()
-        rows = database.single_query(sql, dbconnect_info, (request_id,))
+        rows = _read_query(_jobs_by_object_key_sql(), (object_key,), session, use_primary,
+                           prepare_as="request_status_by_object_key")
         result = result_to_json(rows)
     except DbError as err:
         LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
+        raise _database_error(err)
 
     return result
 
-def get_jobs_by_granule_id(granule_id):
+async def get_jobs_by_object_key_async(object_key, use_primary=False):
     """
-    Reads rows from request_status by granule_id.
+    The asynchronous get_jobs_by_object_key(), for callers running in an event loop.
     """
-    sql = """
+    try:
+        dbconnect_info = get_reader_dbconnect_info(use_primary)
+        rows = await async_database.single_query(_jobs_by_object_key_sql(), dbconnect_info,
+                                                 (object_key,))
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    return result
+
+def _jobs_by_object_key_sql():
+    """
+    Returns the sql for reading rows from request_status by object_key.
+    """
+    return """
         SELECT
             request_id,
             request_group_id,
@@ -181,25 +1178,96 @@ def get_jobs_by_granule_id(granule_id):
         FROM
             request_status
         WHERE
-            granule_id = %s
+            object_key = %s
         ORDER BY last_update_time desc
         """
+
+def get_active_jobs_by_object_keys(object_keys, session=None, use_primary=False):
+    """
+    Reads the newest job that is not complete for each of many object_keys,
+    in one query. The jobs in the job cache, see get_job_cache(), are taken
+    from there, and only the rest are read.
+
+        Args:
+            object_keys (list(string)): The object_keys to look up.
+
+        Returns:
+            dict: For each object_key that has a job that is not complete,
+                the newest such job, in Json format.
+
+        Raises:
+            DatabaseError: An error occurred reading the jobs.
+    """
+    cache = _read_cache(session)
+    jobs, missing = _cached_active_jobs(cache, object_keys)
+    if not missing:
+        return jobs
+
     try:
-        dbconnect_info = get_dbconnect_info()
-        rows = database.single_query(sql, dbconnect_info, (granule_id,))
+        rows = _read_query(_active_jobs_by_object_keys_sql(), (missing,), session, use_primary)
         result = result_to_json(rows)
     except DbError as err:
-        LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
+        LOGGER.exception(f"DbError reading jobs for {len(missing)} object_keys. {str(err)}")
+        raise _database_error(err)
 
-    return result
+    return _add_active_jobs(cache, jobs, result, use_primary)
 
-def get_jobs_by_object_key(object_key):
+async def get_active_jobs_by_object_keys_async(object_keys, use_primary=False):
     """
-    Reads rows from request_status by object_key.
+    The asynchronous get_active_jobs_by_object_keys(), for callers running
+    in an event loop.
     """
-    sql = """
-        SELECT
+    cache = get_job_cache()
+    jobs, missing = _cached_active_jobs(cache, object_keys)
+    if not missing:
+        return jobs
+
+    try:
+        dbconnect_info = get_reader_dbconnect_info(use_primary)
+        rows = await async_database.single_query(_active_jobs_by_object_keys_sql(),
+                                                 dbconnect_info, (missing,))
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError reading jobs for {len(missing)} object_keys. {str(err)}")
+        raise _database_error(err)
+
+    return _add_active_jobs(cache, jobs, result, use_primary)
+
+def _cached_active_jobs(cache, object_keys):
+    """
+    Returns the active jobs of the object_keys that are in the cache, by
+    object_key, and a list of the object_keys that are not.
+    """
+    if not cache:
+        return {}, list(object_keys)
+    jobs = {}
+    missing = []
+    for object_key in object_keys:
+        job = cache.get(("active", object_key))
+        if job is None:
+            missing.append(object_key)
+        else:
+            jobs[object_key] = job
+    return jobs, missing
+
+def _add_active_jobs(cache, jobs, result, use_primary):
+    """
+    Adds the active jobs read from the database to those from the cache,
+    and caches them.
+    """
+    for job in result:
+        jobs[job["object_key"]] = job
+        if cache and _reads_primary(use_primary):
+            cache.put(("active", job["object_key"]), job)
+    return jobs
+
+def _active_jobs_by_object_keys_sql():
+    """
+    Returns the sql for reading the newest job that is not complete for each
+    object_key in an array.
+    """
+    return """
+        SELECT DISTINCT ON (object_key)
             request_id,
             request_group_id,
             granule_id,
@@ -214,24 +1282,32 @@ def get_jobs_by_object_key(object_key):
         FROM
             request_status
         WHERE
-            object_key = %s
-        ORDER BY last_update_time desc
+            object_key = ANY(%s)
+            and job_status <> 'complete'
+        ORDER BY object_key, last_update_time desc
         """
-    try:
-        dbconnect_info = get_dbconnect_info()
-        rows = database.single_query(sql, dbconnect_info, (object_key,))
-        result = result_to_json(rows)
-    except DbError as err:
-        LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
-
-    return result
 
 
-def update_request_status_for_job(request_id, status, err_msg=None):
+def update_request_status_for_job(request_id, status, err_msg=None, session=None):
     """
     Updates the status of a job.
     """
+    return _update_job(request_id, status, err_msg, session, returning=False)
+
+def update_request_status_for_job_returning(request_id, status, err_msg=None, session=None):
+    """
+    The update_request_status_for_job() that returns the job as it was
+    updated, in a list like that of get_job_by_request_id(), which is empty
+    if there is no job with the request_id. The row comes back from the
+    update, with RETURNING, so there is no need to read the job again.
+    """
+    return result_to_json(_update_job(request_id, status, err_msg, session, returning=True))
+
+def _update_job(request_id, status, err_msg, session, returning):
+    """
+    Runs the update of update_request_status_for_job(), returning the job's
+    row when returning is True, and returns the rows.
+    """
     if request_id is None:
         raise BadRequestError("No request_id provided")
 
@@ -253,17 +1329,142 @@ def update_request_status_for_job(request_id, status, err_msg=None):
         WHERE
             request_id = %s
     """
+    prepare_as = "request_status_update_status"
+    if returning:
+        sql += f"""RETURNING {_RETURNING_COLUMNS}
+    """
+        prepare_as += "_returning"
     try:
-        dbconnect_info = get_dbconnect_info()
-        result = database.single_query(sql, dbconnect_info, (status, date, err_msg, request_id))
+        result = _single_query(sql, (status, date, err_msg, request_id), session,
+                               prepare_as=prepare_as)
     except DbError as err:
         msg = f"DbError updating status for job {request_id} to {status}. {str(err)}"
         LOGGER.exception(msg)
-        raise DatabaseError(str(err))
+        raise _database_error(err)
+    _invalidate_jobs([request_id])
     return result
 
 
-def delete_request(request_id):
+def update_request_status_for_jobs(updates, session=None):
+    """
+    Updates the status of many jobs in one statement.
+
+        Args:
+            updates (list(tuple)): A (request_id, status, err_msg) tuple for
+                each job to update. err_msg may be omitted. A request_id may be
+                a str or a UUID. If a request_id appears more than once, its last
+                update is the one applied.
+
+        Returns:
+            dict: For each request_id, True if the job was updated, or
+                False if there is no job with that request_id.
+
+        Raises:
+            BadRequestError: A request_id or status is missing.
+            DatabaseError: An error occurred updating the jobs.
+    """
+    sql, params, request_ids = _update_jobs_query(updates)
+    if not params:
+        return {}
+
+    return _updated_jobs(request_ids, _update_jobs(sql, params, session))
+
+def update_request_status_for_jobs_returning(updates, session=None):
+    """
+    The update_request_status_for_jobs() that returns the jobs as they were
+    updated, a dict for each job found, from the RETURNING of the update.
+    A request_id with no job is left out.
+    """
+    sql, params, _ = _update_jobs_query(updates, returning=True)
+    if not params:
+        return []
+    return result_to_json(_update_jobs(sql, params, session))
+
+def _update_jobs(sql, params, session):
+    """
+    Runs the update of update_request_status_for_jobs(), and returns the rows.
+    """
+    try:
+        rows = _single_query(sql, params, session)
+    except DbError as err:
+        LOGGER.exception(f"DbError updating status for {len(params[1])} jobs. {str(err)}")
+        raise _database_error(err)
+
+    _invalidate_jobs(params[1])
+    return rows
+
+async def update_request_status_for_jobs_async(updates):
+    """
+    The asynchronous update_request_status_for_jobs(), for callers running
+    in an event loop.
+    """
+    sql, params, request_ids = _update_jobs_query(updates)
+    if not params:
+        return {}
+
+    try:
+        dbconnect_info = get_dbconnect_info()
+        rows = await async_database.single_query(sql, dbconnect_info, params)
+    except DbError as err:
+        LOGGER.exception(f"DbError updating status for {len(params[1])} jobs. {str(err)}")
+        raise _database_error(err)
+
+    _invalidate_jobs(params[1])
+    return _updated_jobs(request_ids, rows)
+
+def _updated_jobs(request_ids, rows):
+    """
+    Returns the result of update_request_status_for_jobs(), whether each of
+    the request_ids is one of the updated rows. They are compared as strings,
+    so a request_id may be given as a str or a UUID.
+    """
+    updated = {str(row["request_id"]) for row in rows}
+    return {request_id: str(request_id) in updated for request_id in request_ids}
+
+def _update_jobs_query(updates, returning=False):
+    """
+    Validates the updates for update_request_status_for_jobs, and returns the
+    sql and params that apply them, or None params if there are no updates,
+    and the request_ids as they were given. The sql returns the request_id of
+    each job updated, or, when returning is True, all of its columns.
+    """
+    by_request_id = {}
+    for update in updates:
+        request_id = update[0]
+        status = update[1]
+        err_msg = update[2] if len(update) > 2 else None
+        if request_id is None:
+            raise BadRequestError("No request_id provided")
+        if status is None:
+            raise BadRequestError("A new status must be provided")
+        by_request_id[str(request_id)] = (request_id, status, err_msg)
+
+    sql = """
+        UPDATE
+            request_status
+        SET
+            job_status = updates.job_status,
+            last_update_time = %s,
+            err_msg = updates.err_msg
+        FROM
+            unnest(%s::uuid[], %s::text[], %s::text[])
+                AS updates (request_id, job_status, err_msg)
+        WHERE
+            request_status.request_id = updates.request_id
+        RETURNING
+            """
+    # updates has columns of the same names, so the returned ones are qualified
+    columns = REQUEST_COLUMNS if returning else ("request_id",)
+    sql += ", ".join(f"request_status.{column}" for column in columns)
+    if not by_request_id:
+        return sql, None, []
+
+    jobs = list(by_request_id.values())
+    return sql, (get_utc_now_iso(), list(by_request_id), [job[1] for job in jobs],
+                 [job[2] for job in jobs]), [job[0] for job in jobs]
+
+
+def delete_request(request_id, session=None):
     """
     Deletes a job by request_id.
     """
@@ -277,14 +1478,14 @@ def delete_request(request_id):
             request_id = %s
     """
     try:
-        dbconnect_info = get_dbconnect_info()
-        result = database.single_query(sql, dbconnect_info, (request_id,))
+        result = _single_query(sql, (request_id,), session)
     except DbError as err:
         LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
+        raise _database_error(err)
+    _invalidate_jobs([request_id])
     return result
 
-def delete_all_requests():
+def delete_all_requests(session=None):
     """
     Deletes everything from the request_status table.
 
@@ -296,19 +1497,350 @@ def delete_all_requests():
         DELETE FROM request_status
     """
     try:
-        dbconnect_info = get_dbconnect_info()
-        result = database.single_query(sql, dbconnect_info, ())
+        result = _single_query(sql, (), session)
     except DbError as err:
         LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
+        raise _database_error(err)
+
+    if _JOB_CACHE is not None:
+        _JOB_CACHE.clear()
+    return result
+
+def purge_requests(days_old, statuses=("complete", "error"), batch_size=None,
+                   archive_path=None):
+    """
+    Deletes the jobs with a finished status that were last updated more than
+    days_old days ago, in batches, so that request_status doesn't grow
+    without bound. Each batch is a short transaction of its own, which
+    deletes up to batch_size of the oldest remaining rows of one status,
+    read from the job_status index after the last row of the batch before.
+    Rows locked by another transaction are skipped, so the purge never
+    waits on, or holds up, the lambdas writing to the table.
+
+    When the calls are made in a deadline() block, the purge stops before a
+    batch that might not finish in the time left, and can be run again to
+    carry on.
+
+        Args:
+            days_old (number): Purge the rows last updated before this many
+                days ago.
+            statuses (list(string)): The job_status values to purge, from
+                "complete" and "error".
+            batch_size (int): The most rows to delete in a transaction. The
+                default comes from the DATABASE_PURGE_BATCH_SIZE env var, or 5000.
+            archive_path (string): Optional, a file to write each purged row
+                to, as JSONL, before the batch that deletes it is committed.
+                The file is gzipped if the name ends in .gz.
+
+        Returns:
+            dict: The number of rows "deleted", the number of "batches",
+                the "secs" taken, the "rows_per_sec", and whether the purge
+                "finished" or was stopped by the deadline.
+
+        Raises:
+            BadRequestError: days_old, statuses or batch_size is not valid.
+            DatabaseError: An error occurred deleting a batch. The batches
+                before it stay deleted.
+    """
+    statuses = _purge_statuses(statuses)
+    if batch_size is None:
+        batch_size = os.environ.get("DATABASE_PURGE_BATCH_SIZE", 5000)
+    try:
+        cutoff = (datetime.datetime.now(datetime.timezone.utc)
+                  - datetime.timedelta(days=float(days_old)))
+        batch_size = int(batch_size)
+    except (TypeError, ValueError, OverflowError) as err:
+        raise BadRequestError(f"Invalid days_old or batch_size: {str(err)}")
+    if float(days_old) < 0 or batch_size < 1:
+        raise BadRequestError("days_old must be 0 or more, and batch_size 1 or more")
+
+    stats = {"deleted": 0, "batches": 0, "secs": 0.0, "rows_per_sec": 0.0, "finished": True}
+    start = time.perf_counter()
+    archive = _open_text(archive_path, "w") if archive_path else None
+    try:
+        for status in statuses:
+            if not _purge_status(status, cutoff, batch_size, archive, stats):
+                stats["finished"] = False
+                break
+    finally:
+        if archive:
+            archive.close()
+        stats["secs"] = round(time.perf_counter() - start, 3)
+        if stats["secs"]:
+            stats["rows_per_sec"] = round(stats["deleted"] / stats["secs"], 1)
+        LOGGER.info(f"purged {stats['deleted']} requests older than {cutoff.isoformat()} "
+                    f"in {stats['batches']} batches, {stats['secs']}s, "
+                    f"{stats['rows_per_sec']} rows/s")
+    return stats
+
+def _purge_statuses(statuses):
+    """
+    Returns the statuses to purge as a list, or raises BadRequestError if
+    there are none, or one of them is of a job that may still be running.
+    """
+    if isinstance(statuses, str):
+        statuses = [statuses]
+    statuses = list(statuses or [])
+    if not statuses or any(status not in ("complete", "error") for status in statuses):
+        raise BadRequestError(f"statuses must be 'complete' and/or 'error', not {statuses}")
+    return statuses
+
+def _purge_status(status, cutoff, batch_size, archive, stats):
+    """
+    Deletes the rows of one status in batches, adding them up in stats.
+    Returns False if it stopped for the deadline.
+    """
+    after = None
+    batch_secs = 0.0
+    while True:
+        remaining = database.remaining_secs()
+        if remaining is not None and remaining <= batch_secs:
+            return False
+        batch_start = time.perf_counter()
+        with transaction() as session:
+            try:
+                rows = session.query(*_purge_batch_query(status, cutoff, after, batch_size))
+            except DbError as err:
+                LOGGER.exception(f"DbError purging requests: {str(err)}")
+                raise _database_error(err)
+            if archive and rows:
+                # copies, as result_to_json() converts dict rows in place, and
+                # the keyset of the next batch needs the datetimes
+                for job in result_to_json([dict(row) for row in rows]):
+                    archive.write(json.dumps(job) + "\n")
+                archive.flush()
+        batch_secs = time.perf_counter() - batch_start
+        if not rows:
+            return True
+        stats["deleted"] += len(rows)
+        stats["batches"] += 1
+        _invalidate_jobs([row["request_id"] for row in rows],
+                         [row["object_key"] for row in rows])
+        if len(rows) < batch_size:
+            return True
+        after = max((row["last_update_time"], str(row["request_id"])) for row in rows)
+
+def _purge_batch_query(status, cutoff, after, batch_size):
+    """
+    Returns the sql, and its params, that deletes the next batch of rows of
+    a status last updated before the cutoff, after the (last_update_time,
+    request_id) of the batch before, and returns the deleted rows.
+    """
+    columns = ", ".join(f"r.{column}" for column in REQUEST_COLUMNS)
+    # a job is updated after it is requested, so the request_time bound
+    # finds nothing more, but lets a partitioned table skip newer partitions
+    params = [status, cutoff, cutoff]
+    keyset = ""
+    if after:
+        keyset = "AND (last_update_time, request_id) > (%s, %s)"
+        params.extend(after)
+    params.append(batch_size)
+    sql = f"""
+        WITH batch AS (
+            SELECT request_id
+            FROM request_status
+            WHERE job_status = %s
+                AND last_update_time < %s
+                AND request_time < %s
+                {keyset}
+            ORDER BY last_update_time, request_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        DELETE FROM request_status r
+        USING batch
+        WHERE r.request_id = batch.request_id
+        RETURNING {columns}
+        """
+    return sql, tuple(params)
+
+def maintain_partitions(months_ahead=3, retain_months=None, detach=False):
+    """
+    Makes the monthly partitions of request_status, when it is partitioned
+    by request_time, see database/ddl/base/partitions/request_status.sql,
+    for this month and the months_ahead after it. With retain_months, the
+    partitions of months before the last retain_months are then dropped,
+    or only detached from request_status when detach is True, so that they
+    can be archived and dropped later. Either way the rows are removed in
+    one quick statement, rather than deleted a row at a time.
+
+    A partition that still has an inprogress job is kept, as is a month
+    that rows in the default partition would belong to, which is logged.
+    Each partition is made or removed in a transaction of its own, by the
+    functions of database/ddl/base/partitions/request_status_maintenance.sql,
+    which run as the owner of request_status, as the application user can't
+    create, drop or detach its partitions.
+
+        Args:
+            months_ahead (int): The number of months after this one to make
+                partitions for.
+            retain_months (int): Optional, the number of months, including
+                this one, to keep.
+            detach (bool): Detach the expired partitions rather than drop them.
 
+        Returns:
+            dict: Whether request_status is "partitioned", and lists of the
+                partitions "created", "dropped", "detached" and "skipped".
+
+        Raises:
+            BadRequestError: months_ahead or retain_months is not valid.
+            DatabaseError: An error occurred. The partitions made or removed
+                before it stay that way.
+    """
+    if not isinstance(months_ahead, int) or months_ahead < 0:
+        raise BadRequestError(f"months_ahead must be 0 or more, not {months_ahead}")
+    if retain_months is not None and (not isinstance(retain_months, int) or retain_months < 1):
+        raise BadRequestError(f"retain_months must be 1 or more, not {retain_months}")
+
+    result = {"partitioned": False, "created": [], "dropped": [], "detached": [], "skipped": []}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    this_month = datetime.datetime(now.year, now.month, 1, tzinfo=datetime.timezone.utc)
+    try:
+        partitions = _partitions()
+        if partitions is None:
+            LOGGER.info("request_status is not partitioned")
+            return result
+        result["partitioned"] = True
+
+        for offset in range(months_ahead + 1):
+            month = _add_months(this_month, offset)
+            name = _partition_name(month)
+            if name in partitions:
+                continue
+            if _create_partition(name, month):
+                result["created"].append(name)
+            else:
+                result["skipped"].append(name)
+
+        if retain_months:
+            oldest = _add_months(this_month, 1 - retain_months)
+            for name in sorted(partitions):
+                month = _partition_month(name)
+                if month is None or month >= oldest:
+                    continue
+                if _remove_partition(name, detach):
+                    result["detached" if detach else "dropped"].append(name)
+                else:
+                    result["skipped"].append(name)
+    except DbError as err:
+        LOGGER.exception(f"DbError maintaining partitions: {str(err)}")
+        raise _database_error(err)
+    finally:
+        LOGGER.info(f"request_status partitions: {result}")
+
+    if (result["dropped"] or result["detached"]) and _JOB_CACHE is not None:
+        _JOB_CACHE.clear()
     return result
 
-def get_all_requests():
+def _partitions():
+    """
+    Returns the names of the partitions of request_status, or None if it
+    is not partitioned.
+    """
+    rows = _single_query("""
+        SELECT
+            c.relkind = 'p' AS partitioned,
+            array_remove(array_agg(p.relname::text), NULL) AS partitions
+        FROM pg_class c
+        LEFT JOIN pg_inherits i ON i.inhparent = c.oid
+        LEFT JOIN pg_class p ON p.oid = i.inhrelid
+        WHERE c.oid = 'request_status'::regclass
+        GROUP BY c.relkind """, ())
+    if not rows[0]["partitioned"]:
+        return None
+    return set(rows[0]["partitions"])
+
+def _create_partition(name, month):
+    """
+    Makes the partition of request_status for a month, unless there are
+    rows for it in the default partition, and returns True if it was made.
+    """
+    with transaction() as session:
+        _, rows = session.batch_query([
+            (_PARTITION_LOCK_TIMEOUT_SQL, None),
+            ("SELECT create_request_status_partition(%s) AS created", (month,))])
+    if not rows[0]["created"]:
+        LOGGER.warning(f"Not making {name}, request_status_default has rows for it")
+    return rows[0]["created"]
+
+def _remove_partition(name, detach):
+    """
+    Drops, or detaches, an expired partition of request_status, unless it
+    has an inprogress job, and returns True if it was removed.
+    """
+    with transaction() as session:
+        _, rows = session.batch_query([
+            (_PARTITION_LOCK_TIMEOUT_SQL, None),
+            ("SELECT remove_request_status_partition(%s, %s) AS removed", (name, detach))])
+    if not rows[0]["removed"]:
+        LOGGER.warning(f"Not removing {name}, it has inprogress jobs")
+    return rows[0]["removed"]
+
+def _partition_name(month):
+    """
+    Returns the name of the partition of request_status for a month.
+    """
+    return f"request_status_p{month:%Y%m}"
+
+def _partition_month(name):
+    """
+    Returns the month of a partition of request_status, as a datetime, or
+    None if it isn't a monthly partition.
+    """
+    if not name.startswith("request_status_p"):
+        return None
+    try:
+        month = datetime.datetime.strptime(name[len("request_status_p"):], "%Y%m")
+    except ValueError:
+        return None
+    return month.replace(tzinfo=datetime.timezone.utc)
+
+def _add_months(month, count):
+    """
+    Returns the first of the month count months after a month.
+    """
+    months = month.year * 12 + month.month - 1 + count
+    return month.replace(year=months // 12, month=months % 12 + 1, day=1)
+
+def get_all_requests(session=None, use_primary=False):
     """
     Returns all of the requests.
     """
-    sql = """
+    try:
+        rows = _read_query(_all_requests_sql(), (), session, use_primary)
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    return result
+
+def get_all_requests_page(page_size=100, cursor=None, session=None, use_primary=False):
+    """
+    Returns a page of up to page_size of the requests, in the order of
+    get_all_requests(), and the cursor for the next page, which is None after
+    the last page. Pass the cursor back in to get the next page. Each page
+    is read from an index, after the last row of the one before, so a late
+    page costs no more than the first.
+
+    Raises BadRequestError if the page_size or cursor is not valid.
+    """
+    sql, params = _page_query(None, (), page_size, cursor)
+    return _read_page(sql, params, page_size, session, use_primary)
+
+def iter_all_requests(itersize=None, row_format="dict", use_primary=False):
+    """
+    Yields all of the requests, one at a time. The rows are read from the
+    database itersize at a time on a server side cursor, rather than all at once.
+    row_format "tuple" or "record" yields tuples or namedtuples instead of dicts.
+    """
+    return _stream_rows(_all_requests_sql(), (), itersize, row_format, use_primary)
+
+def _all_requests_sql():
+    """
+    Returns the sql for selecting all of the requests.
+    """
+    return """
         SELECT
             request_id,
             request_group_id,
@@ -323,17 +1855,7 @@ def get_all_requests():
             err_msg
         FROM
             request_status
-        ORDER BY last_update_time desc """
-
-    try:
-        dbconnect_info = get_dbconnect_info()
-        rows = database.single_query(sql, dbconnect_info, ())
-        result = result_to_json(rows)
-    except DbError as err:
-        LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
-
-    return result
+        ORDER BY last_update_time desc, request_id desc """
 
 def create_data(obj,   #pylint: disable-msg=too-many-arguments
                 job_type=None, job_status=None,
@@ -366,10 +1888,53 @@ def create_data(obj,   #pylint: disable-msg=too-many-arguments
         data["err_msg"] = err_msg
     return data
 
-def get_jobs_by_status(status, max_days_old=None):
+def get_jobs_by_status(status, max_days_old=None, session=None, use_primary=False):
     """
     Returns rows from request_status by status, and optional days old
     """
+    sql, params = _jobs_by_status_query(status, max_days_old)
+    try:
+        rows = _read_query(sql, params, session, use_primary)
+        result = result_to_json(rows)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    return result
+
+def get_jobs_by_status_page(status, max_days_old=None,   #pylint: disable-msg=too-many-arguments
+                            page_size=100, cursor=None, session=None, use_primary=False):
+    """
+    Returns a page of up to page_size of the rows from request_status by
+    status, and optional days old, and the cursor for the next page, in the
+    same way as get_all_requests_page().
+    """
+    if status is None:
+        raise BadRequestError("A status must be provided")
+
+    where = "job_status = %s"
+    params = (status,)
+    if max_days_old:
+        where += """ and last_update_time > CURRENT_DATE at time zone 'utc' - INTERVAL '%s' DAY"""
+        params = (status, max_days_old)
+    sql, params = _page_query(where, params, page_size, cursor)
+    return _read_page(sql, params, page_size, session, use_primary)
+
+def iter_jobs_by_status(status, max_days_old=None, itersize=None, row_format="dict",
+                        use_primary=False):
+    """
+    Yields rows from request_status by status, and optional days old, one at
+    a time. The rows are read from the database itersize at a time on a
+    server side cursor, rather than all at once. row_format "tuple" or
+    "record" yields tuples or namedtuples instead of dicts.
+    """
+    sql, params = _jobs_by_status_query(status, max_days_old)
+    return _stream_rows(sql, params, itersize, row_format, use_primary)
+
+def _jobs_by_status_query(status, max_days_old):
+    """
+    Returns the sql and params for selecting jobs by status, and optional days old
+    """
     if status is None:
         raise BadRequestError("A status must be provided")
 
@@ -391,26 +1956,14 @@ def get_jobs_by_status(status, max_days_old=None):
         WHERE
             job_status = %s
         """
-    orderby = """ order by last_update_time desc """
-    try:
-        dbconnect_info = get_dbconnect_info()
-        if max_days_old:
-            sql2 = """ and last_update_time > CURRENT_DATE at time zone 'utc' - INTERVAL '%s' DAY"""
-            sql = sql +  sql2 + orderby
-            rows = database.single_query(sql, dbconnect_info, (status, max_days_old,))
-            result = result_to_json(rows)
-        else:
-            sql = sql + orderby
-            rows = database.single_query(sql, dbconnect_info, (status,))
-            result = result_to_json(rows)
-    except DbError as err:
-        LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
-
-    return result
+    orderby = """ order by last_update_time desc, request_id desc """
+    if max_days_old:
+        sql2 = """ and last_update_time > CURRENT_DATE at time zone 'utc' - INTERVAL '%s' DAY"""
+        return sql + sql2 + orderby, (status, max_days_old,)
+    return sql + orderby, (status,)
 
 
-def get_jobs_by_request_group_id(request_group_id):
+def get_jobs_by_request_group_id(request_group_id, session=None, use_primary=False):
     """
     Returns rows from request_status for a request_group_id
     """
@@ -438,22 +1991,242 @@ def get_jobs_by_request_group_id(request_group_id):
     orderby = """ order by last_update_time desc """
     try:
         sql = sql + orderby
-        dbconnect_info = get_dbconnect_info()
-        rows = database.single_query(sql, dbconnect_info, (request_group_id,))
+        rows = _read_query(sql, (request_group_id,), session, use_primary,
+                           prepare_as="request_status_by_group_id")
         result = result_to_json(rows)
     except DbError as err:
         LOGGER.exception(f"DbError: {str(err)}")
-        raise DatabaseError(str(err))
+        raise _database_error(err)
 
     return result
 
 
-def result_to_json(result_rows):
+def watch_status_changes(request_group_ids=None, since=None, timeout_secs=None,
+                         poll_secs=1.0):
+    """
+    Yields the job_status changes of jobs as they are committed, from the
+    NOTIFY sent by the trigger on request_status, so that a waiter hears of
+    them in milliseconds, rather than by polling get_jobs_by_request_group_id().
+    For example, to wait for the jobs of a request:
+
+        for change in requests_db.watch_status_changes([request_group_id],
+                                                       since=submitted, timeout_secs=600):
+            if change["job_status"] != "inprogress":
+                pending.discard(change["request_id"])
+            if not pending:
+                break
+
+    Each change is a dict with the request_id, request_group_id, job_status
+    and last_update_time of the job. When since is given, the jobs last
+    updated at or after it are yielded first, with their current status,
+    so that changes committed before the watch started are not missed. When
+    the connection is lost the watch reconnects, with database.backoff_delays(),
+    and rereads the jobs updated while it was away in the same way. A change
+    is not yielded twice unless it is older than the last few thousand.
+
+        Args:
+            request_group_ids (list(string)): Optional, only yield the changes
+                of the jobs of these request_group_ids.
+            since (string): Optional, a time to first read the changes from.
+            timeout_secs (number): Optional, stop after this many seconds.
+                The watch also stops at the deadline() of the block it is in.
+            poll_secs (number): How often to check for the timeout while
+                there are no changes.
+
+        Raises:
+            BadRequestError: A request_group_id, since or timeout_secs is
+                not valid.
+            DatabaseError: The connection failed, and could not be made again.
+    """
+    if isinstance(request_group_ids, str):
+        request_group_ids = [request_group_ids]
+    try:
+        group_ids = ({str(uuid.UUID(str(group_id))) for group_id in request_group_ids}
+                     if request_group_ids else None)
+        newest = dateutil.parser.parse(since) if since else None
+        stop = None if timeout_secs is None else time.monotonic() + float(timeout_secs)
+    except (TypeError, ValueError, OverflowError) as err:
+        raise BadRequestError(f"Invalid request_group_ids, since or timeout_secs: {str(err)}")
+    if newest is None:
+        newest = datetime.datetime.now(datetime.timezone.utc)
+    elif newest.tzinfo is None:
+        newest = newest.replace(tzinfo=datetime.timezone.utc)
+    return _watch_status_changes(group_ids, newest, since is not None, stop, poll_secs)
+
+def _watch_status_changes(group_ids, newest, reread, stop, poll_secs):
+    """
+    The generator for watch_status_changes().
+    """
+    dbconnect_info = get_dbconnect_info()
+    seen = collections.OrderedDict()
+    overlap = datetime.timedelta(0)
+    delays = None
+    while not _watch_stopped(stop, poll_secs):
+        try:
+            # listen first, so that a change made during the reread is heard
+            notifications = database.listen(STATUS_CHANNEL, dbconnect_info, poll_secs)
+            try:
+                changes = (_changed_since(newest - overlap, group_ids, dbconnect_info)
+                           if reread else [])
+                for change in changes:
+                    changed_at = change.pop("changed_at")
+                    newest = max(newest, changed_at)
+                    if _first_sighting(seen, change, changed_at):
+                        yield change
+                delays = None
+                for payload in notifications:
+                    if _watch_stopped(stop, poll_secs):
+                        return
+                    if payload is None:
+                        continue
+                    change = json.loads(payload)
+                    if group_ids is not None and change["request_group_id"] not in group_ids:
+                        continue
+                    changed_at = dateutil.parser.isoparse(change["last_update_time"])
+                    change["last_update_time"] = str(changed_at.astimezone(datetime.timezone.utc))
+                    newest = max(newest, changed_at)
+                    if _first_sighting(seen, change, changed_at):
+                        yield change
+            finally:
+                notifications.close()
+
+        except DbError as err:
+            if delays is None:
+                remaining = database.remaining_secs()
+                delays = database.backoff_delays(
+                    None if remaining is None else time.monotonic() + remaining)
+            delay = next(delays, None) if err.retryable else None
+            if delay is None:
+                LOGGER.exception(f"DbError watching status changes: {str(err)}")
+                raise _database_error(err)
+            LOGGER.warning(f"reconnecting in {delay:.2f} seconds after: {str(err)}")
+            time.sleep(delay)
+        reread = True
+        overlap = datetime.timedelta(seconds=_WATCH_OVERLAP_SECS)
+
+def _changed_since(since, group_ids, dbconnect_info):
+    """
+    Yields the jobs, optionally of some request_group_ids, last updated at
+    or after since, oldest first, as changes, with their last_update_time in
+    UTC, as the NOTIFY path has it, and as a datetime in changed_at.
+    """
+    sql = """
+        SELECT request_id, request_group_id, job_status, last_update_time
+        FROM request_status
+        WHERE last_update_time >= %s"""
+    params = [since.isoformat()]
+    if group_ids is not None:
+        sql += " AND request_group_id = ANY(%s::uuid[])"
+        params.append(sorted(group_ids))
+    sql += " ORDER BY last_update_time, request_id"
+    for row in database.stream_query(sql, dbconnect_info, tuple(params)):
+        changed_at = row["last_update_time"]
+        change = result_to_json(row)
+        change["last_update_time"] = str(changed_at.astimezone(datetime.timezone.utc))
+        change["changed_at"] = changed_at
+        yield change
+
+def _first_sighting(seen, change, changed_at):
+    """
+    Returns True, and remembers the change, if it has not been seen before.
+    The change is known by its request_id, job_status and the UTC datetime it
+    was made at, so that the same change from the NOTIFY payload and from the
+    reread match, whatever their time zone and format.
+    """
+    key = (change["request_id"], change["job_status"],
+           changed_at.astimezone(datetime.timezone.utc))
+    if key in seen:
+        return False
+    seen[key] = True
+    if len(seen) > _WATCH_SEEN_SIZE:
+        seen.popitem(last=False)
+    return True
+
+def _watch_stopped(stop, poll_secs):
+    """
+    Returns True once the watch's timeout has passed, or when there is no
+    longer time for another poll before the deadline.
+    """
+    if stop is not None and time.monotonic() >= stop:
+        return True
+    remaining = database.remaining_secs()
+    return remaining is not None and remaining <= poll_secs
+
+
+def _page_query(where, params, page_size, cursor):
+    """
+    Returns the sql and params for reading a page of the rows that match the
+    where clause, newest update first, that come after the cursor's position.
+    The request_id orders rows updated at the same time. One row more than
+    page_size is read, to tell whether there is a next page.
+    """
+    if not isinstance(page_size, int) or page_size < 1:
+        raise BadRequestError(f"page_size must be a positive integer, not {page_size}")
+    conditions = [where] if where else []
+    if cursor:
+        conditions.append("(last_update_time, request_id) < (%s, %s)")
+        params = params + _decode_cursor(cursor)
+    sql = f"SELECT {', '.join(REQUEST_COLUMNS)} FROM request_status"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY last_update_time desc, request_id desc LIMIT %s"
+    return sql, params + (page_size + 1,)
+
+def _read_page(sql, params, page_size, session, use_primary):
+    """
+    Runs a _page_query() and returns the page of rows, converted to Json
+    format, and the cursor for the next page, or None if there isn't one.
+    """
+    try:
+        rows = _read_query(sql, params, session, use_primary)
+        next_cursor = _encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        result = result_to_json(rows[:page_size])
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+    return result, next_cursor
+
+def _encode_cursor(row):
+    """
+    Returns the opaque cursor for the position after a row.
+    """
+    position = [row["last_update_time"].isoformat(), str(row["request_id"])]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def _decode_cursor(cursor):
+    """
+    Returns the (last_update_time, request_id) position of a cursor.
+
+    Raises BadRequestError if it is not a cursor returned by a page read.
+    """
+    try:
+        last_update_time, request_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (dateutil.parser.isoparse(last_update_time).isoformat(),
+                str(uuid.UUID(request_id)))
+    except (AttributeError, TypeError, ValueError) as err:
+        raise BadRequestError(f"Invalid cursor {cursor}: {str(err)}")
+
+def _stream_rows(sql, params, itersize, row_format, use_primary):
+    """
+    Yields the rows of a query, converted to Json format, one at a time.
+    """
+    try:
+        dbconnect_info = get_reader_dbconnect_info(use_primary)
+        for row in database.stream_query(sql, dbconnect_info, params, itersize):
+            yield result_to_json(row, row_format)
+    except DbError as err:
+        LOGGER.exception(f"DbError: {str(err)}")
+        raise _database_error(err)
+
+
+def result_to_json(result_rows, row_format="dict"):
     """
-    Converts a database result to Json format
+    Converts a database result to Json format. The datetime and UUID values
+    are converted to strings in one pass over the rows, see database.convert_rows()
+    for the row_format options.
     """
-    json_result = json.loads(json.dumps(result_rows, default=myconverter))
-    return json_result
+    return database.convert_rows(result_rows, row_format)
 
 
 def myconverter(obj):       #pylint: disable-msg=inconsistent-return-statements
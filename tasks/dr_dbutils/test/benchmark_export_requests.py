@@ -0,0 +1,58 @@
+"""
+Name: benchmark_export_requests.py
+
+Description:  Load test for requests_db.export_requests. Bulk loads synthetic
+requests into the postgres db that the *_postgres tests use, exports them as
+gzipped CSV and JSONL, reports the rows per second and the peak memory of the
+process, and deletes the rows again. Not collected by the unit tests, run it
+directly:
+
+    cd tasks/dr_dbutils
+    python test/benchmark_export_requests.py [rows]
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import uuid
+from unittest.mock import Mock
+
+import boto3
+
+import database
+import db_config
+import requests_db
+from benchmark_load_requests import synthetic_requests
+from request_helpers import mock_ssm_get_parameter
+
+
+def main(count):
+    """
+    loads the requests, exports them in each format, and prints the rows per
+    second, the file size and the peak memory
+    """
+    private_config = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                  'private_config.json')
+    db_config.set_env(private_config)
+    boto3.client = Mock()
+    mock_ssm_get_parameter(1)
+    request_group_id = str(uuid.uuid4())
+    print(f"loading {count} rows")
+    requests_db.load_requests(synthetic_requests(count, request_group_id))
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["export.csv.gz", "export.jsonl.gz"]:
+                path = os.path.join(tmp_dir, name)
+                result = requests_db.export_requests(path, statuses=["inprogress"])
+                size_mb = os.path.getsize(path) / 1024 / 1024
+                peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                print(f"{name}  {result}  {size_mb:,.1f} MB  peak rss {peak_mb:,.0f} MB")
+                os.remove(path)
+    finally:
+        database.single_query("DELETE FROM request_status WHERE request_group_id = %s",
+                              requests_db.get_dbconnect_info(), (request_group_id,))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
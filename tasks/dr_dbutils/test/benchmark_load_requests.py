@@ -0,0 +1,61 @@
+"""
+Name: benchmark_load_requests.py
+
+Description:  Load test for requests_db.load_requests. Bulk loads synthetic
+requests into the postgres db that the *_postgres tests use, reports the rows
+per second, and deletes the rows again. Not collected by the unit tests, run
+it directly:
+
+    cd tasks/dr_dbutils
+    python test/benchmark_load_requests.py [rows]
+"""
+
+import datetime
+import os
+import sys
+import time
+import uuid
+from unittest.mock import Mock
+
+import boto3
+
+import database
+import db_config
+import requests_db
+from request_helpers import mock_ssm_get_parameter
+
+
+def synthetic_requests(count, request_group_id):
+    """
+    yields count requests, without holding them in memory
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for idx in range(count):
+        yield {"request_id": str(uuid.uuid4()), "request_group_id": request_group_id,
+               "granule_id": f"granule_{idx // 10}", "object_key": f"objectkey_{idx}",
+               "job_type": "restore", "restore_bucket_dest": "my-restore-bucket",
+               "archive_bucket_dest": "my-archive-bucket", "job_status": "inprogress",
+               "request_time": now, "last_update_time": now}
+
+
+def main(count):
+    """
+    loads the requests and prints the elapsed time and rows per second
+    """
+    private_config = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                  'private_config.json')
+    db_config.set_env(private_config)
+    boto3.client = Mock()
+    mock_ssm_get_parameter(1)
+    request_group_id = str(uuid.uuid4())
+    print(f"loading {count} rows")
+    start = time.perf_counter()
+    result = requests_db.load_requests(synthetic_requests(count, request_group_id))
+    secs = time.perf_counter() - start
+    print(f"{result}  {secs:.1f}s  {count / secs:,.0f} rows/s")
+    database.single_query("DELETE FROM request_status WHERE request_group_id = %s",
+                          requests_db.get_dbconnect_info(), (request_group_id,))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -72,6 +72,13 @@ def mock_ssm_get_parameter(n_times):
         loop = loop + 1
     ssm_cli = boto3.client('ssm')
     ssm_cli.get_parameter = Mock(side_effect=params)
+    ssm_values = {"drdb-host": os.environ['DATABASE_HOST'],
+                  "drdb-user-pass": os.environ['DATABASE_PW']}
+    ssm_cli.get_parameters = Mock(side_effect=lambda Names, WithDecryption: {
+        "Parameters": [{"Name": name, "Value": ssm_values[name]} for name in Names],
+        "InvalidParameters": []})
+    database.invalidate_db_connect_info()
+    database._SSM_CLIENT = ssm_cli         #pylint: disable-msg=protected-access
 
 def create_handler_event():
     """
@@ -0,0 +1,175 @@
+"""
+Name: test_request_status_indexes_postgres.py
+
+Description:  Tests, against the postgres db running in docker, that the
+requests_db queries use an index once request_status holds a long history.
+The class loads 1,000,000 rows, most of them complete, with load_requests,
+and checks the EXPLAIN plan of each query. Loading takes a minute or so.
+"""
+
+import datetime
+import os
+import unittest
+import uuid
+from unittest.mock import Mock
+import boto3
+
+import database
+import db_config
+import requests_db
+
+from request_helpers import mock_ssm_get_parameter
+
+ROW_COUNT = 1000000
+KEY_COUNT = 250000
+
+def history_requests(count):
+    """
+    yields count requests, four per object_key and ten per granule, one
+    second apart. One in a hundred is inprogress and one in a thousand is
+    an error, the rest are complete.
+    """
+    start = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+    request_group_id = None
+    for idx in range(count):
+        if idx % 10 == 0:
+            request_group_id = str(uuid.uuid4())
+        job_status = "complete"
+        if idx % 100 == 0:
+            job_status = "inprogress"
+        if idx % 1000 == 0:
+            job_status = "error"
+        when = (start + datetime.timedelta(seconds=idx)).isoformat()
+        yield {"request_id": str(uuid.uuid4()), "request_group_id": request_group_id,
+               "granule_id": f"granule_{idx // 10}", "object_key": f"objectkey_{idx % KEY_COUNT}",
+               "job_type": "restore", "restore_bucket_dest": "my-restore-bucket",
+               "archive_bucket_dest": "my-archive-bucket", "job_status": job_status,
+               "request_time": when, "last_update_time": when}
+
+def plan_nodes(plan):
+    """
+    yields the node of an EXPLAIN (FORMAT JSON) plan and all of its children
+    """
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+class TestRequestStatusIndexesPostgres(unittest.TestCase):
+    """
+    TestRequestStatusIndexesPostgres.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        private_config = f"{os.path.realpath(__file__)}".replace(os.path.basename(__file__),
+                                                                 'private_config.json')
+        db_config.set_env(private_config)
+        cls.mock_boto3 = boto3.client
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        requests_db.load_requests(history_requests(ROW_COUNT))
+        dbconnect_info = requests_db.get_dbconnect_info()
+        con = database.return_connection(dbconnect_info)
+        try:
+            # the planner needs the statistics to choose the indexes
+            con.autocommit = True
+            with con.cursor() as cursor:
+                cursor.execute("VACUUM ANALYZE request_status")
+        finally:
+            con.autocommit = False
+            database.release_connection(dbconnect_info, con)
+
+    @classmethod
+    def tearDownClass(cls):
+        requests_db.delete_all_requests()
+        boto3.client = cls.mock_boto3
+
+    def setUp(self):
+        self.mock_single_query = database.single_query
+        self.sample = requests_db.get_jobs_by_object_key("objectkey_12345")[0]
+
+    def tearDown(self):
+        database.single_query = self.mock_single_query
+
+    def explain(self, call, *args, **kwargs):
+        """
+        Runs a requests_db function without running its query, and returns
+        the (node type, index name) of each node of the query's plan.
+        """
+        database.single_query = Mock(return_value=[])
+        call(*args, **kwargs)
+        sql, dbconnect_info, params = database.single_query.call_args[0]
+        database.single_query = self.mock_single_query
+        rows = database.single_query(f"EXPLAIN (FORMAT JSON) {sql}", dbconnect_info, params)
+        plan = rows[0]["QUERY PLAN"][0]["Plan"]
+        return [(node["Node Type"], node.get("Index Name")) for node in plan_nodes(plan)]
+
+    def assert_uses_index(self, nodes, index_name, node_type=None):
+        """
+        Asserts the plan reads request_status with the index, and never
+        with a sequential scan.
+        """
+        self.assertNotIn("Seq Scan", [node[0] for node in nodes], nodes)
+        self.assertIn(index_name, [node[1] for node in nodes], nodes)
+        if node_type:
+            self.assertIn((node_type, index_name), nodes)
+
+    def test_reads_by_key_use_indexes(self):
+        """
+        Tests the reads of jobs by request_id, request_group_id, granule_id
+        and object_key
+        """
+        nodes = self.explain(requests_db.get_job_by_request_id, self.sample["request_id"])
+        self.assert_uses_index(nodes, "request_status_pkey")
+
+        nodes = self.explain(requests_db.get_jobs_by_request_group_id,
+                             self.sample["request_group_id"])
+        self.assert_uses_index(nodes, "idx_reqstat_reqgidlstupd")
+
+        nodes = self.explain(requests_db.get_jobs_by_granule_id, self.sample["granule_id"])
+        self.assert_uses_index(nodes, "idx_reqstat_granidlstupd")
+
+        nodes = self.explain(requests_db.get_jobs_by_object_key, self.sample["object_key"])
+        self.assert_uses_index(nodes, "idx_reqstat_keylstupd")
+
+    def test_active_jobs_use_partial_index(self):
+        """
+        Tests the active jobs by object_key are read from the partial index
+        """
+        keys = [f"objectkey_{idx}" for idx in range(0, 5000, 50)]
+        nodes = self.explain(requests_db.get_active_jobs_by_object_keys, keys)
+        self.assert_uses_index(nodes, "idx_reqstat_keylstupd_active")
+
+    def test_jobs_by_status_use_index(self):
+        """
+        Tests the reads by status, and their pages, are read from the
+        status index
+        """
+        nodes = self.explain(requests_db.get_jobs_by_status, "error")
+        self.assert_uses_index(nodes, "idx_reqstat_statlstupdreqid")
+
+        _, cursor = requests_db.get_jobs_by_status_page("inprogress", page_size=50)
+        nodes = self.explain(requests_db.get_jobs_by_status_page, "inprogress",
+                             page_size=50, cursor=cursor)
+        self.assert_uses_index(nodes, "idx_reqstat_statlstupdreqid")
+
+    def test_pages_of_all_requests_use_index(self):
+        """
+        Tests a late page of all requests is read from the index
+        """
+        _, cursor = requests_db.get_all_requests_page(page_size=1000)
+        nodes = self.explain(requests_db.get_all_requests_page, 100, cursor)
+        self.assert_uses_index(nodes, "idx_reqstat_lstupdreqid")
+
+    def test_status_updates_use_primary_key(self):
+        """
+        Tests the status update of a job finds it by its primary key
+        """
+        nodes = self.explain(requests_db.update_request_status_for_job,
+                             self.sample["request_id"], "complete")
+        self.assert_uses_index(nodes, "request_status_pkey")
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['start'])
@@ -4,12 +4,21 @@ Name: test_requests.py
 Description:  Unit tests for requests_db.py.
 """
 
+import asyncio
+import contextlib
+import datetime
+import gzip
+import io
+import itertools
+import json
 import os
+import tempfile
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 import uuid
 import boto3
 
+import async_database
 import database
 from database import DbError
 from request_helpers import (REQUEST_GROUP_ID_EXP_1, REQUEST_GROUP_ID_EXP_2,
@@ -41,6 +50,17 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         self.mock_utcnow = requests_db.get_utc_now_iso
         self.mock_request_group_id = requests_db.request_id_generator
         self.mock_single_query = database.single_query
+        self.mock_values_query = database.values_query
+        self.mock_stream_query = database.stream_query
+        self.mock_multi_query = database.multi_query
+        self.mock_multi_values_query = database.multi_values_query
+        self.mock_multi_batch_query = database.multi_batch_query
+        self.mock_copy_rows = database.copy_rows
+        self.mock_copy_query = database.copy_query
+        self.mock_listen = database.listen
+        self.mock_transaction = database.transaction
+        self.mock_async_single_query = async_database.single_query
+        self.mock_async_values_query = async_database.values_query
         self.mock_uuid = uuid.uuid4
         self.mock_boto3_client = boto3.client
 
@@ -49,6 +69,17 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         boto3.client = Mock()
         uuid.uuid4 = self.mock_uuid
         database.single_query = self.mock_single_query
+        database.values_query = self.mock_values_query
+        database.stream_query = self.mock_stream_query
+        database.multi_query = self.mock_multi_query
+        database.multi_values_query = self.mock_multi_values_query
+        database.multi_batch_query = self.mock_multi_batch_query
+        database.copy_rows = self.mock_copy_rows
+        database.copy_query = self.mock_copy_query
+        database.listen = self.mock_listen
+        database.transaction = self.mock_transaction
+        async_database.single_query = self.mock_async_single_query
+        async_database.values_query = self.mock_async_values_query
         requests_db.request_id_generator = self.mock_request_group_id
         requests_db.get_utc_now_iso = self.mock_utcnow
         del os.environ["PREFIX"]
@@ -56,6 +87,9 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         del os.environ["DATABASE_NAME"]
         del os.environ["DATABASE_USER"]
         del os.environ["DATABASE_PW"]
+        os.environ.pop("DATABASE_READER_HOST", None)
+        os.environ.pop("DATABASE_JOB_CACHE_SIZE", None)
+        requests_db.reset_job_cache()
 
     def test_delete_all_requests(self):
         """
@@ -286,6 +320,64 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         self.assertEqual(expected, result)
         database.single_query.assert_called_once()
 
+    def test_get_active_jobs_by_object_keys(self):
+        """
+        Tests reading the active jobs for many object_keys in one query
+        """
+        mock_ssm_get_parameter(1)
+        _, exp_result = create_select_requests([REQUEST_ID10, REQUEST_ID11])
+        database.single_query = Mock(side_effect=[exp_result])
+        result = requests_db.get_active_jobs_by_object_keys(["objectkey_3", "objectkey_7",
+                                                             "objectkey_99"])
+        jobs = result_to_json(exp_result)
+        self.assertEqual({"objectkey_3": jobs[1], "objectkey_7": jobs[0]}, result)
+        database.single_query.assert_called_once()
+        self.assertEqual((["objectkey_3", "objectkey_7", "objectkey_99"],),
+                         database.single_query.call_args[0][2])
+
+        self.assertEqual({}, requests_db.get_active_jobs_by_object_keys([]))
+        database.single_query.assert_called_once()
+
+    def test_job_cache(self):
+        """
+        Tests the job lookups are read through the job cache, that writes
+        invalidate it, and that reads in a session bypass it.
+        """
+        os.environ["DATABASE_JOB_CACHE_SIZE"] = "10"
+        requests_db.reset_job_cache()
+        mock_ssm_get_parameter(1)
+        _, job_11 = create_select_requests([REQUEST_ID11])
+        _, job_10 = create_select_requests([REQUEST_ID10])
+        database.single_query = Mock(side_effect=[job_11, [], job_11, job_10, []])
+        exp_job = result_to_json(job_11)
+
+        self.assertEqual(exp_job, requests_db.get_job_by_request_id(REQUEST_ID11))
+        self.assertEqual(exp_job, requests_db.get_job_by_request_id(REQUEST_ID11))
+        self.assertEqual(1, database.single_query.call_count)
+
+        session = Mock()
+        session.query = Mock(return_value=job_11)
+        self.assertEqual(exp_job, requests_db.get_job_by_request_id(REQUEST_ID11,
+                                                                    session=session))
+        session.query.assert_called_once()
+        self.assertEqual(1, database.single_query.call_count)
+
+        requests_db.update_request_status_for_job(REQUEST_ID11, "complete")
+        self.assertEqual(exp_job, requests_db.get_job_by_request_id(REQUEST_ID11))
+        self.assertEqual(3, database.single_query.call_count)
+
+        exp_active = {"objectkey_3": result_to_json(job_10)[0]}
+        self.assertEqual(exp_active, requests_db.get_active_jobs_by_object_keys(["objectkey_3"]))
+        self.assertEqual(exp_active, requests_db.get_active_jobs_by_object_keys(
+            ["objectkey_3", "objectkey_9"]))
+        self.assertEqual((["objectkey_9"],), database.single_query.call_args[0][2])
+        self.assertEqual({"hits": 2, "misses": 4, "expired": 0, "evicted": 0,
+                          "invalidated": 1, "size": 2}, requests_db.get_job_cache_stats())
+
+        os.environ.pop("DATABASE_JOB_CACHE_SIZE")
+        requests_db.reset_job_cache()
+        self.assertIsNone(requests_db.get_job_cache_stats())
+
     def test_get_jobs_by_status(self):
         """
         Tests reading by status
@@ -327,6 +419,171 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         database.single_query.assert_called()
 
 
+    def test_iter_jobs_by_status(self):
+        """
+        Tests streaming rows by status
+        """
+        exp_request_ids = [REQUEST_ID1, REQUEST_ID2, REQUEST_ID3]
+        _, exp_result = create_select_requests(exp_request_ids)
+        mock_ssm_get_parameter(1)
+        database.stream_query = Mock(return_value=iter(exp_result))
+        result = requests_db.iter_jobs_by_status("complete", 5, itersize=100)
+        database.stream_query.assert_not_called()
+        self.assertEqual(result_to_json(exp_result), list(result))
+        database.stream_query.assert_called_once()
+        args = database.stream_query.call_args[0]
+        self.assertEqual(("complete", 5), args[2])
+        self.assertEqual(100, args[3])
+
+    def test_iter_jobs_by_status_exceptions(self):
+        """
+        Tests a missing status and a db error streaming rows by status
+        """
+        exp_msg = "A status must be provided"
+        try:
+            requests_db.iter_jobs_by_status(None)
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual(exp_msg, str(err))
+
+        exp_msg = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        mock_ssm_get_parameter(1)
+        database.stream_query = Mock(side_effect=[DbError(exp_msg)])
+        try:
+            list(requests_db.iter_all_requests())
+            self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertEqual(exp_msg, str(err))
+
+    def test_watch_status_changes(self):
+        """
+        Tests rereading the missed changes, then yielding the notified ones,
+        once each, whatever the time zone and format of their times, and
+        reconnecting when the connection is lost
+        """
+        changed_at = datetime.datetime(2019, 9, 30, 18, 24, 38, 370252,
+                                       tzinfo=datetime.timezone.utc)
+        def change(request_id, request_group_id, job_status, secs):
+            return {"request_id": request_id, "request_group_id": request_group_id,
+                    "job_status": job_status,
+                    "last_update_time": str(changed_at + datetime.timedelta(seconds=secs))}
+        def payloads(*items):
+            for item in items:
+                if isinstance(item, Exception):
+                    raise item
+                yield item if item is None else json.dumps(dict(
+                    item, last_update_time=item["last_update_time"].replace(
+                        " ", "T").replace("+00:00", "Z")))
+
+        missed = change(REQUEST_ID1, REQUEST_GROUP_ID_EXP_1, "complete", 0)
+        notified = change(REQUEST_ID2, REQUEST_GROUP_ID_EXP_1, "error", 1)
+        after_reconnect = change(REQUEST_ID3, REQUEST_GROUP_ID_EXP_1, "complete", 2)
+        database.stream_query = Mock(side_effect=[
+            iter([dict(missed, last_update_time=changed_at.astimezone(
+                datetime.timezone(datetime.timedelta(hours=2))))]), iter([])])
+        database.listen = Mock(side_effect=[
+            payloads(missed, change(REQUEST_ID4, REQUEST_GROUP_ID_EXP_2, "complete", 1),
+                     None, notified, DbError("server closed the connection", retryable=True)),
+            payloads(notified, after_reconnect)])
+        mock_ssm_get_parameter(1)
+        result = requests_db.watch_status_changes(REQUEST_GROUP_ID_EXP_1.upper(),
+                                                  since="2019-09-30T18:00:00Z")
+        self.assertEqual([missed, notified, after_reconnect],
+                         list(itertools.islice(result, 3)))
+        self.assertEqual(2, database.listen.call_count)
+        self.assertEqual("request_status", database.listen.call_args[0][0])
+        sql, _, params = database.stream_query.call_args_list[0][0]
+        self.assertIn("request_group_id = ANY(%s::uuid[])", sql)
+        self.assertEqual(("2019-09-30T18:00:00+00:00", [REQUEST_GROUP_ID_EXP_1]), params)
+        params = database.stream_query.call_args_list[1][0][2]
+        self.assertEqual(str(changed_at + datetime.timedelta(seconds=1) -
+                             datetime.timedelta(seconds=60)).replace(" ", "T"), params[0])
+
+    def test_watch_status_changes_exceptions(self):
+        """
+        Tests watching with bad input, an error that is not retried, and a timeout
+        """
+        for kwargs in [{"request_group_ids": ["not a uuid"]}, {"since": "last week"},
+                       {"timeout_secs": "soon"}]:
+            with self.assertRaises(requests_db.BadRequestError):
+                requests_db.watch_status_changes(**kwargs)
+
+        database.listen = Mock(side_effect=DbError("password authentication failed"))
+        mock_ssm_get_parameter(1)
+        with self.assertRaises(requests_db.DatabaseError):
+            list(requests_db.watch_status_changes())
+        database.listen.assert_called_once()
+
+        database.listen = Mock(return_value=iter([None] * 10))
+        mock_ssm_get_parameter(1)
+        self.assertEqual([], list(requests_db.watch_status_changes(timeout_secs=0)))
+        database.listen.assert_not_called()
+        with requests_db.deadline(secs=0.5):
+            self.assertEqual([], list(requests_db.watch_status_changes(poll_secs=1)))
+        database.listen.assert_not_called()
+
+    def test_read_replica(self):
+        """
+        Tests that the read-only functions query the read replica unless told
+        to use the primary or given a session, and that writes use the primary
+        """
+        os.environ["DATABASE_READER_HOST"] = "my.reader.host.gov"
+        _, exp_result = create_select_requests([REQUEST_ID1])
+        mock_ssm_get_parameter(1)
+        database.single_query = Mock(return_value=exp_result)
+        requests_db.get_all_requests()
+        self.assertEqual("my.reader.host.gov", database.single_query.call_args[0][1]["db_host"])
+        requests_db.get_jobs_by_status("complete")
+        self.assertEqual("my.reader.host.gov", database.single_query.call_args[0][1]["db_host"])
+        requests_db.get_jobs_by_granule_id("granule_1", use_primary=True)
+        self.assertEqual("my.db.host.gov", database.single_query.call_args[0][1]["db_host"])
+        requests_db.delete_request(REQUEST_ID1)
+        self.assertEqual("my.db.host.gov", database.single_query.call_args[0][1]["db_host"])
+
+        session = Mock()
+        session.query = Mock(return_value=exp_result)
+        database.single_query.reset_mock()
+        requests_db.get_job_by_request_id(REQUEST_ID1, session=session)
+        session.query.assert_called_once()
+        database.single_query.assert_not_called()
+
+        database.stream_query = Mock(return_value=iter(exp_result))
+        list(requests_db.iter_jobs_by_status("complete"))
+        self.assertEqual("my.reader.host.gov", database.stream_query.call_args[0][1]["db_host"])
+
+        async_database.single_query = AsyncMock(return_value=exp_result)
+        asyncio.run(requests_db.get_jobs_by_object_key_async("objectkey_1"))
+        self.assertEqual("my.reader.host.gov",
+                         async_database.single_query.call_args[0][1]["db_host"])
+        asyncio.run(requests_db.get_jobs_by_object_key_async("objectkey_1", use_primary=True))
+        self.assertEqual("my.db.host.gov", async_database.single_query.call_args[0][1]["db_host"])
+
+        del os.environ["DATABASE_READER_HOST"]
+        requests_db.get_all_requests()
+        self.assertEqual("my.db.host.gov", database.single_query.call_args[0][1]["db_host"])
+
+    def test_deadline(self):
+        """
+        Tests the deadline from a lambda context and a query that runs into it
+        """
+        context = Mock()
+        context.get_remaining_time_in_millis = Mock(return_value=60000)
+        with requests_db.deadline(context):
+            self.assertAlmostEqual(57, database.remaining_secs(), delta=1)
+            with requests_db.deadline(secs=10):
+                self.assertAlmostEqual(10, database.remaining_secs(), delta=1)
+        self.assertIsNone(database.remaining_secs())
+
+        mock_ssm_get_parameter(1)
+        exp_err = "Database Error. canceling statement due to statement timeout"
+        database.single_query = Mock(side_effect=[database.QueryTimeout(exp_err)])
+        try:
+            requests_db.get_all_requests()
+            self.fail("expected DatabaseTimeout")
+        except requests_db.DatabaseTimeout as err:
+            self.assertIsInstance(err, requests_db.DatabaseError)
+            self.assertEqual(exp_err, str(err))
+
     def test_get_utc_now_iso(self):
         """
         Tests the get_utc_now_iso function
@@ -532,6 +789,465 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
             self.assertEqual(exp_msg, str(err))
 
 
+    def test_submit_requests(self):
+        """
+        Tests that many jobs are written to the db in one query
+        """
+        utc_now_exp = UTC_NOW_EXP_1
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        data_list = []
+        for request_id, key in [(REQUEST_ID1, "objectkey_1"), (REQUEST_ID2, "objectkey_2")]:
+            data = {}
+            data["request_id"] = request_id
+            data["request_group_id"] = REQUEST_GROUP_ID_EXP_1
+            data["granule_id"] = "granule_1"
+            data["object_key"] = key
+            data["job_type"] = "restore"
+            data["job_status"] = "inprogress"
+            data_list.append(data)
+        exp_rows = [{"request_id": REQUEST_ID1}, {"request_id": REQUEST_ID2}]
+        database.values_query = Mock(side_effect=[exp_rows])
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.submit_requests(data_list)
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_requests. {str(err)}")
+        self.assertEqual([REQUEST_ID1, REQUEST_ID2], result)
+        database.values_query.assert_called_once()
+        params_list = database.values_query.call_args[0][2]
+        self.assertEqual(2, len(params_list))
+        self.assertEqual((REQUEST_ID2, REQUEST_GROUP_ID_EXP_1, "granule_1", "objectkey_2",
+                          "restore", None, None, "inprogress", utc_now_exp, utc_now_exp,
+                          None), params_list[1])
+
+    def test_submit_request_returning(self):
+        """
+        Tests that a job is written, and returned as written, by one statement
+        """
+        utc_now_exp = UTC_NOW_EXP_1
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        data = {"request_id": REQUEST_ID1, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                "granule_id": "granule_1", "object_key": "objectkey_1",
+                "job_type": "restore", "job_status": "inprogress"}
+        _, exp_rows = create_insert_request(REQUEST_ID1, REQUEST_GROUP_ID_EXP_1, "granule_1",
+                                            "objectkey_1", "restore", None, None, "inprogress",
+                                            utc_now_exp, utc_now_exp, None)
+        database.single_query = Mock(side_effect=[exp_rows, []])
+        mock_ssm_get_parameter(2)
+        try:
+            result = requests_db.submit_request_returning(data)
+            self.assertEqual(result_to_json(exp_rows), result)
+            sql = database.single_query.call_args[0][0]
+            self.assertIn("RETURNING " + ", ".join(requests_db.REQUEST_COLUMNS), sql)
+            self.assertEqual("request_status_insert_returning",
+                             database.single_query.call_args[1]["prepare_as"])
+
+            self.assertEqual([], requests_db.submit_request_returning(data, on_conflict="skip"))
+            self.assertEqual("request_status_insert_skip_returning",
+                             database.single_query.call_args[1]["prepare_as"])
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_request_returning. {str(err)}")
+        self.assertEqual(2, database.single_query.call_count)
+
+    def test_submit_requests_returning(self):
+        """
+        Tests that many jobs are written, and returned as written, by one statement
+        """
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "job_status": "inprogress"}
+                     for request_id, key in [(REQUEST_ID1, "objectkey_1"),
+                                             (REQUEST_ID2, "objectkey_2")]]
+        _, exp_rows = create_select_requests([REQUEST_ID1, REQUEST_ID2])
+        database.values_query = Mock(side_effect=[exp_rows])
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.submit_requests_returning(data_list, on_conflict="update")
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_requests_returning. {str(err)}")
+        self.assertEqual(result_to_json(exp_rows), result)
+        database.values_query.assert_called_once()
+        sql = database.values_query.call_args[0][0]
+        self.assertIn("DO UPDATE SET", sql)
+        self.assertIn("RETURNING " + ", ".join(requests_db.REQUEST_COLUMNS), sql)
+
+    def test_load_requests(self):
+        """
+        Tests that jobs are copied to a staging table and merged
+        """
+        utc_now_exp = UTC_NOW_EXP_1
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "job_status": "inprogress"}
+                     for request_id, key in [(REQUEST_ID1, "objectkey_1"),
+                                             (REQUEST_ID2, "objectkey_2")]]
+        cursor = Mock()
+        copied = []
+        database.transaction = Mock(return_value=contextlib.nullcontext(cursor))
+        database.copy_rows = Mock(side_effect=lambda table, columns, rows, cursor:
+                                  len(copied.extend(rows) or copied))
+        database.multi_query = Mock(side_effect=[[], [], [{"inserted": 1, "updated": 1}]])
+        mock_ssm_get_parameter(1)
+        result = requests_db.load_requests(iter(data_list), on_conflict="update")
+        self.assertEqual({"loaded": 2, "inserted": 1, "updated": 1}, result)
+        self.assertEqual("request_status_load", database.copy_rows.call_args[0][0])
+        self.assertEqual(requests_db.REQUEST_COLUMNS, database.copy_rows.call_args[0][1])
+        self.assertEqual((REQUEST_ID2, REQUEST_GROUP_ID_EXP_1, "granule_1", "objectkey_2",
+                          "restore", None, None, "inprogress", utc_now_exp, utc_now_exp,
+                          None), copied[1])
+        sql = database.multi_query.call_args[0][0]
+        self.assertIn("UPDATE request_status", sql)
+        # a row for the request_group_id and object_key of a job updates that job
+        self.assertIn("by_key.object_key = staged.object_key", sql)
+        self.assertIn("ON CONFLICT DO NOTHING", sql)
+
+    def test_load_requests_exceptions(self):
+        """
+        Tests loading bad input
+        """
+        try:
+            requests_db.load_requests([], on_conflict="replace")
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("on_conflict must be 'skip' or 'update', not 'replace'", str(err))
+
+        database.transaction = Mock(return_value=contextlib.nullcontext(Mock()))
+        database.copy_rows = Mock(side_effect=lambda table, columns, rows, cursor: list(rows))
+        database.multi_query = Mock(return_value=[])
+        mock_ssm_get_parameter(1)
+        try:
+            requests_db.load_requests([{"request_id": REQUEST_ID1}])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("Missing 'request_group_id' in input data", str(err))
+
+        try:
+            requests_db.load_requests_file("requests.xml")
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("Unknown file format for requests.xml, expected .jsonl or .csv",
+                             str(err))
+
+    def test_purge_requests(self):
+        """
+        Tests purging old jobs in batches, archiving them first
+        """
+        _, batch_1 = create_select_requests([REQUEST_ID11, REQUEST_ID10])
+        _, batch_2 = create_select_requests([REQUEST_ID9])
+        exp_after = max((row["last_update_time"], str(row["request_id"])) for row in batch_1)
+        database.transaction = Mock(side_effect=lambda dbconnect_info:
+                                    contextlib.nullcontext(Mock()))
+        database.multi_query = Mock(side_effect=[batch_1, batch_2, []])
+        mock_ssm_get_parameter(3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, "purged.jsonl.gz")
+            result = requests_db.purge_requests(30, batch_size=2, archive_path=archive_path)
+            with gzip.open(archive_path, "rt") as archive:
+                archived = [json.loads(line) for line in archive]
+        self.assertEqual(3, result["deleted"])
+        self.assertEqual(2, result["batches"])
+        self.assertTrue(result["finished"])
+        self.assertEqual(result_to_json(batch_1 + batch_2), archived)
+        self.assertEqual(3, database.transaction.call_count)
+        calls = database.multi_query.call_args_list
+        self.assertEqual("complete", calls[0][0][1][0])
+        self.assertEqual(4, len(calls[0][0][1]))
+        self.assertEqual(6, len(calls[1][0][1]))
+        self.assertEqual(exp_after, calls[1][0][1][3:5])
+        self.assertEqual("error", calls[2][0][1][0])
+        self.assertIn("FOR UPDATE SKIP LOCKED", calls[0][0][0])
+
+        database.multi_query = Mock(side_effect=[batch_1])
+        with requests_db.deadline(secs=0):
+            result = requests_db.purge_requests(30, batch_size=2)
+        self.assertEqual(0, result["deleted"])
+        self.assertFalse(result["finished"])
+        database.multi_query.assert_not_called()
+
+    def test_purge_requests_exceptions(self):
+        """
+        Tests purging with bad input, and a database error
+        """
+        for args in [(30, ["inprogress"]), (30, []), ("a month", ["error"]),
+                     (-1, ["error"]), (30, ["error"], 0)]:
+            with self.assertRaises(requests_db.BadRequestError):
+                requests_db.purge_requests(*args)
+
+        database.transaction = Mock(return_value=contextlib.nullcontext(Mock()))
+        database.multi_query = Mock(side_effect=DbError("mock insert failed error"))
+        mock_ssm_get_parameter(1)
+        with self.assertRaises(requests_db.DatabaseError):
+            requests_db.purge_requests(30)
+
+    def test_export_requests(self):
+        """
+        Tests exporting requests as gzipped JSONL and CSV
+        """
+        _, exp_result = create_select_requests([REQUEST_ID1, REQUEST_ID2])
+        database.stream_query = Mock(return_value=iter(exp_result))
+        mock_ssm_get_parameter(2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "requests.jsonl.gz")
+            result = requests_db.export_requests(path, statuses=["complete", "error"],
+                                                 start_time="2019-07-01", itersize=500)
+            with gzip.open(path, "rt") as export:
+                exported = [json.loads(line) for line in export]
+        self.assertEqual(2, result["rows"])
+        self.assertEqual(result_to_json(exp_result), exported)
+        sql, _, params, itersize = database.stream_query.call_args[0]
+        self.assertIn("WHERE job_status = ANY(%s) AND request_time >= %s", sql)
+        self.assertNotIn("ORDER BY", sql)
+        self.assertEqual((["complete", "error"], "2019-07-01T00:00:00"), params)
+        self.assertEqual(500, itersize)
+
+        database.copy_query = Mock(side_effect=lambda sql, dbconnect_info, out, params:
+                                   out.write("request_id\n1\n2\n") and 2)
+        upload = io.BytesIO()
+        result = requests_db.export_requests(upload, "csv", end_time="2019-08-01")
+        self.assertEqual(2, result["rows"])
+        self.assertFalse(upload.closed)
+        self.assertEqual(b"request_id\n1\n2\n", gzip.decompress(upload.getvalue()))
+        sql, _, _, params = database.copy_query.call_args[0]
+        self.assertIn("WHERE request_time < %s", sql)
+        self.assertEqual(("2019-08-01T00:00:00",), params)
+
+    def test_export_requests_exceptions(self):
+        """
+        Tests exporting with bad input, and a database error
+        """
+        for args, kwargs in [(("requests.xml",), {}), ((io.BytesIO(),), {}),
+                             (("requests.csv",), {"statuses": ["done"]}),
+                             (("requests.csv",), {"start_time": "last week"})]:
+            with self.assertRaises(requests_db.BadRequestError):
+                requests_db.export_requests(*args, **kwargs)
+
+        database.copy_query = Mock(side_effect=DbError("mock copy failed error"))
+        mock_ssm_get_parameter(1)
+        with self.assertRaises(requests_db.DatabaseError):
+            requests_db.export_requests(io.BytesIO(), "csv")
+
+    def test_maintain_partitions(self):
+        """
+        Tests making the partitions of the coming months and removing the
+        expired ones, skipping one with an inprogress job
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        this_month = datetime.datetime(now.year, now.month, 1, tzinfo=datetime.timezone.utc)
+        months = [(this_month - datetime.timedelta(days=days)).strftime("%Y%m")
+                  for days in (400, 800)]
+        next_month = (this_month + datetime.timedelta(days=40)).strftime("%Y%m")
+        partitions = ["request_status_default", f"request_status_p{this_month:%Y%m}",
+                      f"request_status_p{months[0]}", f"request_status_p{months[1]}"]
+        database.single_query = Mock(return_value=[{"partitioned": True,
+                                                    "partitions": partitions}])
+        database.transaction = Mock(side_effect=lambda dbconnect_info:
+                                    contextlib.nullcontext(Mock()))
+        database.multi_batch_query = Mock(side_effect=[
+            [None, [{"created": True}]],                 # create next month
+            [None, [{"removed": False}]],                # keep the older month
+            [None, [{"removed": True}]]])                # drop the newer one
+        mock_ssm_get_parameter(4)
+        result = requests_db.maintain_partitions(months_ahead=1, retain_months=12)
+        self.assertEqual({"partitioned": True, "created": [f"request_status_p{next_month}"],
+                          "dropped": [f"request_status_p{months[0]}"], "detached": [],
+                          "skipped": [f"request_status_p{months[1]}"]}, result)
+        # the partitions are made and removed by functions that run as their owner, in
+        # the round trip that sets the lock_timeout
+        (timeout_sql, _), (sql, params) = database.multi_batch_query.call_args_list[0][0][0]
+        self.assertIn("SET LOCAL lock_timeout", timeout_sql)
+        self.assertIn("create_request_status_partition(%s)", sql)
+        self.assertEqual(f"{next_month}", f"{params[0]:%Y%m}")
+        _, (sql, params) = database.multi_batch_query.call_args[0][0]
+        self.assertIn("remove_request_status_partition(%s, %s)", sql)
+        self.assertEqual((f"request_status_p{months[0]}", False), params)
+
+        database.single_query = Mock(return_value=[{"partitioned": False, "partitions": []}])
+        self.assertFalse(requests_db.maintain_partitions()["partitioned"])
+        for kwargs in [{"months_ahead": -1}, {"retain_months": 0}, {"months_ahead": "3"}]:
+            with self.assertRaises(requests_db.BadRequestError):
+                requests_db.maintain_partitions(**kwargs)
+
+    def test_submit_requests_update(self):
+        """
+        Tests that jobs already recorded for their request_group_id and
+        object_key are updated, once each
+        """
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "job_status": status}
+                     for request_id, key, status in [(REQUEST_ID1, "objectkey_1", "inprogress"),
+                                                     (REQUEST_ID2, "objectkey_2", "inprogress"),
+                                                     (REQUEST_ID3, "objectkey_1", "error")]]
+        database.values_query = Mock(side_effect=[[{"request_id": REQUEST_ID4},
+                                                   {"request_id": REQUEST_ID2}]])
+        mock_ssm_get_parameter(1)
+        result = requests_db.submit_requests(data_list, on_conflict="update")
+        self.assertEqual([REQUEST_ID4, REQUEST_ID2], result)
+        sql, _, params_list = database.values_query.call_args[0]
+        self.assertIn("ON CONFLICT ON CONSTRAINT uq_reqstat_reqgidkey DO UPDATE", sql)
+        # request_status isn't partitioned, so the jobs are inserted as they are
+        self.assertIn(") VALUES %s", sql)
+        self.assertNotIn("LATERAL", sql)
+        self.assertEqual([REQUEST_ID3, REQUEST_ID2], [params[0] for params in params_list])
+
+        try:
+            requests_db.submit_requests(data_list, on_conflict="replace")
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("on_conflict must be 'skip' or 'update', not 'replace'", str(err))
+        database.values_query.assert_called_once()
+
+    def test_submit_requests_partitioned(self):
+        """
+        Tests that when request_status is partitioned the jobs are locked, in
+        order of their keys, before they are inserted with the request_time
+        of the existing job, in the same transaction
+        """
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "job_status": "inprogress"}
+                     for request_id, key in [(REQUEST_ID1, "objectkey_2"),
+                                             (REQUEST_ID2, "objectkey_1")]]
+        os.environ["PARTITION_REQUEST_STATUS"] = "True"
+        cursor = Mock()
+        database.transaction = Mock(return_value=contextlib.nullcontext(cursor))
+        database.multi_query = Mock(return_value=[{"pg_advisory_xact_lock": ""}])
+        database.multi_values_query = Mock(return_value=[{"request_id": REQUEST_ID1},
+                                                         {"request_id": REQUEST_ID2}])
+        database.values_query = Mock()
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.submit_requests(data_list, on_conflict="skip")
+        finally:
+            del os.environ["PARTITION_REQUEST_STATUS"]
+        self.assertEqual([REQUEST_ID1, REQUEST_ID2], result)
+        database.transaction.assert_called_once()
+        database.values_query.assert_not_called()
+        lock_sql, lock_params, lock_cursor, _ = database.multi_query.call_args[0]
+        self.assertIn("pg_advisory_xact_lock", lock_sql)
+        self.assertIn("ORDER BY job_key", lock_sql)
+        self.assertEqual(([REQUEST_GROUP_ID_EXP_1, REQUEST_GROUP_ID_EXP_1],
+                          ["objectkey_2", "objectkey_1"]), lock_params)
+        sql, params_list, values_cursor = database.multi_values_query.call_args[0]
+        self.assertIn("coalesce(existing.request_time,", sql)
+        self.assertEqual([REQUEST_ID1, REQUEST_ID2], [params[0] for params in params_list])
+        self.assertIs(cursor, lock_cursor)
+        self.assertIs(cursor, values_cursor)
+
+    def test_submit_requests_empty(self):
+        """
+        Tests that no query is made when there are no jobs
+        """
+        database.values_query = Mock()
+        self.assertEqual([], requests_db.submit_requests([]))
+        database.values_query.assert_not_called()
+
+    def test_submit_requests_missing_key(self):
+        """
+        Tests that nothing is written when any of the jobs is invalid
+        """
+        data_list = [{"request_id": REQUEST_ID1, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": "objectkey_1",
+                      "job_type": "restore", "job_status": "inprogress"},
+                     {"request_id": REQUEST_ID2, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "object_key": "objectkey_2", "job_type": "restore",
+                      "job_status": "inprogress"}]
+        database.values_query = Mock()
+        try:
+            requests_db.submit_requests(data_list)
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("Missing 'granule_id' in input data", str(err))
+        database.values_query.assert_not_called()
+
+    def test_submit_requests_dberror(self):
+        """
+        Tests a db error writing many jobs
+        """
+        data_list = [{"request_id": REQUEST_ID1, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": "objectkey_1",
+                      "job_type": "restore", "job_status": "inprogress"}]
+        exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        database.values_query = Mock(side_effect=[DbError(exp_err)])
+        mock_ssm_get_parameter(1)
+        try:
+            requests_db.submit_requests(data_list)
+            self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertEqual(exp_err, str(err))
+
+    def test_submit_requests_duplicate(self):
+        """
+        Tests writing a job that is already there for its natural key
+        """
+        data_list = [{"request_id": REQUEST_ID1, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": "objectkey_1",
+                      "job_type": "restore", "job_status": "inprogress"}]
+        db_err = ('Database Error. duplicate key value violates unique constraint '
+                  '"uq_reqstat_reqgidkey"\nDETAIL:  Key (request_group_id, object_key)='
+                  f'({REQUEST_GROUP_ID_EXP_1}, objectkey_1) already exists.')
+        database.values_query = Mock(side_effect=[DbError(db_err)])
+        database.single_query = Mock(side_effect=[DbError(db_err)])
+        mock_ssm_get_parameter(2)
+        exp_err = ("A job for this request_group_id and object_key already exists, "
+                   "submit it with on_conflict 'skip' or 'update'")
+        try:
+            requests_db.submit_requests(data_list)
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual(exp_err, str(err))
+        try:
+            requests_db.submit_request(data_list[0])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual(exp_err, str(err))
+
+    def test_submit_requests_async(self):
+        """
+        Tests writing many jobs in one insert from an event loop
+        """
+        data_list = [{"request_id": REQUEST_ID1, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": "objectkey_1",
+                      "job_type": "restore", "job_status": "inprogress"}]
+        async_database.values_query = AsyncMock(return_value=[{"request_id": REQUEST_ID1}])
+        mock_ssm_get_parameter(1)
+        result = asyncio.run(requests_db.submit_requests_async(data_list))
+        self.assertEqual([REQUEST_ID1], result)
+        async_database.values_query.assert_awaited_once()
+
+        exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        async_database.values_query = AsyncMock(side_effect=[DbError(exp_err)])
+        try:
+            asyncio.run(requests_db.submit_requests_async(data_list))
+            self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertEqual(exp_err, str(err))
+
+    def test_get_jobs_by_object_key_async(self):
+        """
+        Tests reading by object_key from an event loop
+        """
+        exp_request_ids = [REQUEST_ID1, REQUEST_ID2]
+        _, exp_result = create_select_requests(exp_request_ids)
+        async_database.single_query = AsyncMock(return_value=exp_result)
+        mock_ssm_get_parameter(1)
+        result = asyncio.run(requests_db.get_jobs_by_object_key_async("objectkey_1"))
+        self.assertEqual(result_to_json(exp_result), result)
+        self.assertEqual(("objectkey_1",), async_database.single_query.call_args[0][2])
+
+    def test_update_request_status_for_jobs_async(self):
+        """
+        Tests updating many jobs from an event loop
+        """
+        async_database.single_query = AsyncMock(return_value=[{"request_id": REQUEST_ID3}])
+        mock_ssm_get_parameter(1)
+        result = asyncio.run(requests_db.update_request_status_for_jobs_async(
+            [(REQUEST_ID3, "complete"), (REQUEST_ID4, "error", "oops")]))
+        self.assertEqual({REQUEST_ID3: True, REQUEST_ID4: False}, result)
+        self.assertEqual({}, asyncio.run(requests_db.update_request_status_for_jobs_async([])))
+        async_database.single_query.assert_awaited_once()
+
     def test_update_request_status_for_job(self):
         """
         Tests updating a job to an 'inprogress' status
@@ -582,6 +1298,173 @@ class TestRequests(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
             self.assertEqual(exp_err, str(err))
             database.single_query.assert_called_once()
 
+    def test_transaction(self):
+        """
+        Tests that functions given a session run in its transaction
+        """
+        utc_now_exp = "2019-07-31 21:07:15.234362+00:00"
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        cursor = Mock()
+        database.transaction = Mock(return_value=contextlib.nullcontext(cursor))
+        database.single_query = Mock()
+        exp_job = {"request_id": REQUEST_ID3, "job_status": "inprogress"}
+        database.multi_query = Mock(side_effect=[[exp_job], []])
+        mock_ssm_get_parameter(1)
+        with requests_db.transaction() as session:
+            job = requests_db.get_job_by_request_id(REQUEST_ID3, session=session)
+            requests_db.update_request_status_for_job(REQUEST_ID3, "complete",
+                                                      session=session)
+        self.assertEqual([exp_job], job)
+        self.assertEqual(2, database.multi_query.call_count)
+        database.multi_query.assert_called_with(
+            database.multi_query.call_args[0][0],
+            ("complete", utc_now_exp, None, REQUEST_ID3), cursor, "request_status_update_status")
+        database.single_query.assert_not_called()
+        database.transaction.assert_called_once()
+
+    def test_transaction_exceptions(self):
+        """
+        Tests that errors inside a session keep their type, and that a failed
+        connection raises DatabaseError
+        """
+        database.transaction = Mock(return_value=contextlib.nullcontext(Mock()))
+        mock_ssm_get_parameter(1)
+        try:
+            with requests_db.transaction() as session:
+                requests_db.update_request_status_for_job(REQUEST_ID3, None, session=session)
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual("A new status must be provided", str(err))
+
+        exp_err = "Database Error. could not connect to server"
+        database.transaction = Mock(side_effect=DbError(exp_err))
+        try:
+            with requests_db.transaction():
+                self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertEqual(exp_err, str(err))
+
+    def test_update_request_status_for_jobs(self):
+        """
+        Tests updating many jobs in one statement
+        """
+        utc_now_exp = "2019-07-31 21:07:15.234362+00:00"
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        updates = [(REQUEST_ID3, "complete"), (REQUEST_ID4, "error", "copy failed"),
+                   (REQUEST_ID5, "complete"), (REQUEST_ID3, "error", "retried")]
+        database.single_query = Mock(side_effect=[[{"request_id": REQUEST_ID3},
+                                                   {"request_id": REQUEST_ID4}]])
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.update_request_status_for_jobs(updates)
+        except requests_db.DatabaseError as err:
+            self.fail(f"update_request_status_for_jobs. {str(err)}")
+        self.assertEqual({REQUEST_ID3: True, REQUEST_ID4: True, REQUEST_ID5: False}, result)
+        database.single_query.assert_called_once()
+        params = database.single_query.call_args[0][2]
+        self.assertEqual((utc_now_exp, [REQUEST_ID3, REQUEST_ID4, REQUEST_ID5],
+                          ["error", "error", "complete"], ["retried", "copy failed", None]),
+                         params)
+
+    def test_update_request_status_for_jobs_uuid(self):
+        """
+        Tests that jobs given by UUID request_ids are found to be updated
+        """
+        updates = [(uuid.UUID(REQUEST_ID3), "complete"), (uuid.UUID(REQUEST_ID4), "error"),
+                   (REQUEST_ID3, "error", "retried")]
+        database.single_query = Mock(return_value=[{"request_id": REQUEST_ID3}])
+        mock_ssm_get_parameter(1)
+        result = requests_db.update_request_status_for_jobs(updates)
+        self.assertEqual({REQUEST_ID3: True, uuid.UUID(REQUEST_ID4): False}, result)
+        # the request_ids are sent as strings, and a job is updated once
+        params = database.single_query.call_args[0][2]
+        self.assertEqual([REQUEST_ID3, REQUEST_ID4], params[1])
+        self.assertEqual(["error", "error"], params[2])
+
+    def test_update_request_status_for_job_returning(self):
+        """
+        Tests that a job is updated, and returned as updated, by one statement
+        """
+        utc_now_exp = UTC_NOW_EXP_4
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        _, exp_rows = create_insert_request(REQUEST_ID3, REQUEST_GROUP_ID_EXP_1, "granule_1",
+                                            "objectkey_3", "restore", None, None, "error",
+                                            UTC_NOW_EXP_1, utc_now_exp, "copy failed")
+        database.single_query = Mock(side_effect=[exp_rows, []])
+        mock_ssm_get_parameter(2)
+        try:
+            result = requests_db.update_request_status_for_job_returning(REQUEST_ID3, "error",
+                                                                          "copy failed")
+            self.assertEqual(result_to_json(exp_rows), result)
+            self.assertIn("RETURNING " + ", ".join(requests_db.REQUEST_COLUMNS),
+                          database.single_query.call_args[0][0])
+            self.assertEqual(("error", utc_now_exp, "copy failed", REQUEST_ID3),
+                             database.single_query.call_args[0][2])
+            self.assertEqual("request_status_update_status_returning",
+                             database.single_query.call_args[1]["prepare_as"])
+            self.assertEqual([], requests_db.update_request_status_for_job_returning(
+                REQUEST_ID6, "complete"))
+        except requests_db.DatabaseError as err:
+            self.fail(f"update_request_status_for_job_returning. {str(err)}")
+
+    def test_update_request_status_for_jobs_returning(self):
+        """
+        Tests that many jobs are updated, and returned as updated, by one statement
+        """
+        updates = [(REQUEST_ID10, "complete"), (REQUEST_ID11, "error", "copy failed")]
+        _, exp_rows = create_select_requests([REQUEST_ID10, REQUEST_ID11])
+        database.single_query = Mock(side_effect=[exp_rows])
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.update_request_status_for_jobs_returning(updates)
+        except requests_db.DatabaseError as err:
+            self.fail(f"update_request_status_for_jobs_returning. {str(err)}")
+        self.assertEqual(result_to_json(exp_rows), result)
+        database.single_query.assert_called_once()
+        self.assertIn("RETURNING\n            request_status.request_id, "
+                      "request_status.request_group_id",
+                      database.single_query.call_args[0][0])
+        self.assertEqual([], requests_db.update_request_status_for_jobs_returning([]))
+
+    def test_update_request_status_for_jobs_empty(self):
+        """
+        Tests that no statement is run when there is nothing to update
+        """
+        database.single_query = Mock()
+        self.assertEqual({}, requests_db.update_request_status_for_jobs([]))
+        database.single_query.assert_not_called()
+
+    def test_update_request_status_for_jobs_exceptions(self):
+        """
+        Tests a missing request_id or status, and a db error, updating many jobs
+        """
+        database.single_query = Mock()
+        exp_err = 'A new status must be provided'
+        try:
+            requests_db.update_request_status_for_jobs([(REQUEST_ID3, "complete"),
+                                                        (REQUEST_ID4, None)])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual(exp_err, str(err))
+
+        exp_err = 'No request_id provided'
+        try:
+            requests_db.update_request_status_for_jobs([(None, "complete")])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertEqual(exp_err, str(err))
+        database.single_query.assert_not_called()
+
+        exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        database.single_query = Mock(side_effect=[DbError(exp_err)])
+        mock_ssm_get_parameter(1)
+        try:
+            requests_db.update_request_status_for_jobs([(REQUEST_ID3, "complete")])
+            self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertEqual(exp_err, str(err))
+            database.single_query.assert_called_once()
+
 
     def test_update_request_status_complete(self):
         """
@@ -4,11 +4,17 @@ Name: test_requests_postgres.py
 Description:  Unit tests for requests_db.py that hit a postgres db running in docker.
 """
 
+import asyncio
+import gzip
+import json
 import os
+import tempfile
+import threading
 import unittest
 from unittest.mock import Mock
 import boto3
 
+import database
 import db_config
 import requests_db
 from requests_db import create_data, result_to_json
@@ -260,6 +266,429 @@ class TestRequestsPostgres(unittest.TestCase): #pylint: disable-msg=too-many-ins
             self.fail(f"get_job_by_request_id. {str(err)}")
 
 
+    def test_submit_requests(self):
+        """
+        Tests that many jobs are written to the db in one insert
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(2)
+        utc_now_exp = "2019-07-31 18:05:19.161362+00:00"
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        data_list = []
+        for request_id, key in [(REQUEST_ID1, "objectkey_1"), (REQUEST_ID2, "objectkey_2"),
+                                (REQUEST_ID3, "objectkey_3")]:
+            data = {}
+            data["request_id"] = request_id
+            data["request_group_id"] = REQUEST_GROUP_ID_EXP_1
+            data["granule_id"] = "granule_1"
+            data["object_key"] = key
+            data["job_type"] = "restore"
+            data["restore_bucket_dest"] = "my_s3_bucket"
+            data["archive_bucket_dest"] = PROTECTED_BUCKET
+            data["job_status"] = "inprogress"
+            data["request_time"] = utc_now_exp
+            data_list.append(data)
+        try:
+            result = requests_db.submit_requests(data_list)
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_requests. {str(err)}")
+        self.assertEqual([REQUEST_ID1, REQUEST_ID2, REQUEST_ID3], result)
+
+        result = requests_db.get_jobs_by_request_group_id(REQUEST_GROUP_ID_EXP_1)
+        self.assertEqual(3, len(result))
+        result = requests_db.get_job_by_request_id(REQUEST_ID2)
+        data_list[1]["last_update_time"] = utc_now_exp
+        self.assertEqual(data_list[1], result[0])
+
+        retry = dict(data_list[1], request_id=REQUEST_ID4, job_status="error",
+                     err_msg="oh oh, an error happened")
+        try:
+            requests_db.submit_requests([retry])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError:
+            pass
+        self.assertEqual([], requests_db.submit_requests([retry], on_conflict="skip"))
+        self.assertEqual([REQUEST_ID2], requests_db.submit_requests([retry],
+                                                                    on_conflict="update"))
+        # the job is now error, so a further retry leaves it as it is
+        self.assertIsNone(requests_db.submit_request(dict(retry, err_msg="again"),
+                                                     on_conflict="update"))
+        result = requests_db.get_jobs_by_request_group_id(REQUEST_GROUP_ID_EXP_1)
+        self.assertEqual(3, len(result))
+        result = requests_db.get_job_by_request_id(REQUEST_ID2)
+        self.assertEqual("error", result[0]["job_status"])
+        self.assertEqual("oh oh, an error happened", result[0]["err_msg"])
+
+    def test_load_requests(self):
+        """
+        Tests bulk loading jobs, skipping and then updating existing ones
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        utc_now_exp = "2019-07-31 18:05:19.161362+00:00"
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "restore_bucket_dest": "my_s3_bucket", "job_status": status,
+                      "request_time": utc_now_exp, "last_update_time": utc_now_exp}
+                     for request_id, key, status in [
+                         ("0000a0a0-a000-00a0-00a0-0000a0000097", "objectkey_97", "inprogress"),
+                         (REQUEST_ID4, "objectkey_4", "complete"),
+                         ("0000a0a0-a000-00a0-00a0-0000a0000098", "objectkey_98", "inprogress"),
+                         ("0000a0a0-a000-00a0-00a0-0000a0000098", "objectkey_98", "error")]]
+        try:
+            result = requests_db.load_requests(iter(data_list))
+            self.assertEqual({"loaded": 4, "inserted": 2, "updated": 0}, result)
+            self.assertEqual("inprogress", requests_db.get_job_by_request_id(
+                "0000a0a0-a000-00a0-00a0-0000a0000098")[0]["job_status"])
+            original = requests_db.get_job_by_request_id(REQUEST_ID4)[0]
+            self.assertEqual("error", original["job_status"])
+
+            result = requests_db.load_requests(data_list, on_conflict="update")
+            self.assertEqual({"loaded": 4, "inserted": 0, "updated": 3}, result)
+            self.assertEqual("error", requests_db.get_job_by_request_id(
+                "0000a0a0-a000-00a0-00a0-0000a0000098")[0]["job_status"])
+            row = requests_db.get_job_by_request_id(REQUEST_ID4)[0]
+            self.assertEqual("complete", row["job_status"])
+            self.assertEqual(utc_now_exp, row["request_time"])
+        except requests_db.DatabaseError as err:
+            self.fail(f"load_requests. {str(err)}")
+
+    def test_load_requests_natural_key(self):
+        """
+        Tests that a loaded job with the request_group_id and object_key of
+        an existing one is skipped or updates it, rather than failing the load
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(2)
+        utc_now_exp = "2019-07-31 18:05:19.161362+00:00"
+        existing = requests_db.get_job_by_request_id(REQUEST_ID4)[0]
+        data_list = [{"request_id": request_id, "request_group_id": group_id,
+                      "granule_id": "granule_1", "object_key": key, "job_type": "restore",
+                      "job_status": "complete", "request_time": utc_now_exp,
+                      "last_update_time": utc_now_exp}
+                     for request_id, group_id, key in [
+                         ("0000a0a0-a000-00a0-00a0-0000a0000099",
+                          existing["request_group_id"], existing["object_key"]),
+                         ("0000a0a0-a000-00a0-00a0-0000a0000097",
+                          REQUEST_GROUP_ID_EXP_1, "objectkey_97")]]
+        try:
+            result = requests_db.load_requests(data_list)
+            self.assertEqual({"loaded": 2, "inserted": 1, "updated": 0}, result)
+            self.assertEqual(existing, requests_db.get_job_by_request_id(REQUEST_ID4)[0])
+
+            result = requests_db.load_requests(data_list, on_conflict="update")
+            self.assertEqual({"loaded": 2, "inserted": 0, "updated": 2}, result)
+            row = requests_db.get_job_by_request_id(REQUEST_ID4)[0]
+            self.assertEqual("complete", row["job_status"])
+            self.assertEqual(existing["object_key"], row["object_key"])
+            self.assertEqual([], requests_db.get_job_by_request_id(
+                "0000a0a0-a000-00a0-00a0-0000a0000099"))
+        except requests_db.DatabaseError as err:
+            self.fail(f"load_requests. {str(err)}")
+
+        try:
+            requests_db.submit_request(data_list[0])
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertIn("already exists", str(err))
+
+    def test_load_requests_file(self):
+        """
+        Tests bulk loading jobs from JSONL and CSV files
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        utc_now_exp = "2019-07-31 18:05:19.161362+00:00"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            jsonl_path = os.path.join(tmp_dir, "requests.jsonl.gz")
+            with gzip.open(jsonl_path, "wt") as jsonl_file:
+                for request_id in [REQUEST_ID1, REQUEST_ID2]:
+                    jsonl_file.write(json.dumps({
+                        "request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                        "granule_id": "granule_1", "object_key": f"key_{request_id}",
+                        "job_type": "restore", "job_status": "inprogress",
+                        "request_time": utc_now_exp, "err_msg": None}) + "\n")
+            csv_path = os.path.join(tmp_dir, "requests.csv")
+            with open(csv_path, "w", newline="") as csv_file:
+                csv_file.write("request_id,request_group_id,granule_id,object_key,"
+                               "job_type,job_status,err_msg\n")
+                csv_file.write(f'{REQUEST_ID3},{REQUEST_GROUP_ID_EXP_2},granule_2,'
+                               f'"key, with a comma",restore,error,"oh ""no"""\n')
+            try:
+                self.assertEqual({"loaded": 2, "inserted": 2, "updated": 0},
+                                 requests_db.load_requests_file(jsonl_path))
+                self.assertEqual({"loaded": 1, "inserted": 1, "updated": 0},
+                                 requests_db.load_requests_file(csv_path))
+            except requests_db.DatabaseError as err:
+                self.fail(f"load_requests_file. {str(err)}")
+        row = requests_db.get_job_by_request_id(REQUEST_ID2)[0]
+        self.assertEqual(f"key_{REQUEST_ID2}", row["object_key"])
+        self.assertEqual(utc_now_exp, row["request_time"])
+        row = requests_db.get_job_by_request_id(REQUEST_ID3)[0]
+        self.assertEqual("key, with a comma", row["object_key"])
+        self.assertEqual('oh "no"', row["err_msg"])
+        self.assertEqual(None, row["archive_bucket_dest"])
+
+    def test_purge_requests(self):
+        """
+        Tests purging the old finished jobs in batches, and loading the
+        archive of them back in
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        old_time = "2019-07-31 18:05:19.161362+00:00"
+        new_time = requests_db.get_utc_now_iso()
+        data_list = [{"request_id": f"0000a0a0-a000-00a0-00a0-00000000009{idx}",
+                      "request_group_id": REQUEST_GROUP_ID_EXP_1, "granule_id": "granule_1",
+                      "object_key": f"objectkey_9{idx}", "job_type": "restore",
+                      "job_status": status, "request_time": when, "last_update_time": when}
+                     for idx, (status, when) in enumerate(
+                         [("complete", old_time)] * 5 + [("error", old_time),
+                                                         ("inprogress", old_time),
+                                                         ("complete", new_time)])]
+        requests_db.load_requests(data_list)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = os.path.join(tmp_dir, "purged.jsonl.gz")
+            try:
+                result = requests_db.purge_requests(30, batch_size=2,
+                                                    archive_path=archive_path)
+                self.assertEqual(6, result["deleted"])
+                self.assertEqual(4, result["batches"])
+                self.assertTrue(result["finished"])
+                self.assertEqual(["complete", "inprogress"],
+                                 [job["job_status"] for job in requests_db.get_all_requests()])
+
+                result = requests_db.load_requests_file(archive_path)
+                self.assertEqual({"loaded": 6, "inserted": 6, "updated": 0}, result)
+            except requests_db.DatabaseError as err:
+                self.fail(f"purge_requests. {str(err)}")
+        self.assertEqual(old_time, requests_db.get_job_by_request_id(
+            data_list[0]["request_id"])[0]["last_update_time"])
+
+    def test_export_requests(self):
+        """
+        Tests exporting jobs, filtered by status and request_time, as CSV and
+        JSONL, and loading the exports back in
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        data_list = [{"request_id": f"0000a0a0-a000-00a0-00a0-00000000009{idx}",
+                      "request_group_id": REQUEST_GROUP_ID_EXP_1, "granule_id": "granule_1",
+                      "object_key": f"objectkey_9{idx}", "job_type": "restore",
+                      "job_status": status, "request_time": when, "last_update_time": when}
+                     for idx, (status, when) in enumerate(
+                         [("complete", "2019-07-31 18:05:19.161362+00:00"),
+                          ("error", "2019-08-01 10:00:00.000000+00:00"),
+                          ("error", "2019-09-02 10:00:00.000000+00:00"),
+                          ("inprogress", "2019-08-15 10:00:00.000000+00:00")])]
+        requests_db.load_requests(data_list)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                for name in ["export.csv.gz", "export.jsonl"]:
+                    path = os.path.join(tmp_dir, name)
+                    result = requests_db.export_requests(
+                        path, statuses=["error", "inprogress"],
+                        start_time="2019-08-01T00:00:00+00:00",
+                        end_time="2019-09-01T00:00:00+00:00")
+                    self.assertEqual(2, result["rows"])
+                    requests_db.delete_all_requests()
+                    result = requests_db.load_requests_file(path)
+                    self.assertEqual({"loaded": 2, "inserted": 2, "updated": 0}, result)
+                    self.assertEqual(["inprogress", "error"],
+                                     [job["job_status"]
+                                      for job in requests_db.get_all_requests()])
+            except requests_db.DatabaseError as err:
+                self.fail(f"export_requests. {str(err)}")
+        # the times survive the round trip, read back without the zero microseconds
+        self.assertEqual("2019-08-01 10:00:00+00:00", requests_db.get_job_by_request_id(
+            data_list[1]["request_id"])[0]["request_time"])
+
+    def test_watch_status_changes(self):
+        """
+        Tests that a job_status update is heard from the NOTIFY of the trigger
+        on request_status, and that one made before the watch started is reread
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        old_time = "2019-07-31 18:05:19.161362+00:00"
+        request_ids = ["0000a0a0-a000-00a0-00a0-000000000081",
+                       "0000a0a0-a000-00a0-00a0-000000000082"]
+        requests_db.load_requests(
+            [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+              "granule_id": "granule_1", "object_key": f"objectkey_8{idx}",
+              "job_type": "restore", "job_status": "inprogress",
+              "request_time": old_time, "last_update_time": old_time}
+             for idx, request_id in enumerate(request_ids)])
+        since = requests_db.get_utc_now_iso()
+        requests_db.update_request_status_for_job(request_ids[0], "complete")
+        timer = threading.Timer(1, requests_db.update_request_status_for_job,
+                                (request_ids[1], "error", "oh no an error"))
+        watch = requests_db.watch_status_changes([REQUEST_GROUP_ID_EXP_1], since=since,
+                                                 timeout_secs=30)
+        try:
+            reread = next(watch)
+            timer.start()
+            notified = next(watch)
+        except requests_db.DatabaseError as err:
+            self.fail(f"watch_status_changes. {str(err)}")
+        finally:
+            timer.cancel()
+            watch.close()
+        self.assertEqual((request_ids[0], "complete"),
+                         (reread["request_id"], reread["job_status"]))
+        self.assertEqual((request_ids[1], "error", REQUEST_GROUP_ID_EXP_1),
+                         (notified["request_id"], notified["job_status"],
+                          notified["request_group_id"]))
+
+    def test_writes_returning(self):
+        """
+        Tests that the *_returning writes give back the rows as a read of them
+        afterwards does
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        request_ids = ["0000a0a0-a000-00a0-00a0-000000000071",
+                       "0000a0a0-a000-00a0-00a0-000000000072"]
+        data_list = [{"request_id": request_id, "request_group_id": REQUEST_GROUP_ID_EXP_1,
+                      "granule_id": "granule_1", "object_key": f"objectkey_7{idx}",
+                      "job_type": "restore", "job_status": "inprogress"}
+                     for idx, request_id in enumerate(request_ids)]
+        try:
+            inserted = requests_db.submit_request_returning(data_list[0])
+            self.assertEqual(requests_db.get_job_by_request_id(request_ids[0]), inserted)
+            inserted = requests_db.submit_requests_returning(data_list, on_conflict="skip")
+            self.assertEqual([request_ids[1]], [job["request_id"] for job in inserted])
+
+            updated = requests_db.update_request_status_for_job_returning(
+                request_ids[0], "error", "oh no an error")
+            self.assertEqual(requests_db.get_job_by_request_id(request_ids[0]), updated)
+            self.assertEqual("oh no an error", updated[0]["err_msg"])
+            updated = requests_db.update_request_status_for_jobs_returning(
+                [(request_id, "complete") for request_id in request_ids] +
+                [(REQUEST_ID12, "complete")])
+            self.assertEqual(sorted(request_ids),
+                             sorted(job["request_id"] for job in updated))
+            self.assertEqual({"complete"}, {job["job_status"] for job in updated})
+        except requests_db.DatabaseError as err:
+            self.fail(f"writes returning. {str(err)}")
+
+    def test_maintain_partitions(self):
+        """
+        Tests making the partitions of the coming months, when request_status
+        is partitioned, see db_deploy, and that a job retried in a later
+        month is still recorded once
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        try:
+            result = requests_db.maintain_partitions(months_ahead=2)
+            if not result["partitioned"]:
+                self.skipTest("request_status is not partitioned")
+            self.assertEqual([], requests_db.maintain_partitions(months_ahead=2)["created"])
+
+            data = create_data({"request_group_id": REQUEST_GROUP_ID_EXP_1,
+                                "granule_id": "granule_1", "key": "objectkey_1",
+                                "glacier_bucket": PROTECTED_BUCKET, "dest_bucket": None},
+                               "restore", "inprogress",
+                               "2019-07-31 18:05:19.161362+00:00",
+                               "2019-07-31 18:05:19.161362+00:00")
+            data["request_id"] = REQUEST_ID1
+            requests_db.submit_request(data, on_conflict="update")
+            data = dict(data, request_id=REQUEST_ID2, job_status="error", err_msg="oh no",
+                        request_time=requests_db.get_utc_now_iso(),
+                        last_update_time=requests_db.get_utc_now_iso())
+            self.assertEqual(REQUEST_ID1, requests_db.submit_request(data, on_conflict="update"))
+        except requests_db.DatabaseError as err:
+            self.fail(f"maintain_partitions. {str(err)}")
+        jobs = requests_db.get_jobs_by_request_group_id(REQUEST_GROUP_ID_EXP_1)
+        self.assertEqual(["error"], [job["job_status"] for job in jobs])
+
+    def test_submit_request_finished(self):
+        """
+        Tests that a retry of a job that has finished leaves it as it is
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        data = create_data({"request_group_id": REQUEST_GROUP_ID_EXP_1,
+                            "granule_id": "granule_1", "key": "objectkey_1",
+                            "glacier_bucket": PROTECTED_BUCKET, "dest_bucket": None},
+                           "restore", "inprogress")
+        data["request_id"] = REQUEST_ID1
+        retry = dict(data, request_id=REQUEST_ID2)
+        try:
+            self.assertEqual(REQUEST_ID1, requests_db.submit_request(data, on_conflict="update"))
+            requests_db.update_request_status_for_job(REQUEST_ID1, "complete")
+            self.assertIsNone(requests_db.submit_request(retry, on_conflict="update"))
+            self.assertEqual([], requests_db.submit_requests([retry], on_conflict="update"))
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_request. {str(err)}")
+        jobs = requests_db.get_jobs_by_request_group_id(REQUEST_GROUP_ID_EXP_1)
+        self.assertEqual([(REQUEST_ID1, "complete")],
+                         [(job["request_id"], job["job_status"]) for job in jobs])
+
+    def test_submit_request_concurrent(self):
+        """
+        Tests that a job recorded while another transaction is recording the
+        same one, with a different request_time, updates it once that
+        commits, rather than adding a duplicate, also when request_status is
+        partitioned and uq_reqstat_reqgidkey includes request_time, which is
+        to be tested with PARTITION_REQUEST_STATUS set to True
+        """
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        data = create_data({"request_group_id": REQUEST_GROUP_ID_EXP_1,
+                            "granule_id": "granule_1", "key": "objectkey_1",
+                            "glacier_bucket": PROTECTED_BUCKET, "dest_bucket": None},
+                           "restore", "inprogress",
+                           "2019-07-31 18:05:19.161362+00:00",
+                           "2019-07-31 18:05:19.161362+00:00")
+        data["request_id"] = REQUEST_ID1
+        retry = dict(data, request_id=REQUEST_ID2, job_status="error", err_msg="oh no",
+                     request_time=requests_db.get_utc_now_iso(),
+                     last_update_time=requests_db.get_utc_now_iso())
+        results = []
+        retried = threading.Thread(target=lambda: results.append(
+            requests_db.submit_request(retry, on_conflict="update")))
+        try:
+            with requests_db.transaction() as session:
+                requests_db.submit_request(data, session=session, on_conflict="update")
+                retried.start()
+                retried.join(1)
+                # the retry waits for this transaction to end
+                self.assertTrue(retried.is_alive())
+            retried.join()
+        except requests_db.DatabaseError as err:
+            self.fail(f"submit_request. {str(err)}")
+        self.assertEqual([REQUEST_ID1], results)
+        jobs = requests_db.get_jobs_by_request_group_id(REQUEST_GROUP_ID_EXP_1)
+        self.assertEqual(["error"], [job["job_status"] for job in jobs])
+
+    def test_submit_requests_duplicate(self):
+        """
+        Tests that no jobs are written when one of them can't be
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(2)
+        obj = {"request_group_id": REQUEST_GROUP_ID_EXP_6, "granule_id": "granule_8",
+               "key": "objectkey_8", "glacier_bucket": "my_s3_bucket",
+               "dest_bucket": PROTECTED_BUCKET}
+        requests_db.request_id_generator = Mock(side_effect=[REQUEST_ID12, REQUEST_ID1])
+        data_list = [create_data(obj, "restore", "inprogress"),
+                     create_data(obj, "restore", "inprogress")]
+        try:
+            requests_db.submit_requests(data_list)
+            self.fail("expected DatabaseError")
+        except requests_db.DatabaseError as err:
+            self.assertIn("duplicate key value violates unique constraint", str(err))
+        except requests_db.BadRequestError as err:
+            # when request_status is partitioned, request_time is part of its
+            # primary key, so it is the object_key that is found to be a duplicate
+            self.assertIn("already exists", str(err))
+        self.assertEqual([], requests_db.get_job_by_request_id(REQUEST_ID12))
+
     def test_update_request_status_for_job_inprogress(self):
         """
         Tests updating an 'error' job to an 'inprogress' status
@@ -284,6 +713,23 @@ class TestRequestsPostgres(unittest.TestCase): #pylint: disable-msg=too-many-ins
         except requests_db.DatabaseError as err:
             self.fail(f"update_request_status_for_job. {str(err)}")
 
+    def test_update_request_status_for_job_long_error(self):
+        """
+        Tests recording an error message longer than an index row may be
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(2)
+        # random, so it does not compress to under the limit
+        err_msg = os.urandom(8000).hex()
+        try:
+            requests_db.update_request_status_for_job(REQUEST_ID8, "error", err_msg)
+        except requests_db.DatabaseError as err:
+            self.fail(f"update_request_status_for_job. {str(err)}")
+        row = requests_db.get_job_by_request_id(REQUEST_ID8)
+        self.assertEqual("error", row[0]["job_status"])
+        self.assertEqual(err_msg, row[0]["err_msg"])
+
     def test_update_request_status_for_job_error(self):
         """
         Tests updating an inprogress job to an 'error' status
@@ -311,6 +757,97 @@ class TestRequestsPostgres(unittest.TestCase): #pylint: disable-msg=too-many-ins
         except requests_db.DatabaseError as err:
             self.fail(f"update_request_status_for_job. {str(err)}")
 
+    def test_update_request_status_for_jobs(self):
+        """
+        Tests updating many jobs in one statement
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(4)
+        utc_now_exp = "2019-07-31 21:07:15.234362+00:00"
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        unknown_id = "0000a0a0-a000-00a0-00a0-0000a0000000"
+        updates = [(REQUEST_ID8, "complete"), (REQUEST_ID4, "error", "oh no an error"),
+                   (unknown_id, "complete")]
+        try:
+            result = requests_db.update_request_status_for_jobs(updates)
+        except requests_db.DatabaseError as err:
+            self.fail(f"update_request_status_for_jobs. {str(err)}")
+        self.assertEqual({REQUEST_ID8: True, REQUEST_ID4: True, unknown_id: False}, result)
+        row = requests_db.get_job_by_request_id(REQUEST_ID8)
+        self.assertEqual("complete", row[0]["job_status"])
+        self.assertEqual(None, row[0]["err_msg"])
+        self.assertIn(utc_now_exp, row[0]["last_update_time"])
+        row = requests_db.get_job_by_request_id(REQUEST_ID4)
+        self.assertEqual("error", row[0]["job_status"])
+        self.assertEqual("oh no an error", row[0]["err_msg"])
+
+    def test_transaction(self):
+        """
+        Tests a read and a write in one transaction, which is rolled back
+        when the block raises
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        try:
+            with requests_db.transaction() as session:
+                job = requests_db.get_job_by_request_id(REQUEST_ID4, session=session)
+                requests_db.update_request_status_for_job(job[0]["request_id"], "complete",
+                                                          session=session)
+                row = requests_db.get_job_by_request_id(REQUEST_ID4, session=session)
+                self.assertEqual("complete", row[0]["job_status"])
+        except requests_db.DatabaseError as err:
+            self.fail(f"transaction. {str(err)}")
+        row = requests_db.get_job_by_request_id(REQUEST_ID4)
+        self.assertEqual("complete", row[0]["job_status"])
+
+        try:
+            with requests_db.transaction() as session:
+                requests_db.update_request_status_for_job(REQUEST_ID4, "error",
+                                                          session=session)
+                raise ValueError("oops")
+        except ValueError:
+            pass
+        row = requests_db.get_job_by_request_id(REQUEST_ID4)
+        self.assertEqual("complete", row[0]["job_status"])
+
+    def test_async_requests(self):
+        """
+        Tests the asynchronous functions, run concurrently in one event loop
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        utc_now_exp = "2019-07-31 21:07:15.234362+00:00"
+        requests_db.get_utc_now_iso = Mock(return_value=utc_now_exp)
+        requests_db.request_id_generator = Mock(
+            return_value="0000a0a0-a000-00a0-00a0-0000a0000099")
+        data = create_data({"request_group_id": REQUEST_GROUP_ID_EXP_1,
+                            "granule_id": "granule_1", "key": "objectkey_new",
+                            "glacier_bucket": "my_s3_bucket",
+                            "dest_bucket": PROTECTED_BUCKET},
+                           "restore", "inprogress", utc_now_exp, utc_now_exp)
+
+        async def run():
+            inserted, jobs = await asyncio.gather(
+                requests_db.submit_requests_async([data]),
+                requests_db.get_jobs_by_object_key_async("objectkey_4"))
+            updated = await requests_db.update_request_status_for_jobs_async(
+                [(data["request_id"], "complete")])
+            job = await requests_db.get_job_by_request_id_async(data["request_id"])
+            return inserted, jobs, updated, job
+
+        try:
+            inserted, jobs, updated, job = asyncio.run(run())
+        except requests_db.DatabaseError as err:
+            self.fail(f"async requests. {str(err)}")
+        self.assertEqual([data["request_id"]], inserted)
+        self.assertEqual([REQUEST_ID7, REQUEST_ID4], [job["request_id"] for job in jobs])
+        self.assertEqual({data["request_id"]: True}, updated)
+        self.assertEqual("complete", job[0]["job_status"])
+        self.assertEqual(requests_db.get_job_by_request_id(data["request_id"]), job)
+
     def test_update_request_status_complete(self):
         """
         Tests updating a job to a 'complete' status
@@ -359,6 +896,44 @@ class TestRequestsPostgres(unittest.TestCase): #pylint: disable-msg=too-many-ins
         result = requests_db.get_all_requests()
         self.assertEqual(expected, result)
 
+    def test_get_all_requests_page(self):
+        """
+        Tests reading all requests, and those with a status, a page at a time
+        """
+        qresult = self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        expected = result_to_json(qresult)
+        result, cursor = requests_db.get_all_requests_page(4)
+        while cursor:
+            self.assertEqual(4, len(result) % 4 or 4)
+            page, cursor = requests_db.get_all_requests_page(4, cursor)
+            result.extend(page)
+        self.assertEqual(expected, result)
+
+        result, cursor = requests_db.get_jobs_by_status_page("complete", page_size=2)
+        self.assertEqual([REQUEST_ID3, REQUEST_ID2], [job["request_id"] for job in result])
+        result, cursor = requests_db.get_jobs_by_status_page("complete", page_size=2,
+                                                             cursor=cursor)
+        self.assertEqual([REQUEST_ID1], [job["request_id"] for job in result])
+        self.assertIsNone(cursor)
+
+    def test_iter_all_requests(self):
+        """
+        Tests streaming all requests, a few rows at a time
+        """
+        qresult = self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        expected = result_to_json(qresult)
+        result = list(requests_db.iter_all_requests(itersize=3))
+        self.assertEqual(expected, result)
+
+        status = "complete"
+        expected = requests_db.get_jobs_by_status(status)
+        result = list(requests_db.iter_jobs_by_status(status, itersize=2))
+        self.assertEqual(expected, result)
+
     def test_get_jobs_by_object_key(self):
         """
         Tests reading by object_key
@@ -381,6 +956,42 @@ class TestRequestsPostgres(unittest.TestCase): #pylint: disable-msg=too-many-ins
         object_key = "objectkey_5"
         result = requests_db.get_jobs_by_object_key(object_key)
 
+    def test_get_active_jobs_by_object_keys(self):
+        """
+        Tests reading the newest job that isn't complete for many object_keys
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        result = requests_db.get_active_jobs_by_object_keys(["objectkey_4", "objectkey_1",
+                                                             "nofilefound"])
+        self.assertEqual({"objectkey_4": REQUEST_ID7, "objectkey_1": REQUEST_ID8},
+                         {key: job["request_id"] for key, job in result.items()})
+
+    def test_prepared_statements(self):
+        """
+        Tests that the reads by object_key are prepared once on the pooled
+        connection, and still run when a proxy has lost the prepared statement
+        """
+        self.create_test_requests()
+        boto3.client = Mock()
+        mock_ssm_get_parameter(1)
+        os.environ["DATABASE_POOL_MAX_SIZE"] = "1"
+        database.close_pools()
+        try:
+            exp_result = requests_db.get_jobs_by_object_key("objectkey_4")
+            self.assertEqual(exp_result, requests_db.get_jobs_by_object_key("objectkey_4"))
+            with requests_db.transaction() as session:
+                rows = session.query("SELECT name FROM pg_prepared_statements")
+            self.assertEqual([{"name": "request_status_by_object_key"}], rows)
+
+            with requests_db.transaction() as session:
+                session.query("DEALLOCATE ALL")
+            self.assertEqual(exp_result, requests_db.get_jobs_by_object_key("objectkey_4"))
+        finally:
+            os.environ.pop("DATABASE_POOL_MAX_SIZE", None)
+            database.close_pools()
+
     def test_get_jobs_by_status(self):
         """
         Tests reading by status
@@ -0,0 +1,559 @@
+"""
+This module is the asyncio counterpart of database.py. Connections are opened
+in psycopg2's asynchronous mode and waited on with the event loop, so that
+queries can overlap with other I/O, such as s3 calls made in an executor.
+Errors are raised as the same DbError as database.py raises, and transient
+ones are retried with the same backoff and circuit breaker. The deadline set
+by database.query_deadline() applies too, but is enforced by cancelling the
+statement from the client, rather than by a statement_timeout.
+
+Asynchronous connections are always in autocommit mode, so single_query()
+runs its statement on its own, and transaction() wraps its statements in an
+explicit BEGIN and COMMIT.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from contextlib import asynccontextmanager
+from psycopg2 import DataError, InterfaceError, OperationalError, ProgrammingError
+from psycopg2 import connect as psycopg2_connect
+from psycopg2 import sql
+from psycopg2.extensions import (AsIs, POLL_OK, POLL_READ, POLL_WRITE,
+                                 TRANSACTION_STATUS_IDLE, encodings)
+from psycopg2.extras import RealDictCursor
+
+from database import (CircuitOpenError, DbError, QueryTimeout, _DEADLINE, _batch_pages,
+                      _batch_sql, _close_quietly, _emit, _forget_pools, _get_env_number,
+                      _is_auth_failure, _pool_key, _record_batch, _record_query,
+                      backoff_delays, fingerprint,
+                      get_circuit_breaker, get_query_sinks, invalidate_db_connect_info,
+                      is_retryable, query_deadline, remaining_secs)
+
+LOGGER = logging.getLogger(__name__)
+
+# connection pools by connect info. kept at module level so that they survive
+# across warm lambda invocations, and the event loops that each one runs.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class AsyncConnectionPool:
+    """
+    A pool of open asynchronous connections to one database. Connections are
+    handed out most recently used first, and closed when they have been idle
+    for longer than max_idle_secs or open for longer than max_lifetime_secs.
+    When max_size connections are checked out, getconn() waits for one to be
+    returned.
+    """
+
+    def __init__(self, dbconnect_info, max_size=5, max_idle_secs=300,
+                 max_lifetime_secs=3600):
+        self.dbconnect_info = dbconnect_info
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self.max_lifetime_secs = max_lifetime_secs
+        # idle connections as [connection, created, last_used], oldest first
+        self._idle = []
+        # created time of the checked out connections, by id
+        self._in_use = {}
+        # connections that are being opened
+        self._opening = 0
+        self._waiters = []
+        # set by closeall(), after which returned connections are closed
+        self._closed = False
+        self.stats = {"hits": 0, "misses": 0, "discarded": 0, "evicted": 0, "waits": 0}
+
+    async def getconn(self):
+        """
+        Returns a healthy pooled connection, a new one if none is available,
+        or waits for one to be returned if max_size are checked out.
+        """
+        while True:
+            self._evict_idle()
+            while self._idle:
+                connection, created, _ = self._idle.pop()
+                if not connection.closed and not connection.isexecuting():
+                    self.stats["hits"] += 1
+                    self._in_use[id(connection)] = created
+                    return connection
+                self.stats["discarded"] += 1
+                _close_quietly(connection)
+
+            if len(self._in_use) + self._opening < self.max_size:
+                self.stats["misses"] += 1
+                self._opening += 1
+                try:
+                    connection = await _connect(self.dbconnect_info)
+                finally:
+                    self._opening -= 1
+                    self._wake_waiter()
+                self._in_use[id(connection)] = time.monotonic()
+                return connection
+
+            self.stats["waits"] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def putconn(self, connection, discard=False):
+        """
+        Returns a connection to the pool. The connection is closed instead if
+        it is broken, too old, still running a statement, in a transaction,
+        or if discard is True.
+        """
+        created = self._in_use.pop(id(connection), time.monotonic())
+        now = time.monotonic()
+        keep = (not discard and not self._closed and not connection.closed
+                and not connection.isexecuting()
+                and connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+                and now - created < self.max_lifetime_secs)
+        if keep:
+            self._idle.append([connection, created, now])
+        else:
+            self.stats["discarded"] += 1
+            _close_quietly(connection)
+        self._wake_waiter()
+
+    def closeall(self):
+        """
+        Closes all of the idle connections in the pool, and the checked out
+        ones as they are returned.
+        """
+        self._closed = True
+        for connection, _, _ in self._idle:
+            _close_quietly(connection)
+        self._idle = []
+
+    def _wake_waiter(self):
+        """
+        Wakes the first caller waiting for a connection, if any.
+        """
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                try:
+                    waiter.set_result(None)
+                    return
+                except RuntimeError:
+                    # the waiter's event loop has been closed
+                    continue
+
+    def _evict_idle(self):
+        """
+        Closes the idle connections that have been idle too long or have
+        exceeded their lifetime.
+        """
+        now = time.monotonic()
+        kept = []
+        for entry in self._idle:
+            connection, created, last_used = entry
+            if (now - created >= self.max_lifetime_secs
+                    or now - last_used >= self.max_idle_secs):
+                self.stats["evicted"] += 1
+                _close_quietly(connection)
+            else:
+                kept.append(entry)
+        self._idle = kept
+
+
+def get_pool(dbconnect_info):
+    """
+    Returns the asynchronous connection pool for the given connect info,
+    creating it the first time. The sizes and timeouts are read from the same
+    DATABASE_POOL_MAX_SIZE, DATABASE_POOL_MAX_IDLE_SECS and
+    DATABASE_POOL_MAX_LIFETIME_SECS env vars as database.get_pool(). As
+    there, a pool with an older password is closed and forgotten.
+    """
+    key = _pool_key(dbconnect_info)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            _forget_pools(_POOLS, lambda other: other[:4] == key[:4])
+            pool = AsyncConnectionPool(
+                dbconnect_info,
+                max_size=_get_env_number("DATABASE_POOL_MAX_SIZE", 5),
+                max_idle_secs=_get_env_number("DATABASE_POOL_MAX_IDLE_SECS", 300, float),
+                max_lifetime_secs=_get_env_number("DATABASE_POOL_MAX_LIFETIME_SECS",
+                                                  3600, float))
+            _POOLS[key] = pool
+    return pool
+
+
+def get_pool_stats():
+    """
+    Returns the counters summed over all of the asynchronous connection pools.
+    """
+    totals = {"hits": 0, "misses": 0, "discarded": 0, "evicted": 0, "waits": 0}
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            for stat in totals:
+                totals[stat] += pool.stats[stat]
+    return totals
+
+
+def close_pools():
+    """
+    Closes the idle connections in all of the pools and forgets the pools.
+    """
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.closeall()
+        _POOLS.clear()
+
+
+async def _wait(connection):
+    """
+    Waits, without blocking the event loop, until the connection has
+    finished connecting or running its statement.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = connection.poll()
+        if state == POLL_OK:
+            return
+        ready = loop.create_future()
+        fileno = connection.fileno()
+        if state == POLL_READ:
+            loop.add_reader(fileno, _set_ready, ready)
+            remove = loop.remove_reader
+        elif state == POLL_WRITE:
+            loop.add_writer(fileno, _set_ready, ready)
+            remove = loop.remove_writer
+        else:
+            raise OperationalError(f"bad state from poll: {state}")
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+async def _before_deadline(awaitable):
+    """
+    Awaits awaitable, cancelling it and raising QueryTimeout if the deadline
+    set by database.query_deadline() passes first.
+    """
+    remaining = remaining_secs()
+    if remaining is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(remaining, 0))
+    except asyncio.TimeoutError:
+        raise QueryTimeout("Database Error. The query deadline has passed") from None
+
+
+def _set_ready(ready):
+    """
+    Marks a wait as ready, unless it has already been cancelled.
+    """
+    if not ready.done():
+        ready.set_result(None)
+
+
+async def _connect(dbconnect_info):
+    """
+    Opens a new asynchronous connection to the database.
+    """
+    try:
+        db_port = dbconnect_info["db_port"]
+    except ValueError:
+        db_port = 5432
+
+    connection = psycopg2_connect(
+        host=dbconnect_info["db_host"],
+        port=db_port,
+        database=dbconnect_info["db_name"],
+        user=dbconnect_info["db_user"],
+        password=dbconnect_info["db_pw"],
+        async_=1
+    )
+    try:
+        await _before_deadline(_wait(connection))
+    except BaseException:
+        _close_quietly(connection)
+        raise
+    return connection
+
+
+@asynccontextmanager
+async def get_connection(dbconnect_info):
+    """
+    Retrieves an asynchronous connection from the connection pool and yields
+    it. The connection goes back to the pool afterwards.
+    """
+    pool = None
+    connection = None
+    discard = False
+    get_circuit_breaker(dbconnect_info).check()
+    try:
+        start = time.perf_counter()
+        pool = get_pool(dbconnect_info)
+        connection = await _before_deadline(pool.getconn())
+        if get_query_sinks():
+            _emit({"event": "connect", "secs": time.perf_counter() - start})
+        yield connection
+
+    except QueryTimeout:
+        # the cancelled statement may not have finished yet
+        discard = True
+        raise
+
+    except (OperationalError, InterfaceError) as ex:
+        discard = True
+        if _is_auth_failure(ex):
+            invalidate_db_connect_info(dbconnect_info)
+            key = _pool_key(dbconnect_info)
+            with _POOLS_LOCK:
+                _forget_pools(_POOLS, lambda other: other == key)
+        # in autocommit mode a statement may have been committed before the
+        # connection was lost, so only an error reported by the server, or a
+        # failure to connect, is safe to retry
+        retryable = is_retryable(ex) and (connection is None or ex.pgcode is not None)
+        raise DbError(f"Database Error. {str(ex)}", retryable=retryable)
+
+    except Exception as ex:
+        raise DbError(f"Database Error. {str(ex)}", retryable=is_retryable(ex))
+
+    finally:
+        if connection:
+            pool.putconn(connection, discard)
+
+
+class AsyncCursor:
+    """
+    Runs statements on an asynchronous connection, yielded by transaction().
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def query(self, sql_stmt, params=None):
+        """
+        Runs a statement and returns its rows as a list, like
+        database.multi_query().
+        """
+        return await _query(sql_stmt, params, self.connection)
+
+    async def values_query(self, sql_stmt, params_list, template=None, fetch=True):
+        """
+        Runs a statement with a single VALUES %s placeholder for all of the
+        tuples in params_list, like database.values_query().
+        """
+        return await _values_query(sql_stmt, params_list, self.connection, template, fetch)
+
+    async def batch_query(self, statements, page_size=100):
+        """
+        Runs a list of (sql_stmt, params) statements, sending up to page_size
+        of them in each round trip, like database.multi_batch_query().
+        """
+        return await _batch_query(statements, self.connection, page_size)
+
+
+@asynccontextmanager
+async def transaction(dbconnect_info, deadline=None):
+    """
+    Yields an AsyncCursor whose statements all run in one transaction, which
+    is committed if no exception occurred, and rolled back otherwise. The
+    statements are limited by the deadline, as by database.query_deadline().
+    """
+    with query_deadline(deadline):
+        async with get_connection(dbconnect_info) as conn:
+            await _execute(conn, "BEGIN")
+            try:
+                yield AsyncCursor(conn)
+                await _execute(conn, "COMMIT")
+
+            except BaseException:
+                if not conn.closed and not conn.isexecuting():
+                    await _execute(conn, "ROLLBACK")
+                raise
+
+
+async def single_query(sql_stmt, dbconnect_info, params=None, deadline=None):
+    """
+    The asynchronous single_query(). Runs one statement, which is committed
+    automatically, and returns a list of the rows.
+    """
+    start = time.perf_counter()
+
+    async def run():
+        async with get_connection(dbconnect_info) as conn:
+            return await _query(sql_stmt, params, conn)
+
+    with query_deadline(deadline):
+        rows = await _with_retries(run, dbconnect_info)
+
+    if get_query_sinks():
+        query_fingerprint, statement = fingerprint(sql_stmt)
+        _emit({"event": "single_query", "fingerprint": query_fingerprint,
+               "statement": statement, "secs": time.perf_counter() - start,
+               "rows": len(rows)})
+    return rows
+
+
+async def values_query(sql_stmt, dbconnect_info, params_list,   #pylint: disable-msg=too-many-arguments
+                       template=None, page_size=1000, fetch=True, deadline=None):
+    """
+    The asynchronous values_query(). The rows are sent page_size at a time,
+    all in one transaction. When fetch is True the statement must have a
+    RETURNING clause, and the returned rows of all the pages are returned as
+    one list.
+    """
+    params_list = list(params_list)
+
+    async def run():
+        rows = []
+        async with transaction(dbconnect_info) as cursor:
+            for first in range(0, len(params_list), page_size):
+                rows.extend(await cursor.values_query(
+                    sql_stmt, params_list[first:first + page_size], template, fetch))
+        return rows
+
+    with query_deadline(deadline):
+        return await _with_retries(run, dbconnect_info)
+
+
+async def batch_query(statements, dbconnect_info, page_size=100, deadline=None):
+    """
+    The asynchronous batch_query(). Runs a list of (sql_stmt, params)
+    statements in one transaction, sending up to page_size of them in each
+    round trip, and returns a list with the rows of each statement, or None
+    for one that doesn't return rows.
+    """
+    statements = list(statements)
+
+    async def run():
+        async with transaction(dbconnect_info) as cursor:
+            return await cursor.batch_query(statements, page_size)
+
+    with query_deadline(deadline):
+        return await _with_retries(run, dbconnect_info)
+
+
+async def _with_retries(operation, dbconnect_info):
+    """
+    The asynchronous database._with_retries(). Awaits operation(), retrying
+    it with backoff while it fails with a retryable DbError.
+    """
+    breaker = get_circuit_breaker(dbconnect_info)
+    delays = backoff_delays(_DEADLINE.get())
+    while True:
+        try:
+            result = await operation()
+        except CircuitOpenError:
+            raise
+        except DbError as err:
+            delay = next(delays, None) if err.retryable else None
+            if delay is None:
+                breaker.record(not err.retryable)
+                raise
+            LOGGER.warning(f"retrying in {delay:.2f} seconds after: {str(err)}")
+            await asyncio.sleep(delay)
+            continue
+        breaker.record(True)
+        return result
+
+
+async def _execute(connection, sql_stmt, params=None):
+    """
+    Runs a statement on a new cursor and waits for it to finish. Returns the
+    cursor, so that its rows can be fetched.
+    """
+    remaining = remaining_secs()
+    if remaining is not None and remaining <= 0:
+        raise QueryTimeout("Database Error. The query deadline has passed")
+    cursor = connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(sql_stmt, params)
+    try:
+        await _before_deadline(_wait(connection))
+    except (asyncio.CancelledError, QueryTimeout):
+        connection.cancel()
+        raise
+    return cursor
+
+
+async def _query(sql_stmt, params, connection):
+    """
+    Runs a query, handling errors in the same manner as database._query().
+    """
+    try:
+        start = time.perf_counter()
+        cursor = await _execute(connection, sql.SQL(sql_stmt), params)
+
+    except (ProgrammingError, DataError) as err:
+        LOGGER.exception(f"database error - {err}")
+        raise DbError("Internal database error, please contact LP DAAC User Services")
+
+    executed = time.perf_counter()
+    try:
+        rows = cursor.fetchall()
+
+    except (ProgrammingError) as err:
+        # no results, return an empty list
+        rows = []
+
+    cursor.close()
+    _record_query(sql_stmt, params, executed - start, time.perf_counter() - executed, len(rows))
+    return rows
+
+
+async def _values_query(sql_stmt, params_list, connection,   #pylint: disable-msg=too-many-arguments
+                        template, fetch):
+    """
+    Runs a statement for one page of a values_query(). The VALUES %s
+    placeholder is filled with each of the tuples in params_list, formatted
+    with the template, if given.
+    """
+    if not params_list:
+        return []
+    try:
+        start = time.perf_counter()
+        cursor = connection.cursor()
+        if template:
+            values = b",".join(cursor.mogrify(template, params) for params in params_list)
+        else:
+            values = b",".join(cursor.mogrify("%s", (tuple(params),)) for params in params_list)
+        cursor.close()
+        cursor = await _execute(connection, sql_stmt,
+                                (AsIs(values.decode(encodings[connection.encoding])),))
+
+    except (ProgrammingError, DataError) as err:
+        LOGGER.exception(f"database error - {err}")
+        raise DbError("Internal database error, please contact LP DAAC User Services")
+
+    rows = cursor.fetchall() if fetch else []
+    cursor.close()
+    _record_query(sql_stmt, params_list, time.perf_counter() - start, 0.0, len(rows))
+    return rows
+
+
+async def _batch_query(statements, connection, page_size):
+    """
+    Runs the statements of a batch_query() a page at a time, handling errors
+    in the same manner as _query().
+    """
+    results = []
+    for page in _batch_pages(statements, page_size):
+        try:
+            start = time.perf_counter()
+            cursor = connection.cursor()
+            batch = _batch_sql(page, cursor)
+            cursor.close()
+            cursor = await _execute(connection, batch)
+
+        except (ProgrammingError, DataError) as err:
+            LOGGER.exception(f"database error - {err}")
+            raise DbError("Internal database error, please contact LP DAAC User Services")
+
+        executed = time.perf_counter()
+        rows = cursor.fetchall() if cursor.description is not None else None
+        cursor.close()
+        results.extend(_record_batch(page, rows, executed - start,
+                                     time.perf_counter() - executed))
+    return results
@@ -4,26 +4,129 @@ cursor and connection objects can be imported and used directly, but for most
 queries, simply using the "query()" fuction will likely suffice.
 """
 
+import collections
+import contextvars
+import csv
+import functools
+import hashlib
+import io
+import itertools
 import logging
 import json
 import os
+import random
+import re
+import select
+import sys
+import threading
+import time
+import weakref
 
 from contextlib import contextmanager
 import datetime
 import uuid
 import boto3
-from psycopg2 import DataError, ProgrammingError
+from psycopg2 import DataError, InterfaceError, OperationalError, ProgrammingError
+from psycopg2 import Error as Psycopg2Error
 from psycopg2 import connect as psycopg2_connect
 from psycopg2 import sql
-from psycopg2.extras import RealDictCursor
+#pylint: disable-msg=no-name-in-module
+from psycopg2.errors import InvalidSqlStatementName, QueryCanceled
+#pylint: enable-msg=no-name-in-module
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.extras import RealDictCursor, execute_values
 
 LOGGER = logging.getLogger(__name__)
 
+# connection pools by connect info. kept at module level so that they survive
+# across warm lambda invocations.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# circuit breakers by database, shared by database.py and async_database.py
+_BREAKERS = {}
+
+# the sqlstates of errors that are transient: serialization failure, deadlock,
+# too many connections, and the server shutting down or starting up. Those of
+# class 08, connection exceptions, are transient too.
+_RETRYABLE_PGCODES = frozenset(["40001", "40P01", "53300", "57P01", "57P02", "57P03"])
+
+# connection failures that are configuration errors rather than transient ones
+_CONFIG_FAILURES = ("authentication failed", "does not exist", "no pg_hba.conf entry",
+                    "could not translate host name")
+
+# the time.monotonic() by which the statements in the current context must
+# finish, set by query_deadline(). None when there is no deadline.
+_DEADLINE = contextvars.ContextVar("database_deadline", default=None)
+
+# parameter store values by name, as (value, expires), and the ssm client
+_SSM_CACHE = {}
+_SSM_CLIENT = None
+
+# the sinks that the query timing events are sent to. None until they are
+# first read from the DATABASE_QUERY_SINKS env var.
+_QUERY_SINKS = None
+
+# the number of characters of csv that copy_rows() sends to the server at a
+# time, and the number of rows it formats at a time
+_COPY_CHUNK_SIZE = 65536
+_COPY_BATCH_ROWS = 200
+
+# statements that return rows, which end a page of batch_query(). a WITH
+# without RETURNING returns none, but ending the page for it costs no more
+# than the round trip it would have had without batching.
+_RETURNS_ROWS = re.compile(r"^[\s(]*(SELECT|WITH|VALUES|TABLE|SHOW|EXPLAIN)\b|\bRETURNING\b",
+                           re.IGNORECASE)
+
+# the names of the statements prepared on each connection, or None for one
+# where prepared statements were found not to last from one transaction to the
+# next, as behind a transaction pooling proxy, and aren't used. weak, so that
+# a connection dropped by its pool takes its names with it.
+_PREPARED = weakref.WeakKeyDictionary()
+
+# the (deadline, timeout_ms) of the statement_timeout last set in the open
+# transaction of each connection. weak, as _PREPARED is.
+_TIMEOUTS = weakref.WeakKeyDictionary()
+
+# the fraction of a statement_timeout that the time left before its deadline
+# may fall by before it is set again. a statement may go on past the deadline
+# by at most this much of the timeout.
+_TIMEOUT_SLACK = 0.1
+
+# the placeholders that are numbered for PREPARE
+_PLACEHOLDERS = re.compile(r"%[s%]")
+
+# the placeholders, and the quoted literals, identifiers and comments that
+# they are not numbered in, of a statement
+_SQL_TOKENS = re.compile(r"""(?<![\w$])[Ee]'(?:[^'\\]|\\.|'')*'"""
+                         r"""|'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/"""
+                         r"""|(\$(?:[A-Za-z_]\w*)?\$).*?\1|%[s%]""", re.DOTALL)
+
+# the types of column values that convert_rows() turns into strings
+_STR_TYPES = frozenset([datetime.datetime, datetime.date, datetime.time, uuid.UUID])
+
 #TODO develop tests for database.py later. in those mock psycopg2.cursor, etc
 
 class DbError(Exception):
     """
-    Exception to be raised if there is a database error.
+    Exception to be raised if there is a database error. retryable is True
+    when the error is transient, such as a lost connection, and the statement
+    can safely be run again.
+    """
+
+    def __init__(self, *args, retryable=False):
+        super().__init__(*args)
+        self.retryable = retryable
+
+class CircuitOpenError(DbError):
+    """
+    Exception to be raised when a circuit breaker fails a call fast.
+    """
+
+class QueryTimeout(DbError):
+    """
+    Exception to be raised when a statement, or connecting to run it, would
+    go on past the deadline set by query_deadline().
     """
 
 class ResourceExists(Exception):
@@ -51,8 +154,56 @@ def result_to_json(result_rows):
     """
     Converts a database result to Json format
     """
-    json_result = json.loads(json.dumps(result_rows, default=myconverter))
-    return json_result
+    return convert_rows(result_rows)
+
+
+def convert_rows(result_rows, row_format="dict"):
+    """
+    Converts the datetime, date, time and UUID values in a database result,
+    a list of rows or a single row, to strings, walking the rows once.
+
+    row_format "dict" converts dict rows in place and returns them, "tuple"
+    returns each row as a tuple of its values, and "record" returns each row
+    as a namedtuple with a field per column, which has no per row __dict__.
+    """
+    if isinstance(result_rows, dict):
+        return _convert_row(result_rows, row_format)
+    return [_convert_row(row, row_format) for row in result_rows]
+
+
+def _convert_row(row, row_format):
+    """
+    Converts the values of a single row for convert_rows().
+    """
+    if row_format == "dict":
+        for column, value in row.items():
+            if value.__class__ in _STR_TYPES:
+                row[column] = str(value)
+        return row
+
+    if isinstance(row, dict):
+        columns = tuple(row.keys())
+        values = row.values()
+    else:
+        columns = None
+        values = row
+    values = tuple(str(value) if value.__class__ in _STR_TYPES else value
+                   for value in values)
+    if row_format == "tuple":
+        return values
+    if row_format == "record":
+        if columns is None:
+            raise ValueError("record rows can only be made from dict rows")
+        return _record_type(columns)._make(values)
+    raise ValueError(f"unknown row_format: {row_format}")
+
+
+@functools.lru_cache(maxsize=32)
+def _record_type(columns):
+    """
+    Returns the namedtuple class for a set of column names.
+    """
+    return collections.namedtuple("Row", columns)
 
 
 def myconverter(obj):       #pylint: disable-msg=inconsistent-return-statements
@@ -63,34 +214,715 @@ def myconverter(obj):       #pylint: disable-msg=inconsistent-return-statements
     if isinstance(obj, datetime.datetime):
         return obj.__str__()
 
+class ConnectionPool:
+    """
+    A pool of open connections to one database. Connections are handed out
+    most recently used first, checked before being reused, and closed when
+    they have been idle for longer than max_idle_secs (down to min_size idle
+    connections) or have been open for longer than max_lifetime_secs.
+    """
+
+    def __init__(self, dbconnect_info,          #pylint: disable-msg=too-many-arguments
+                 min_size=0, max_size=5, max_idle_secs=300,
+                 max_lifetime_secs=3600, ping_after_secs=30):
+        self.dbconnect_info = dbconnect_info
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self.max_lifetime_secs = max_lifetime_secs
+        self.ping_after_secs = ping_after_secs
+        # idle connections as [connection, created, last_used], oldest first
+        self._idle = []
+        # checked out connections by id, as [connection, created]
+        self._in_use = {}
+        # connections that are being opened
+        self._opening = 0
+        # set by closeall(), after which returned connections are closed
+        self._closed = False
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "discarded": 0, "evicted": 0}
+
+    def getconn(self, connect_timeout=None):
+        """
+        Returns a healthy pooled connection, or a new one if none is available,
+        given up on after connect_timeout seconds, if given. The lock is only
+        held to take an idle connection, or a place for a new one, so that a
+        slow ping or connect doesn't hold up the other threads.
+
+        Raises DbError if max_size connections are already checked out.
+        """
+        while True:
+            with self._lock:
+                self._evict_idle()
+                self._prune_in_use()
+                if not self._idle:
+                    if len(self._in_use) + self._opening >= self.max_size:
+                        raise DbError(f"connection pool exhausted, "
+                                      f"{len(self._in_use) + self._opening} connections in use")
+                    self.stats["misses"] += 1
+                    self._opening += 1
+                    break
+                connection, created, last_used = self._idle.pop()
+                self._in_use[id(connection)] = [connection, created]
+
+            healthy = self._is_healthy(connection, created, last_used)
+            with self._lock:
+                if healthy:
+                    self.stats["hits"] += 1
+                    return connection
+                del self._in_use[id(connection)]
+                self.stats["discarded"] += 1
+            _close_quietly(connection)
+
+        try:
+            connection = _connect(self.dbconnect_info, connect_timeout)
+        finally:
+            with self._lock:
+                self._opening -= 1
+        with self._lock:
+            self._in_use[id(connection)] = [connection, time.monotonic()]
+        return connection
+
+    def putconn(self, connection, discard=False):
+        """
+        Returns a connection to the pool. Any open transaction is rolled back.
+        The connection is closed instead if it is broken, too old, if the
+        pool is full, or if discard is True.
+        """
+        with self._lock:
+            entry = self._in_use.pop(id(connection), None)
+            created = entry[1] if entry else time.monotonic()
+            now = time.monotonic()
+            keep = (not discard and not self._closed and not connection.closed
+                    and now - created < self.max_lifetime_secs
+                    and len(self._idle) < self.max_size)
+            if keep and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Exception:       #pylint: disable-msg=broad-except
+                    keep = False
+            if keep:
+                self._idle.append([connection, created, now])
+            else:
+                self.stats["discarded"] += 1
+                _close_quietly(connection)
+
+    def closeall(self):
+        """
+        Closes all of the idle connections in the pool, and the checked out
+        ones as they are returned.
+        """
+        with self._lock:
+            self._closed = True
+            for connection, _, _ in self._idle:
+                _close_quietly(connection)
+            self._idle = []
+
+    def _is_healthy(self, connection, created, last_used):
+        """
+        Checks a connection before it is handed out again. A connection that
+        has sat idle for longer than ping_after_secs, such as one held across
+        a frozen lambda, is pinged with a trivial query.
+        """
+        now = time.monotonic()
+        if connection.closed or now - created >= self.max_lifetime_secs:
+            return False
+        if connection.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if now - last_used >= self.ping_after_secs:
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                connection.rollback()
+            except Exception:       #pylint: disable-msg=broad-except
+                return False
+        return True
+
+    def _evict_idle(self):
+        """
+        Closes the idle connections that have exceeded their lifetime, and
+        those that have been idle too long while more than min_size remain.
+        """
+        now = time.monotonic()
+        kept = []
+        n_idle = len(self._idle)
+        for entry in self._idle:
+            connection, created, last_used = entry
+            expired = now - created >= self.max_lifetime_secs
+            stale = now - last_used >= self.max_idle_secs and n_idle > self.min_size
+            if expired or stale:
+                self.stats["evicted"] += 1
+                n_idle -= 1
+                _close_quietly(connection)
+            else:
+                kept.append(entry)
+        self._idle = kept
+
+    def _prune_in_use(self):
+        """
+        Forgets checked out connections that the caller has already closed
+        rather than returning them, such as those from return_connection().
+        """
+        for key in [key for key, entry in self._in_use.items() if entry[0].closed]:
+            del self._in_use[key]
+
+
+def get_pool(dbconnect_info):
+    """
+    Returns the connection pool for the given connect info, creating it
+    the first time. Sizes and timeouts are read from these env vars:
+        DATABASE_POOL_MIN_SIZE (default 0)
+        DATABASE_POOL_MAX_SIZE (default 5)
+        DATABASE_POOL_MAX_IDLE_SECS (default 300)
+        DATABASE_POOL_MAX_LIFETIME_SECS (default 3600)
+        DATABASE_POOL_PING_AFTER_SECS (default 30)
+
+    A pool for the same database and user with an older password, as after a
+    rotation, is closed and forgotten.
+    """
+    key = _pool_key(dbconnect_info)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            _forget_pools(_POOLS, lambda other: other[:4] == key[:4])
+            pool = ConnectionPool(
+                dbconnect_info,
+                min_size=_get_env_number("DATABASE_POOL_MIN_SIZE", 0),
+                max_size=_get_env_number("DATABASE_POOL_MAX_SIZE", 5),
+                max_idle_secs=_get_env_number("DATABASE_POOL_MAX_IDLE_SECS", 300, float),
+                max_lifetime_secs=_get_env_number("DATABASE_POOL_MAX_LIFETIME_SECS",
+                                                  3600, float),
+                ping_after_secs=_get_env_number("DATABASE_POOL_PING_AFTER_SECS", 30, float))
+            _POOLS[key] = pool
+    return pool
+
+
+def _pool_key(dbconnect_info):
+    """
+    Returns the key of the connection pool for the given connect info, which
+    includes the password, so that new credentials get a new pool.
+    """
+    return (dbconnect_info["db_host"], str(dbconnect_info.get("db_port")),
+            dbconnect_info["db_name"], dbconnect_info["db_user"], dbconnect_info["db_pw"])
+
+
+def _forget_pools(pools, stale):
+    """
+    Closes and removes the pools whose keys stale() is true for. The caller
+    holds the lock of pools.
+    """
+    for key in [key for key in pools if stale(key)]:
+        pools.pop(key).closeall()
+
+
+def get_pool_stats():
+    """
+    Returns the hit/miss counters summed over all of the connection pools.
+    Each miss is a new connection, so hits are connects that were avoided.
+    """
+    totals = {"hits": 0, "misses": 0, "discarded": 0, "evicted": 0}
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            for stat in totals:
+                totals[stat] += pool.stats[stat]
+    return totals
+
+
+def close_pools():
+    """
+    Closes the idle connections in all of the pools and forgets the pools
+    and the circuit breakers.
+    """
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.closeall()
+        _POOLS.clear()
+        _BREAKERS.clear()
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a database is down. After threshold consecutive failed
+    calls the breaker opens, and check() raises CircuitOpenError for cooldown_secs
+    without trying the database. Then one call is let through: if it
+    succeeds the breaker closes, and if it fails the breaker opens again.
+    """
+
+    def __init__(self, threshold=3, cooldown_secs=30):
+        self.threshold = threshold
+        self.cooldown_secs = cooldown_secs
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        Raises CircuitOpenError if the breaker is open.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown_secs - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(f"Database Error. The database is unavailable, "
+                              f"not trying again for {remaining:.0f} seconds")
+            # let this call through, and fail fast for the others until it's done
+            self.opened_at = time.monotonic()
+
+    def record(self, success):
+        """
+        Records the outcome of a call.
+        """
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    LOGGER.warning(f"{self.failures} consecutive database failures, "
+                                   f"failing fast for {self.cooldown_secs} seconds")
+                self.opened_at = time.monotonic()
+
+
+def get_circuit_breaker(dbconnect_info):
+    """
+    Returns the circuit breaker for the given database, creating it the first
+    time. It opens after DATABASE_BREAKER_THRESHOLD (default 3) consecutive
+    failed calls, for DATABASE_BREAKER_COOLDOWN_SECS (default 30).
+    """
+    key = (dbconnect_info["db_host"], str(dbconnect_info.get("db_port")),
+           dbconnect_info["db_name"])
+    with _POOLS_LOCK:
+        breaker = _BREAKERS.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                threshold=_get_env_number("DATABASE_BREAKER_THRESHOLD", 3),
+                cooldown_secs=_get_env_number("DATABASE_BREAKER_COOLDOWN_SECS", 30, float))
+            _BREAKERS[key] = breaker
+    return breaker
+
+
+def is_retryable(ex):
+    """
+    Returns True if the exception is a transient database error, such as a
+    lost connection or a failover, after which the statement can be retried.
+    Configuration errors such as authentication failures are not.
+    """
+    if isinstance(ex, DbError):
+        return ex.retryable
+    if any(failure in str(ex) for failure in _CONFIG_FAILURES):
+        return False
+    pgcode = getattr(ex, "pgcode", None)
+    if pgcode:
+        return pgcode in _RETRYABLE_PGCODES or pgcode.startswith("08")
+    return isinstance(ex, (OperationalError, InterfaceError))
+
+
+def backoff_delays(deadline=None):
+    """
+    Yields the delays to sleep before each retry: exponential backoff with
+    full jitter, until the next retry would be past the retry deadline, or
+    the given deadline if that is earlier. They are read from these env vars:
+        DATABASE_RETRY_DEADLINE_SECS (default 20)
+        DATABASE_RETRY_BASE_SECS (default 0.2)
+        DATABASE_RETRY_MAX_SECS (default 5)
+    """
+    deadline = _earliest(deadline, time.monotonic() +
+                         _get_env_number("DATABASE_RETRY_DEADLINE_SECS", 20, float))
+    base_secs = _get_env_number("DATABASE_RETRY_BASE_SECS", 0.2, float)
+    max_secs = _get_env_number("DATABASE_RETRY_MAX_SECS", 5, float)
+    attempt = 0
+    while True:
+        delay = random.uniform(0, min(max_secs, base_secs * 2 ** min(attempt, 30)))
+        if time.monotonic() + delay > deadline:
+            return
+        yield delay
+        attempt += 1
+
+
+def _with_retries(operation, dbconnect_info):
+    """
+    Runs operation(), retrying it with backoff_delays() while it fails with
+    a retryable DbError. The circuit breaker records the outcome, where an
+    error that is not retryable still means the database is up.
+    """
+    breaker = get_circuit_breaker(dbconnect_info)
+    delays = backoff_delays(_DEADLINE.get())
+    while True:
+        try:
+            result = operation()
+        except CircuitOpenError:
+            raise
+        except DbError as err:
+            delay = next(delays, None) if err.retryable else None
+            if delay is None:
+                breaker.record(not err.retryable)
+                raise
+            LOGGER.warning(f"retrying in {delay:.2f} seconds after: {str(err)}")
+            time.sleep(delay)
+            continue
+        breaker.record(True)
+        return result
+
+
 @contextmanager
-def get_connection(dbconnect_info):
+def query_deadline(deadline):
     """
-    Retrieves a connection from the connection pool and yields it.
+    Sets the time.monotonic() by which the statements run in the block must
+    finish. Each statement gets a statement_timeout of the time left, and new
+    connections a connect_timeout, and one that would go on past the deadline
+    raises QueryTimeout rather than run until the lambda is killed. Retries
+    stop at the deadline too. A deadline of None, or one later than that of
+    an enclosing block, changes nothing.
+
+    The deadline is kept in a context variable, so it applies to the thread,
+    or the asyncio task, that set it.
+    """
+    token = _DEADLINE.set(_earliest(deadline, _DEADLINE.get()))
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def deadline_from_context(context, margin_secs=None):
+    """
+    Returns a deadline for query_deadline() that leaves margin_secs of a
+    lambda invocation's remaining time for the handler to report what it
+    got done. The default margin comes from the DATABASE_DEADLINE_MARGIN_SECS
+    env var, or 3. Returns None if there is no context, such as in a test.
+    """
+    if context is None:
+        return None
+    if margin_secs is None:
+        margin_secs = _get_env_number("DATABASE_DEADLINE_MARGIN_SECS", 3, float)
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - margin_secs
+
+
+def remaining_secs():
+    """
+    Returns the seconds left before the current deadline, or None if there
+    isn't one.
+    """
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def _earliest(deadline, other):
+    """
+    Returns the earlier of two deadlines, either of which may be None.
+    """
+    if deadline is None:
+        return other
+    if other is None:
+        return deadline
+    return min(deadline, other)
+
+
+def _set_statement_timeout(cursor, deadline):
+    """
+    Limits the statements that follow in the transaction to the time left
+    before the deadline, if there is one.
+
+    SET LOCAL lasts until the transaction ends, so it is only sent again in
+    the same transaction when the deadline changes, or when the time left has
+    fallen by more than _TIMEOUT_SLACK of the timeout that was set, rather
+    than costing a round trip before every statement.
+    """
+    if deadline is None:
+        return
+    timeout_ms = int((deadline - time.monotonic()) * 1000)
+    if timeout_ms <= 0:
+        raise QueryTimeout("Database Error. The query deadline has passed")
+    conn = cursor.connection
+    if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        set_deadline, set_ms = _TIMEOUTS.get(conn, (None, 0))
+        if set_deadline == deadline and timeout_ms >= set_ms * (1 - _TIMEOUT_SLACK):
+            return
+    cursor.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+    _TIMEOUTS[conn] = (deadline, timeout_ms)
+
+
+def _is_timeout(ex):
+    """
+    Returns True if the exception is a statement cancelled by its
+    statement_timeout or a connect_timeout.
+    """
+    return (isinstance(ex, QueryCanceled) or
+            (isinstance(ex, OperationalError) and "timeout expired" in str(ex)))
+
+
+def _get_env_number(name, default, convert=int):
+    """
+    Returns the numeric value of an env var, or the default if it isn't set.
+    """
+    try:
+        return convert(os.environ[name])
+    except KeyError:
+        return default
+
+
+def _connect(dbconnect_info, connect_timeout=None):
+    """
+    Opens a new connection to the database, waiting for up to connect_timeout
+    seconds, if given. libpq waits for whole seconds, and at least 2.
     """
-    # create and yield a connection
-    connection = None
     try:
         db_port = dbconnect_info["db_port"]
     except ValueError:
         db_port = 5432
 
+    kwargs = {}
+    if connect_timeout is not None:
+        kwargs["connect_timeout"] = max(int(connect_timeout), 1)
+    return psycopg2_connect(
+        host=dbconnect_info["db_host"],
+        port=db_port,
+        database=dbconnect_info["db_name"],
+        user=dbconnect_info["db_user"],
+        password=dbconnect_info["db_pw"],
+        **kwargs
+    )
+
+
+def _is_auth_failure(ex):
+    """
+    Returns True if the exception is a failure to authenticate a connection.
+    """
+    return isinstance(ex, OperationalError) and "authentication failed" in str(ex)
+
+
+def _close_quietly(connection):
+    """
+    Closes a connection, ignoring any error from an already broken one.
+    """
+    try:
+        connection.close()
+    except Exception:       #pylint: disable-msg=broad-except
+        pass
+
+
+class QueryStats:
+    """
+    A query sink that keeps the timings of the query events in memory, by
+    statement fingerprint, and the connect events under "connect". Meant for
+    benchmarks and tests, add it with add_query_sink().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = collections.defaultdict(list)
+        self._statements = {}
+
+    def __call__(self, event):
+        if event["event"] == "query":
+            key = event["fingerprint"]
+            secs = event["execute_secs"] + event["fetch_secs"]
+        elif event["event"] == "connect":
+            key = "connect"
+            secs = event["secs"]
+        else:
+            return
+        with self._lock:
+            self._timings[key].append(secs)
+            self._statements.setdefault(key, event.get("statement", ""))
+
+    def summary(self):
+        """
+        Returns {fingerprint: {"statement", "count", "p50", "p95", "total"}},
+        with the times in seconds.
+        """
+        result = {}
+        with self._lock:
+            for key, timings in self._timings.items():
+                ordered = sorted(timings)
+                result[key] = {"statement": self._statements[key],
+                               "count": len(ordered),
+                               "p50": _percentile(ordered, 50),
+                               "p95": _percentile(ordered, 95),
+                               "total": sum(ordered)}
+        return result
+
+    def reset(self):
+        """
+        Forgets all of the recorded timings.
+        """
+        with self._lock:
+            self._timings.clear()
+            self._statements.clear()
+
+
+def _percentile(ordered, percent):
+    """
+    Returns the nearest rank percentile of a sorted list.
+    """
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def log_query_sink(event):
+    """
+    A query sink that logs each event at debug level.
+    """
+    LOGGER.debug(f"query event: {event}")
+
+
+def emf_query_sink(event):
+    """
+    A query sink that prints each event to stdout as a CloudWatch embedded
+    metric format line, so that Lambda turns the timings into metrics. The
+    namespace comes from the DATABASE_METRICS_NAMESPACE env var.
+    """
+    metrics = {}
+    for name, value in event.items():
+        if name.endswith("secs"):
+            metrics[name.replace("secs", "ms")] = (round(value * 1000, 3), "Milliseconds")
+        elif name == "rows":
+            metrics[name] = (value, "Count")
+    dimensions = ["event", "fingerprint"] if "fingerprint" in event else ["event"]
+    line = {"_aws": {"Timestamp": int(time.time() * 1000),
+                     "CloudWatchMetrics": [{
+                         "Namespace": os.environ.get("DATABASE_METRICS_NAMESPACE",
+                                                     "DisasterRecovery/Database"),
+                         "Dimensions": [dimensions],
+                         "Metrics": [{"Name": name, "Unit": unit}
+                                     for name, (_, unit) in metrics.items()]}]}}
+    line.update({name: event[name] for name in dimensions})
+    line.update({name: value for name, (value, _) in metrics.items()})
+    if "statement" in event:
+        line["statement"] = event["statement"]
+    sys.stdout.write(json.dumps(line) + "\n")
+
+
+_NAMED_SINKS = {"log": log_query_sink, "emf": emf_query_sink}
+
+
+def get_query_sinks():
+    """
+    Returns the list of query sinks. Until sinks are added or cleared it is
+    made from the comma separated names in the DATABASE_QUERY_SINKS env var,
+    "log" and/or "emf".
+    """
+    global _QUERY_SINKS     #pylint: disable-msg=global-statement
+    if _QUERY_SINKS is None:
+        names = os.environ.get("DATABASE_QUERY_SINKS", "")
+        _QUERY_SINKS = [_NAMED_SINKS[name.strip()] for name in names.split(",")
+                        if name.strip() in _NAMED_SINKS]
+    return _QUERY_SINKS
+
+
+def add_query_sink(sink):
+    """
+    Adds a callable that is called with a dict for every connect and query
+    event. A query event has the statement fingerprint, the normalized
+    statement, execute_secs, fetch_secs and rows.
+    """
+    get_query_sinks().append(sink)
+
+
+def remove_query_sink(sink):
+    """
+    Removes a sink added with add_query_sink().
+    """
+    sinks = get_query_sinks()
+    if sink in sinks:
+        sinks.remove(sink)
+
+
+def clear_query_sinks():
+    """
+    Removes all of the query sinks, including the ones from DATABASE_QUERY_SINKS.
+    """
+    global _QUERY_SINKS     #pylint: disable-msg=global-statement
+    _QUERY_SINKS = []
+
+
+def _emit(event):
+    """
+    Sends an event to each of the query sinks. A failing sink is logged, it
+    never fails the query.
+    """
+    for sink in get_query_sinks():
+        try:
+            sink(event)
+        except Exception:       #pylint: disable-msg=broad-except
+            LOGGER.exception(f"query sink {sink} failed")
+
+
+@functools.lru_cache(maxsize=256)
+def fingerprint(sql_stmt):
+    """
+    Returns a short hash of a statement with its whitespace normalized, and
+    the normalized statement.
+    """
+    statement = " ".join(sql_stmt.split())
+    return hashlib.sha1(statement.encode("utf-8")).hexdigest()[:12], statement
+
+
+def _record_query(sql_stmt, params, execute_secs, fetch_secs, rows):
+    """
+    Emits a query event, and logs the statement with a digest of its params
+    if it took longer than DATABASE_SLOW_QUERY_SECS (default 1).
+    """
+    query_fingerprint, statement = fingerprint(sql_stmt)
+    secs = execute_secs + fetch_secs
+    if secs >= _get_env_number("DATABASE_SLOW_QUERY_SECS", 1, float):
+        digest = hashlib.sha256(repr(params).encode("utf-8")).hexdigest()[:16]
+        LOGGER.warning(f"slow query {query_fingerprint} took {secs:.3f}s, {rows} rows. "
+                       f"params digest: {digest} sql: {statement}")
+    if get_query_sinks():
+        _emit({"event": "query", "fingerprint": query_fingerprint, "statement": statement,
+               "execute_secs": execute_secs, "fetch_secs": fetch_secs, "rows": rows})
+
+
+@contextmanager
+def get_connection(dbconnect_info, deadline=None):
+    """
+    Retrieves a connection from the connection pool and yields it. The
+    connection goes back to the pool afterwards. A connection attempt, or a
+    statement, that runs into the deadline, or that of query_deadline(),
+    raises QueryTimeout.
+    """
+    pool = None
+    connection = None
+    discard = False
+    deadline = _earliest(deadline, _DEADLINE.get())
+    get_circuit_breaker(dbconnect_info).check()
     try:
-        connection = psycopg2_connect(
-            host=dbconnect_info["db_host"],
-            port=db_port,
-            database=dbconnect_info["db_name"],
-            user=dbconnect_info["db_user"],
-            password=dbconnect_info["db_pw"]
-        )
+        start = time.perf_counter()
+        pool = get_pool(dbconnect_info)
+        if deadline is None:
+            connection = pool.getconn()
+        elif deadline > time.monotonic():
+            connection = pool.getconn(deadline - time.monotonic())
+        else:
+            raise QueryTimeout("Database Error. The query deadline has passed")
+        if get_query_sinks():
+            _emit({"event": "connect", "secs": time.perf_counter() - start})
         yield connection
 
+    except QueryTimeout:
+        raise
+
     except Exception as ex:
-        raise DbError(f"Database Error. {str(ex)}")
+        # a connection that failed like this is not reused. one whose
+        # statement was cancelled is fine.
+        discard = (isinstance(ex, (OperationalError, InterfaceError))
+                   and not isinstance(ex, QueryCanceled))
+        if _is_auth_failure(ex):
+            invalidate_db_connect_info(dbconnect_info)
+        if deadline is not None and _is_timeout(ex):
+            raise QueryTimeout(f"Database Error. {str(ex)}")
+        raise DbError(f"Database Error. {str(ex)}", retryable=is_retryable(ex))
 
     finally:
         if connection:
-            connection.close()
+            pool.putconn(connection, discard)
 
 
 @contextmanager
@@ -102,38 +934,249 @@ def get_cursor(dbconnect_info):
     with get_connection(dbconnect_info) as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         try:
-            yield cursor
-            conn.commit()
+            try:
+                yield cursor
+            except:
+                conn.rollback()
+                raise
 
-        except:
-            conn.rollback()
-            raise
+            try:
+                conn.commit()
+            except (OperationalError, InterfaceError) as err:
+                # the commit may have been applied before the connection was
+                # lost, so this is not safe to retry
+                raise DbError(str(err))
 
         finally:
             cursor.close()
 
 
 
-def single_query(sql_stmt, dbconnect_info, params=None):
+@contextmanager
+def transaction(dbconnect_info, deadline=None):
+    """
+    Yields a cursor for running several statements with multi_query() and
+    multi_values_query() on one connection, in one transaction. The
+    transaction is committed if no exception occurred, and rolled back
+    otherwise. Unlike get_cursor(), an exception raised by the caller is
+    re-raised as it is rather than wrapped in a DbError, so that errors such
+    as a bad request keep their type. psycopg2 errors are still wrapped.
+
+    The statements are limited by the deadline, as by query_deadline().
+    """
+    failure = None
+    try:
+        with query_deadline(deadline), get_cursor(dbconnect_info) as cursor:
+            try:
+                yield cursor
+            except Exception as ex:
+                failure = ex
+                raise
+
+    except DbError:
+        if failure is None or isinstance(failure, Psycopg2Error):
+            raise
+        raise failure from None
+
+
+def single_query(sql_stmt, dbconnect_info, params=None,   #pylint: disable-msg=too-many-arguments
+                 deadline=None, prepare_as=None):
     """
     This is a convenience function for running single statement transactions
     against the database. It will automatically commit the transaction and
     return a list of the rows.
 
+    Transient errors, such as a lost connection during a failover, are retried
+    with backoff, see backoff_delays(), unless the circuit breaker is open.
+    The statement and its retries are limited by the deadline, as by
+    query_deadline(), and raise QueryTimeout if they run into it.
+
+    A fixed statement that is run often can be given a name in prepare_as,
+    see multi_query().
+
     For multi-query transactions, see multi_query().
     """
-    rows = []
+    start = time.perf_counter()
+
+    def run():
+        with get_cursor(dbconnect_info) as cursor:
+            if prepare_as:
+                return _prepared_query(prepare_as, sql_stmt, params, cursor)
+            return _query(sql_stmt, params, cursor)
 
-    with get_cursor(dbconnect_info) as cursor:
-        rows = _query(sql_stmt, params, cursor)
+    with query_deadline(deadline):
+        rows = _with_retries(run, dbconnect_info)
 
+    if get_query_sinks():
+        query_fingerprint, statement = fingerprint(sql_stmt)
+        _emit({"event": "single_query", "fingerprint": query_fingerprint,
+               "statement": statement, "secs": time.perf_counter() - start,
+               "rows": len(rows)})
     return rows
 
 
+def values_query(sql_stmt, dbconnect_info, params_list,   #pylint: disable-msg=too-many-arguments
+                 template=None, page_size=1000, fetch=True, deadline=None):
+    """
+    This is a convenience function for running a statement with a single
+    VALUES %s placeholder, such as a multi-row INSERT, for every tuple in
+    params_list. The rows are sent page_size at a time, all in one
+    transaction that is automatically committed.
+
+    When fetch is True the statement must have a RETURNING clause, and the
+    returned rows of all the pages are returned as one list. Transient errors
+    are retried, and the deadline applied, in the same way as by single_query().
+    """
+    def run():
+        with get_cursor(dbconnect_info) as cursor:
+            return _values_query(sql_stmt, params_list, cursor, template, page_size, fetch)
+
+    with query_deadline(deadline):
+        return _with_retries(run, dbconnect_info)
+
+
+def batch_query(statements, dbconnect_info, page_size=100, deadline=None):
+    """
+    This is a convenience function for running a list of independent
+    statements, each a (sql_stmt, params) tuple, in one transaction that is
+    automatically committed, with as few round trips to the server as
+    possible. See multi_batch_query(). Transient errors are retried, and the
+    deadline applied, in the same way as by single_query().
+
+    Returns a list with, for each statement in order, a list of its rows, or
+    None if it is a statement that doesn't return rows.
+    """
+    statements = list(statements)
+
+    def run():
+        with get_cursor(dbconnect_info) as cursor:
+            return multi_batch_query(statements, cursor, page_size)
+
+    with query_deadline(deadline):
+        return _with_retries(run, dbconnect_info)
+
+
+def stream_query(sql_stmt, dbconnect_info, params=None,   #pylint: disable-msg=too-many-arguments
+                 itersize=None, deadline=None):
+    """
+    Runs a query on a named, server side cursor and yields the rows one at a
+    time, fetching them from the server itersize rows at a time, so that a
+    large result is never held in memory all at once. The default itersize
+    comes from the DATABASE_ITERSIZE env var, or 2000.
+
+    The connection is held until the generator is exhausted or closed. The
+    query and each of its fetches get a statement_timeout of the time left,
+    when the query starts, before the deadline, or that of the
+    query_deadline() in effect when stream_query() is called.
+    """
+    if itersize is None:
+        itersize = _get_env_number("DATABASE_ITERSIZE", 2000)
+    deadline = _earliest(deadline, _DEADLINE.get())
+    return _stream_query(sql_stmt, dbconnect_info, params, itersize, deadline)
+
+
+def _stream_query(sql_stmt, dbconnect_info, params, itersize, deadline):
+    """
+    The generator for stream_query().
+    """
+    with get_connection(dbconnect_info, deadline) as conn:
+        cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=RealDictCursor)
+        cursor.itersize = itersize
+        try:
+            try:
+                if deadline is not None:
+                    with conn.cursor() as timeout_cursor:
+                        _set_statement_timeout(timeout_cursor, deadline)
+                start = time.perf_counter()
+                cursor.execute(sql.SQL(sql_stmt), params)
+                execute_secs = time.perf_counter() - start
+                fetch_secs = 0.0
+                count = 0
+                rows = iter(cursor)
+                while True:
+                    start = time.perf_counter()
+                    row = next(rows, None)
+                    fetch_secs += time.perf_counter() - start
+                    if row is None:
+                        break
+                    count += 1
+                    yield row
+                _record_query(sql_stmt, params, execute_secs, fetch_secs, count)
+
+            except (ProgrammingError, DataError) as err:
+                LOGGER.exception(f"database error - {err}")
+                raise DbError("Internal database error, please contact LP DAAC User Services")
+
+            conn.commit()
+
+        except:
+            conn.rollback()
+            raise
+
+        finally:
+            _close_quietly(cursor)
+
+
+def listen(channel, dbconnect_info, poll_secs=1.0):
+    """
+    Runs LISTEN on a channel and yields the payload of each NOTIFY sent to it,
+    as it arrives, or None after poll_secs without one, so that the caller
+    can stop waiting or do other work. The connection is opened for the
+    listener alone, outside of the pool, since it is held until the generator
+    is closed, and is checked with a SELECT 1 every DATABASE_LISTEN_HEARTBEAT_SECS
+    (default 30) that it is idle, to find a lost connection.
+
+    Notifications sent while the listener was not connected are lost, so a
+    caller that needs every change should reread what it missed.
+
+    Raises DbError, retryable when the connection fails or is lost.
+    """
+    heartbeat_secs = _get_env_number("DATABASE_LISTEN_HEARTBEAT_SECS", 30, float)
+    remaining = remaining_secs()
+    if remaining is not None and remaining <= 0:
+        raise QueryTimeout("Database Error. The query deadline has passed")
+    try:
+        conn = _connect(dbconnect_info, remaining)
+    except Psycopg2Error as ex:
+        if _is_auth_failure(ex):
+            invalidate_db_connect_info(dbconnect_info)
+        raise DbError(f"Database Error. {str(ex)}", retryable=is_retryable(ex))
+    return _listen(conn, channel, poll_secs, heartbeat_secs)
+
+
+def _listen(conn, channel, poll_secs, heartbeat_secs):
+    """
+    The generator for listen().
+    """
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            idle_since = time.monotonic()
+            while True:
+                if select.select([conn], [], [], poll_secs) == ([], [], []):
+                    if time.monotonic() - idle_since >= heartbeat_secs:
+                        cursor.execute("SELECT 1")
+                        idle_since = time.monotonic()
+                    yield None
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    yield conn.notifies.pop(0).payload
+                idle_since = time.monotonic()
+
+    except (OperationalError, InterfaceError) as ex:
+        raise DbError(f"Database Error. {str(ex)}", retryable=True)
+
+    finally:
+        _close_quietly(conn)
+
+
 def read_db_connect_info(param_source):
     """
     This function will retrieve database connection parameters from
-    the parameter store and/or env vars.
+    the parameter store and/or env vars. All of the parameter store values
+    that aren't already cached are read with one get_parameters call.
 
         Args:
             param_source (dict): A dict containing
@@ -154,67 +1197,293 @@ def read_db_connect_info(param_source):
                 "db_user": value,
                 "db_pw": value
     """
+    ssm_names = []
+    for source in param_source.values():
+        for env_or_ssm, param_name in source.items():
+            if env_or_ssm == "ssm":
+                ssm_names.append(param_name)
+    ssm_values = get_ssm_parameters(ssm_names)
+
     dbconnect_info = {}
-    host_info = param_source["db_host"]
-    for key in host_info:
-        val = host_info[key]
-        dbconnect_info["db_host"] = get_db_connect_info(key, val, False)
-
-    port_info = param_source["db_port"]
-    for key in port_info:
-        val = port_info[key]
-        dbconnect_info["db_port"] = int(get_db_connect_info(key, val, False))
-
-    name_info = param_source["db_name"]
-    for key in name_info:
-        val = name_info[key]
-        dbconnect_info["db_name"] = get_db_connect_info(key, val, False)
-
-    user_info = param_source["db_user"]
-    for key in user_info:
-        val = user_info[key]
-        dbconnect_info["db_user"] = get_db_connect_info(key, val, False)
-
-    pw_info = param_source["db_pw"]
-    for key in pw_info:
-        val = pw_info[key]
-        dbconnect_info["db_pw"] = get_db_connect_info(key, val, True)
+    for key, source in param_source.items():
+        for env_or_ssm, param_name in source.items():
+            if env_or_ssm == "ssm":
+                dbconnect_info[key] = ssm_values[param_name]
+            else:
+                dbconnect_info[key] = os.environ[param_name]
+    dbconnect_info["db_port"] = int(dbconnect_info["db_port"])
 
     return dbconnect_info
 
 
-def get_db_connect_info(env_or_ssm, param_name, decrypt=False):
+def reader_connect_info(dbconnect_info):
+    """
+    Returns the connect info for the read replica named by the optional
+    "db_reader_host" in dbconnect_info, or dbconnect_info itself if there
+    isn't one. The replica gets its own connection pool and circuit breaker,
+    since those are kept per host.
+    """
+    reader_host = dbconnect_info.get("db_reader_host")
+    if not reader_host:
+        return dbconnect_info
+    return dict(dbconnect_info, db_host=reader_host)
+
+
+def get_db_connect_info(env_or_ssm, param_name, decrypt=False):   #pylint: disable-msg=unused-argument
     """
     This function will retrieve a database connection parameter from
-    the parameter store or an env var.
+    the parameter store or an env var. Parameter store values are always
+    read with decryption, which has no effect on plain String parameters.
     """
     param_value = None
     if env_or_ssm == "ssm":
-        ssm = boto3.client('ssm')
-        if decrypt:
-            parameter = ssm.get_parameter(Name=param_name, WithDecryption=True)
-        else:
-            parameter = ssm.get_parameter(Name=param_name)
-        param_value = parameter['Parameter']['Value']
+        param_value = get_ssm_parameters([param_name])[param_name]
     else:
         param_value = os.environ[param_name]
 
     return param_value
 
 
-def multi_query(sql_stmt, params, cursor):
+def get_ssm_parameters(param_names):
+    """
+    Returns a dict of parameter store values by name. Values are cached for
+    DATABASE_CONNECT_INFO_TTL_SECS (default 300) seconds, or until
+    invalidate_db_connect_info() is called, and the uncached ones are read
+    in batches of up to 10 per get_parameters call.
+
+    Raises DbError if any of the parameters don't exist.
+    """
+    now = time.monotonic()
+    values = {}
+    missing = []
+    for name in param_names:
+        cached = _SSM_CACHE.get(name)
+        if cached and cached[1] > now:
+            values[name] = cached[0]
+        elif name not in missing:
+            missing.append(name)
+
+    if missing:
+        expires = now + _get_env_number("DATABASE_CONNECT_INFO_TTL_SECS", 300, float)
+        ssm = get_ssm_client()
+        for start in range(0, len(missing), 10):
+            response = ssm.get_parameters(Names=missing[start:start + 10],
+                                          WithDecryption=True)
+            if response.get("InvalidParameters"):
+                raise DbError(f"Parameters not found in parameter store: "
+                              f"{response['InvalidParameters']}")
+            for parameter in response["Parameters"]:
+                values[parameter["Name"]] = parameter["Value"]
+                _SSM_CACHE[parameter["Name"]] = (parameter["Value"], expires)
+
+    return values
+
+
+def get_ssm_client():
+    """
+    Returns the SSM client, creating it once per process.
+    """
+    global _SSM_CLIENT          #pylint: disable-msg=global-statement
+    if _SSM_CLIENT is None:
+        _SSM_CLIENT = boto3.client('ssm')
+    return _SSM_CLIENT
+
+
+def invalidate_db_connect_info(dbconnect_info=None):
+    """
+    Forgets the cached parameter store values, so that the next
+    read_db_connect_info() reads them again. This is done automatically
+    when a connection fails to authenticate, such as after a password
+    rotation, when the pool for the dbconnect_info that failed is closed
+    and forgotten too.
+    """
+    _SSM_CACHE.clear()
+    if dbconnect_info is not None:
+        key = _pool_key(dbconnect_info)
+        with _POOLS_LOCK:
+            _forget_pools(_POOLS, lambda other: other == key)
+
+
+def multi_query(sql_stmt, params, cursor, prepare_as=None):
     """
     This function will use the provided cursor to run the query instead of
     retreiving one itself. This is intended to be used when the caller wants
     to make a query that doesn't automatically commit and close the cursor.
     Like single_query(), this will return the rows as a list.
 
+    A fixed statement that is run often can be given a name in prepare_as.
+    It is then prepared, as that named prepared statement, the first time it
+    is run on each pooled connection, and after that only executed, which
+    saves the server parsing and planning it every time. The statement may
+    only have positional %s placeholders, and the name must be a plain
+    identifier that always goes with the same sql_stmt. A statement with a
+    %s placeholder inside a quoted literal or a comment, which PREPARE can't
+    number, is run plainly.
+
+    Prepared statements belong to a server session, so they are not used when
+    the DATABASE_PREPARED_STATEMENTS env var is false, nor, on a connection,
+    once one is found to be missing or already prepared there, as happens
+    behind a proxy that pools connections by transaction. PREPARE is run in a
+    savepoint, so one that fails leaves the transaction as it was, and the
+    statement is run plainly. A prepared statement found missing by EXECUTE
+    has aborted the transaction, and fails with a DbError that is retryable,
+    as by single_query(), only if it was the first statement of the
+    transaction.
+
     This function should be used within a context made by get_cursor().
     """
 
+    if prepare_as:
+        return _prepared_query(prepare_as, sql_stmt, params, cursor)
     return _query(sql_stmt, params, cursor)
 
 
+def _prepared_query(name, sql_stmt, params, cursor):
+    """
+    Runs a statement as the named prepared statement, preparing it first if
+    the cursor's connection hasn't yet, or as a plain statement if prepared
+    statements are not in use.
+    """
+    conn = cursor.connection
+    prepared = _PREPARED.setdefault(conn, set())
+    if prepared is None or os.getenv("DATABASE_PREPARED_STATEMENTS",
+                                     "true").lower() in ("false", "0", "no", "off"):
+        return _query(sql_stmt, params, cursor)
+
+    first = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    if name not in prepared:
+        numbered = _number_placeholders(sql_stmt)
+        if numbered is None:
+            return _query(sql_stmt, params, cursor)
+        try:
+            cursor.execute(f"SAVEPOINT prepare_{name}; PREPARE {name} AS {numbered}; "
+                           f"RELEASE SAVEPOINT prepare_{name}")
+        except (ProgrammingError, DataError) as err:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT prepare_{name}")
+            LOGGER.warning(f"not using prepared statements on this connection: {str(err)}")
+            _PREPARED[conn] = None
+            return _query(sql_stmt, params, cursor)
+        prepared.add(name)
+    try:
+        placeholders = ", ".join(["%s"] * len(params or ()))
+        return _query(f"EXECUTE {name} ({placeholders})" if placeholders else f"EXECUTE {name}",
+                      params, cursor)
+
+    except InvalidSqlStatementName as err:
+        LOGGER.warning(f"not using prepared statements on this connection: {str(err)}")
+        _PREPARED[conn] = None
+        raise DbError(str(err), retryable=first)
+
+    except (ProgrammingError, DataError) as err:
+        LOGGER.exception(f"database error - {err}")
+        raise DbError("Internal database error, please contact LP DAAC User Services")
+
+
+def _number_placeholders(sql_stmt):
+    """
+    Returns the statement with its %s placeholders numbered $1, $2, ... for
+    PREPARE, and any %% unescaped, or None if it has a %s placeholder inside
+    a quoted literal or a comment, where psycopg2 would have put the value
+    but PREPARE can't.
+    """
+    numbers = itertools.count(1)
+    quoted = []
+
+    def number(match):
+        token = match.group()
+        if token == "%s":
+            return f"${next(numbers)}"
+        if token == "%%":
+            return "%"
+        if "%s" in _PLACEHOLDERS.findall(token):
+            quoted.append(token)
+        return token.replace("%%", "%")
+
+    numbered = _SQL_TOKENS.sub(number, sql_stmt)
+    return None if quoted else numbered
+
+
+def multi_values_query(sql_stmt, params_list, cursor,   #pylint: disable-msg=too-many-arguments
+                       template=None, page_size=1000, fetch=True):
+    """
+    The values_query() counterpart of multi_query(). Runs the statement for
+    every tuple in params_list on the provided cursor, without committing.
+    """
+
+    return _values_query(sql_stmt, params_list, cursor, template, page_size, fetch)
+
+
+def multi_batch_query(statements, cursor, page_size=100):
+    """
+    The batch_query() counterpart of multi_query(). Runs the (sql_stmt,
+    params) statements on the provided cursor, without committing, sending
+    up to page_size of them to the server in each round trip.
+
+    As with execute_batch(), the statements of a page are interpolated on
+    the client and sent as one string, so only the rows of the last one can
+    be fetched. A statement that returns rows, one that starts with SELECT,
+    WITH, VALUES, TABLE, SHOW or EXPLAIN, or that has a RETURNING clause,
+    therefore ends its page.
+
+    Returns a list with, for each statement in order, a list of its rows, or
+    None if it is a statement that doesn't return rows.
+    """
+    results = []
+    for page in _batch_pages(statements, page_size):
+        _set_statement_timeout(cursor, _DEADLINE.get())
+        try:
+            start = time.perf_counter()
+            cursor.execute(_batch_sql(page, cursor))
+
+        except (ProgrammingError, DataError) as err:
+            LOGGER.exception(f"database error - {err}")
+            raise DbError("Internal database error, please contact LP DAAC User Services")
+
+        executed = time.perf_counter()
+        rows = cursor.fetchall() if cursor.description is not None else None
+        results.extend(_record_batch(page, rows, executed - start,
+                                     time.perf_counter() - executed))
+    return results
+
+
+def _batch_pages(statements, page_size):
+    """
+    Yields the (sql_stmt, params) statements in pages of up to page_size,
+    where a statement that returns rows ends its page.
+    """
+    page = []
+    for sql_stmt, params in statements:
+        page.append((sql_stmt, params))
+        if len(page) >= page_size or _RETURNS_ROWS.search(sql_stmt):
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _batch_sql(page, cursor):
+    """
+    Returns the statements of a page, interpolated by the cursor, as one
+    string. They are separated by newlines too, so that a trailing comment
+    can't swallow the statement after it.
+    """
+    return b";\n".join(cursor.mogrify(sql_stmt, params) for sql_stmt, params in page)
+
+
+def _record_batch(page, rows, execute_secs, fetch_secs):
+    """
+    Records a query event for each statement of a page, with the time of the
+    page split between them, and returns their results: None for all but the
+    last, which gets the rows.
+    """
+    row_count = len(rows) if rows is not None else 0
+    for sql_stmt, params in page[:-1]:
+        _record_query(sql_stmt, params, execute_secs / len(page), 0.0, 0)
+    sql_stmt, params = page[-1]
+    _record_query(sql_stmt, params, execute_secs / len(page), fetch_secs, row_count)
+    return [None] * (len(page) - 1) + [rows]
+
+
 def _query(sql_stmt, params, cursor):
     """
     Wrapper for running queries that will automatically handle errors in a
@@ -223,13 +1492,16 @@ def _query(sql_stmt, params, cursor):
     Returns the result of the query returned by fetchall()
     """
 
+    _set_statement_timeout(cursor, _DEADLINE.get())
     try:
+        start = time.perf_counter()
         cursor.execute(sql.SQL(sql_stmt), params)
 
     except (ProgrammingError, DataError) as err:
         LOGGER.exception(f"database error - {err}")
         raise DbError("Internal database error, please contact LP DAAC User Services")
 
+    executed = time.perf_counter()
     try:
         rows = cursor.fetchall()
 
@@ -237,34 +1509,155 @@ def _query(sql_stmt, params, cursor):
         # no results, return an empty list
         rows = []
 
+    _record_query(sql_stmt, params, executed - start, time.perf_counter() - executed, len(rows))
     return rows
 
-def return_connection(dbconnect_info):
+def copy_rows(table, columns, rows, cursor):
     """
-    Retrieves a connection from the connection pool.
+    Loads rows, an iterable of tuples in the order of columns, into a table
+    with COPY FROM STDIN on the provided cursor, without committing. The
+    rows are taken from the iterable as COPY reads them, so a large load is
+    never held in memory all at once. None, and the empty string, are loaded
+    as NULL.
+
+    Returns the number of rows loaded.
     """
-    # create a connection
-    connection = None
+    stmt = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.Identifier(*table.split(".")),
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns))
+    stream = _CsvStream(rows)
+    _set_statement_timeout(cursor, _DEADLINE.get())
     try:
-        db_port = dbconnect_info["db_port"]
-    except ValueError:
-        db_port = 5432
+        start = time.perf_counter()
+        cursor.copy_expert(stmt, stream, size=_COPY_CHUNK_SIZE)
+
+    except (ProgrammingError, DataError) as err:
+        LOGGER.exception(f"database error - {err}")
+        raise DbError("Internal database error, please contact LP DAAC User Services")
+
+    if stream.error:
+        # the rows that were loaded are rolled back with the caller's transaction
+        raise stream.error
+
+    _record_query(f"COPY {table} ({', '.join(columns)}) FROM STDIN", None,
+                  time.perf_counter() - start, 0.0, stream.count)
+    return stream.count
+
+
+def copy_query(sql_stmt, dbconnect_info, out, params=None,   #pylint: disable-msg=too-many-arguments
+               header=True, deadline=None):
+    """
+    Runs a query with COPY TO STDOUT and writes its rows to out, a writable
+    file, as csv with a header line of the column names unless header is
+    False. The server sends the rows as it reads them, and psycopg2 writes
+    them to out as they arrive, so a large result is never held in memory.
+    out may be a text file, or a binary one that is written utf-8 bytes.
+
+    Unlike single_query(), a transient error is not retried, since some of
+    the rows may already have been written. The query is limited by the
+    deadline, as by query_deadline().
+
+    Returns the number of rows written.
+    """
+    options = "FORMAT csv, HEADER" if header else "FORMAT csv"
+    with query_deadline(deadline), get_cursor(dbconnect_info) as cursor:
+        stmt = f"COPY ({cursor.mogrify(sql_stmt, params).decode()}) TO STDOUT WITH ({options})"
+        _set_statement_timeout(cursor, _DEADLINE.get())
+        try:
+            start = time.perf_counter()
+            cursor.copy_expert(stmt, out, size=_COPY_CHUNK_SIZE)
+
+        except (ProgrammingError, DataError) as err:
+            LOGGER.exception(f"database error - {err}")
+            raise DbError("Internal database error, please contact LP DAAC User Services")
+
+        _record_query(f"COPY ({sql_stmt}) TO STDOUT", params, time.perf_counter() - start, 0.0,
+                      cursor.rowcount)
+        return cursor.rowcount
+
+
+class _CsvStream(io.TextIOBase):
+    """
+    A file that copy_expert() reads rows from as csv, formatting them from
+    the iterable as they are read. An exception raised by the iterable ends
+    the data early, and is kept in error for copy_rows() to raise, rather
+    than being turned into a failed COPY by psycopg2.
+    """
 
+    def __init__(self, rows):
+        super().__init__()
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator="\n")
+        self.count = 0
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or self._buffer.tell() < size:
+                rows = list(itertools.islice(self._rows, _COPY_BATCH_ROWS))
+                if not rows:
+                    break
+                self._writer.writerows(rows)
+                self.count += len(rows)
+        except Exception as ex:     #pylint: disable-msg=broad-except
+            self.error = ex
+            return ""
+        data = self._buffer.getvalue()
+        rest = ""
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(rest)
+        return data
+
+
+def _values_query(sql_stmt, params_list, cursor,   #pylint: disable-msg=too-many-arguments
+                  template, page_size, fetch):
+    """
+    Wrapper for running execute_values that will automatically handle errors
+    in the same manner as _query().
+    """
+    _set_statement_timeout(cursor, _DEADLINE.get())
     try:
-        connection = psycopg2_connect(
-            host=dbconnect_info["db_host"],
-            port=db_port,
-            database=dbconnect_info["db_name"],
-            user=dbconnect_info["db_user"],
-            password=dbconnect_info["db_pw"]
-        )
-        return connection
+        start = time.perf_counter()
+        rows = execute_values(cursor, sql_stmt, params_list, template=template,
+                              page_size=page_size, fetch=fetch)
+
+    except (ProgrammingError, DataError) as err:
+        LOGGER.exception(f"database error - {err}")
+        raise DbError("Internal database error, please contact LP DAAC User Services")
+
+    rows = rows if fetch else []
+    _record_query(sql_stmt, params_list, time.perf_counter() - start, 0.0, len(rows))
+    return rows
+
+def return_connection(dbconnect_info):
+    """
+    Retrieves a connection from the connection pool. The caller either
+    closes it or hands it back with release_connection().
+    """
+    try:
+        return get_pool(dbconnect_info).getconn()
 
     except Exception as ex:
+        if _is_auth_failure(ex):
+            invalidate_db_connect_info(dbconnect_info)
         LOGGER.exception(f"Exception. {str(ex)}")
         raise DbError(f"Database Error. {str(ex)}")
 
 
+def release_connection(dbconnect_info, connection):
+    """
+    Returns a connection obtained from return_connection() to the pool.
+    """
+    get_pool(dbconnect_info).putconn(connection)
+
+
 def return_cursor(conn):
     """
     Retrieves the cursor from the connection.
@@ -0,0 +1,80 @@
+"""
+Name: benchmark_convert_rows.py
+
+Description:  Microbenchmark comparing the json round trip that result_to_json
+used to make with database.convert_rows, on a result the size of a large
+request_status read. Not collected by the unit tests, run it directly:
+
+    cd tasks/pg_utils
+    python test/benchmark_convert_rows.py [rows]
+"""
+
+import datetime
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+
+from psycopg2.extras import RealDictRow
+
+import database
+
+COLUMNS = ["request_id", "request_group_id", "granule_id", "object_key", "job_type",
+           "restore_bucket_dest", "archive_bucket_dest", "job_status", "request_time",
+           "last_update_time", "err_msg"]
+
+
+def build_rows(count):
+    """
+    builds count rows like the ones psycopg2 returns for request_status
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    group_id = str(uuid.uuid4())
+    rows = []
+    for idx in range(count):
+        rows.append(RealDictRow(zip(COLUMNS, [str(uuid.uuid4()), group_id,
+                                              f"granule_{idx}", f"objectkey_{idx}",
+                                              "restore", "my-restore-bucket",
+                                              "my-archive-bucket", "inprogress",
+                                              now, now, None])))
+    return rows
+
+
+def json_round_trip(rows):
+    """
+    the conversion result_to_json made before convert_rows
+    """
+    return json.loads(json.dumps(rows, default=database.myconverter))
+
+
+def measure(name, convert, count):
+    """
+    times one conversion of a fresh result, and traces its peak memory
+    """
+    rows = build_rows(count)
+    tracemalloc.start()
+    start_cpu = time.process_time()
+    result = convert(rows)
+    cpu_secs = time.process_time() - start_cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<22} cpu: {cpu_secs:7.3f}s  peak memory: {peak / 1024 / 1024:8.1f} MiB")
+    return result
+
+
+def main(count):
+    """
+    runs the conversions and prints the cpu time and peak memory of each
+    """
+    print(f"converting {count} rows")
+    expected = measure("json round trip", json_round_trip, count)
+    result = measure("convert_rows dict", database.convert_rows, count)
+    assert len(expected) == len(result)
+    assert expected[0].keys() == result[0].keys()
+    measure("convert_rows tuple", lambda rows: database.convert_rows(rows, "tuple"), count)
+    measure("convert_rows record", lambda rows: database.convert_rows(rows, "record"), count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
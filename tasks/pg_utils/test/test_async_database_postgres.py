@@ -0,0 +1,211 @@
+"""
+Name: test_async_database_postgres.py
+
+Description:  Unit tests for async_database.py that hit a postgres db running in docker.
+"""
+
+import asyncio
+import os
+import time
+import unittest
+
+import async_database
+import database
+import db_config
+from database import DbError
+
+
+class TestAsyncDatabasePostgres(unittest.TestCase):
+    """
+    TestAsyncDatabasePostgres.
+    """
+
+    def setUp(self):
+        private_config = f"{os.path.realpath(__file__)}".replace(os.path.basename(__file__),
+                                                                 'private_config.json')
+        db_config.set_env(private_config)
+        self.dbconnect_info = {"db_host": os.environ["DATABASE_HOST"],
+                               "db_port": int(os.environ["DATABASE_PORT"]),
+                               "db_name": os.environ["DATABASE_NAME"],
+                               "db_user": os.environ["DATABASE_USER"],
+                               "db_pw": os.environ["DATABASE_PW"]}
+        async_database.close_pools()
+
+    def tearDown(self):
+        async_database.close_pools()
+        database.close_pools()
+        os.environ.pop("DATABASE_POOL_MAX_SIZE", None)
+
+    def test_single_query(self):
+        """
+        Tests running a query with params
+        """
+        rows = asyncio.run(async_database.single_query(
+            "SELECT %s::int AS num, %s::text AS txt", self.dbconnect_info, (1, "a")))
+        self.assertEqual([{"num": 1, "txt": "a"}], rows)
+
+    def test_single_query_error(self):
+        """
+        Tests that a bad statement raises the same DbError as database.single_query
+        """
+        exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        try:
+            asyncio.run(async_database.single_query("SELECT * FROM nosuchtable",
+                                                    self.dbconnect_info))
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual(exp_err, str(err))
+        try:
+            database.single_query("SELECT * FROM nosuchtable", self.dbconnect_info)
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual(exp_err, str(err))
+
+    def test_connect_error(self):
+        """
+        Tests a connection failure
+        """
+        dbconnect_info = dict(self.dbconnect_info, db_name="nosuchdatabase")
+        try:
+            asyncio.run(async_database.single_query("SELECT 1", dbconnect_info))
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertIn("Database Error.", str(err))
+            self.assertIn("nosuchdatabase", str(err))
+
+    def test_circuit_breaker(self):
+        """
+        Tests that an open circuit breaker fails fast without connecting
+        """
+        breaker = database.get_circuit_breaker(self.dbconnect_info)
+        for _ in range(breaker.threshold):
+            breaker.record(False)
+        try:
+            asyncio.run(async_database.single_query("SELECT 1", self.dbconnect_info))
+            self.fail("expected CircuitOpenError")
+        except database.CircuitOpenError as err:
+            self.assertIn("The database is unavailable", str(err))
+        self.assertEqual(0, async_database.get_pool_stats()["misses"])
+        breaker.opened_at -= breaker.cooldown_secs
+        rows = asyncio.run(async_database.single_query("SELECT 1 AS num", self.dbconnect_info))
+        self.assertEqual([{"num": 1}], rows)
+        self.assertIsNone(breaker.opened_at)
+
+    def test_deadline(self):
+        """
+        Tests that a statement that runs into its deadline is cancelled, and
+        that the pooled connection is still usable afterwards
+        """
+        for single_query in [database.single_query, async_database.single_query]:
+            start = time.monotonic()
+            try:
+                result = single_query("SELECT pg_sleep(5)", self.dbconnect_info,
+                                      deadline=start + 0.3)
+                if asyncio.iscoroutine(result):
+                    asyncio.run(result)
+                self.fail("expected QueryTimeout")
+            except database.QueryTimeout:
+                pass
+            self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual([{"num": 1}], database.single_query("SELECT 1 AS num",
+                                                             self.dbconnect_info))
+        self.assertEqual([{"num": 1}], asyncio.run(async_database.single_query(
+            "SELECT 1 AS num", self.dbconnect_info)))
+
+    def test_values_query(self):
+        """
+        Tests a multi-row statement sent in pages
+        """
+        params_list = [(1, "a"), (2, "b'c"), (3, None)]
+        rows = asyncio.run(async_database.values_query(
+            "SELECT * FROM (VALUES %s) AS v (num, txt)", self.dbconnect_info,
+            params_list, page_size=2))
+        self.assertEqual([{"num": 1, "txt": "a"}, {"num": 2, "txt": "b'c"},
+                          {"num": 3, "txt": None}], rows)
+
+    def test_transaction(self):
+        """
+        Tests that a transaction commits, and rolls back on an error
+        """
+        # one pooled connection, so that every statement sees the temp table
+        os.environ["DATABASE_POOL_MAX_SIZE"] = "1"
+
+        async def run():
+            async with async_database.transaction(self.dbconnect_info) as cursor:
+                await cursor.query("CREATE TEMP TABLE async_test (id int)")
+                await cursor.query("INSERT INTO async_test VALUES (1)")
+            try:
+                async with async_database.transaction(self.dbconnect_info) as cursor:
+                    await cursor.query("INSERT INTO async_test VALUES (2)")
+                    await cursor.query("SELECT * FROM nosuchtable")
+            except DbError:
+                pass
+            rows = await async_database.single_query("SELECT id FROM async_test",
+                                                     self.dbconnect_info)
+            await async_database.single_query("DROP TABLE async_test", self.dbconnect_info)
+            return rows
+
+        self.assertEqual([{"id": 1}], asyncio.run(run()))
+
+    def test_batch_query(self):
+        """
+        Tests running a batch of statements in a transaction, and on its own
+        """
+        # one pooled connection, so that every statement sees the temp table
+        os.environ["DATABASE_POOL_MAX_SIZE"] = "1"
+        statements = [("INSERT INTO batch_test VALUES (%s, %s)", (1, "a;b")),
+                      ("INSERT INTO batch_test VALUES (%s, %s)", (2, "it's")),
+                      ("UPDATE batch_test SET txt = upper(txt) WHERE id = %s", (1,)),
+                      ("SELECT id, txt FROM batch_test ORDER BY id", None),
+                      ("DELETE FROM batch_test WHERE id = %s RETURNING id", (2,))]
+        exp_result = [None, None, None, [{"id": 1, "txt": "A;B"}, {"id": 2, "txt": "it's"}],
+                      [{"id": 2}]]
+        with database.transaction(self.dbconnect_info) as cursor:
+            database.multi_query("CREATE TEMP TABLE batch_test (id int, txt text)", None,
+                                 cursor)
+            self.assertEqual(exp_result, database.multi_batch_query(statements, cursor,
+                                                                    page_size=2))
+            database.multi_query("DROP TABLE batch_test", None, cursor)
+
+        async def run():
+            await async_database.single_query("CREATE TEMP TABLE batch_test (id int, txt text)",
+                                              self.dbconnect_info)
+            result = await async_database.batch_query(statements, self.dbconnect_info)
+            await async_database.single_query("DROP TABLE batch_test", self.dbconnect_info)
+            return result
+
+        self.assertEqual(exp_result, asyncio.run(run()))
+
+    def test_concurrent_queries(self):
+        """
+        Tests that queries overlap, and wait for a connection when the pool is full
+        """
+        os.environ["DATABASE_POOL_MAX_SIZE"] = "2"
+
+        async def run():
+            return await asyncio.gather(*[
+                async_database.single_query("SELECT pg_sleep(0.2)", self.dbconnect_info)
+                for _ in range(4)])
+
+        start = time.monotonic()
+        self.assertEqual(4, len(asyncio.run(run())))
+        elapsed = time.monotonic() - start
+        self.assertLess(elapsed, 0.7)
+        self.assertGreaterEqual(elapsed, 0.4)
+        stats = async_database.get_pool_stats()
+        self.assertEqual(2, stats["misses"])
+        self.assertGreater(stats["waits"], 0)
+
+    def test_pool_survives_event_loops(self):
+        """
+        Tests that a pooled connection is reused by a later event loop
+        """
+        asyncio.run(async_database.single_query("SELECT 1", self.dbconnect_info))
+        asyncio.run(async_database.single_query("SELECT 1", self.dbconnect_info))
+        stats = async_database.get_pool_stats()
+        self.assertEqual(1, stats["misses"])
+        self.assertEqual(1, stats["hits"])
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['start'])
@@ -4,14 +4,24 @@ Name: test_requests.py
 Description:  Unit tests for requests_db.py.
 """
 
+import collections
+import contextlib
 import datetime
+import io
+import itertools
+import json
 import os
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import MagicMock, Mock
 import uuid
 
 import boto3
 import psycopg2.extras
+from psycopg2.errors import (InvalidSqlStatementName,       #pylint: disable-msg=no-name-in-module
+                             QueryCanceled)
+from psycopg2.extensions import (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS,
+                                 TRANSACTION_STATUS_UNKNOWN)
 
 import database
 from database import DbError
@@ -30,8 +40,15 @@ class TestDatabase(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         os.environ["DATABASE_NAME"] = "sndbx"
         os.environ["DATABASE_USER"] = "unittestdbuser"
         os.environ["DATABASE_PW"] = "unittestdbpw"
+        # no retries, unless a test sets a deadline
+        os.environ["DATABASE_RETRY_DEADLINE_SECS"] = "0"
 
         self.mock_single_query = database.single_query
+        self.mock_connect = database.psycopg2_connect
+        self.mock_uniform = database.random.uniform
+        self.mock_monotonic = database.time.monotonic
+        self.mock_select = database.select.select
+        database.close_pools()
         self.mock_utcnow = database.get_utc_now_iso
         self.mock_uuid = database.uuid_generator
         self.mock_boto3 = boto3.client
@@ -41,6 +58,9 @@ class TestDatabase(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         db_pw = {"Parameter": {"Value": os.environ['DATABASE_PW']}}
         s3_cli.get_parameter = Mock(side_effect=[db_host,
                                                  db_pw])
+        s3_cli.get_parameters = Mock(side_effect=self.mock_get_parameters)
+        database.invalidate_db_connect_info()
+        database._SSM_CLIENT = s3_cli           #pylint: disable-msg=protected-access
         db_params = {}
         db_params["db_host"] = {"ssm": "drdb-host"}
         db_params["db_port"] = {"env": "DATABASE_PORT"}
@@ -51,9 +71,21 @@ class TestDatabase(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
 
     def tearDown(self):
         boto3.client = self.mock_boto3
+        database.invalidate_db_connect_info()
+        database._SSM_CLIENT = None             #pylint: disable-msg=protected-access
         database.single_query = self.mock_single_query
         database.get_utc_now_iso = self.mock_utcnow
         database.uuid_generator = self.mock_uuid
+        database.psycopg2_connect = self.mock_connect
+        database.select.select = self.mock_select
+        database.close_pools()
+        database._QUERY_SINKS = None            #pylint: disable-msg=protected-access
+        os.environ.pop("DATABASE_QUERY_SINKS", None)
+        os.environ.pop("DATABASE_SLOW_QUERY_SECS", None)
+        os.environ.pop("DATABASE_RETRY_DEADLINE_SECS", None)
+        os.environ.pop("DATABASE_BREAKER_THRESHOLD", None)
+        os.environ.pop("DATABASE_PREPARED_STATEMENTS", None)
+        os.environ.pop("DATABASE_LISTEN_HEARTBEAT_SECS", None)
         del os.environ["DATABASE_HOST"]
         del os.environ["DATABASE_PORT"]
         del os.environ["DATABASE_NAME"]
@@ -76,6 +108,45 @@ class TestDatabase(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
         database.uuid_generator = Mock(return_value=UUID1)
         self.assertEqual(UUID1, database.uuid_generator())
 
+    def test_convert_rows(self):
+        """
+        Tests converting rows to dicts, tuples and records
+        """
+        when = datetime.datetime(2019, 7, 31, 18, 5, 19, 161362, tzinfo=datetime.timezone.utc)
+        request_id = uuid.UUID(UUID1)
+        exp_dict = {"request_id": UUID1, "job_status": "complete",
+                    "request_time": "2019-07-31 18:05:19.161362+00:00",
+                    "request_date": "2019-07-31", "err_msg": None, "retries": 2}
+        exp_values = (UUID1, "complete", "2019-07-31 18:05:19.161362+00:00",
+                      "2019-07-31", None, 2)
+
+        def rows():
+            return [psycopg2.extras.RealDictRow([("request_id", request_id),
+                                                 ("job_status", "complete"),
+                                                 ("request_time", when),
+                                                 ("request_date", when.date()),
+                                                 ("err_msg", None), ("retries", 2)])]
+
+        in_rows = rows()
+        result = database.result_to_json(in_rows)
+        self.assertEqual([exp_dict], result)
+        self.assertIs(in_rows[0], result[0])
+        self.assertEqual(exp_dict, database.convert_rows(rows()[0]))
+
+        self.assertEqual([exp_values], database.convert_rows(rows(), "tuple"))
+
+        result = database.convert_rows(rows(), "record")
+        self.assertEqual([exp_values], result)
+        self.assertEqual(UUID1, result[0].request_id)
+        self.assertEqual("complete", result[0].job_status)
+        self.assertFalse(hasattr(result[0], "__dict__"))
+
+        try:
+            database.convert_rows(rows(), "xml")
+            self.fail("expected ValueError")
+        except ValueError as err:
+            self.assertEqual("unknown row_format: xml", str(err))
+
     def test_get_connection(self):
         """
         Tests getting a database connection
@@ -153,6 +224,817 @@ class TestDatabase(unittest.TestCase):  #pylint: disable-msg=too-many-public-met
             self.assertEqual(exp_err, str(err))
 
 
+    def test_pool_reuses_connection(self):
+        """
+        Tests that consecutive queries reuse one pooled connection
+        """
+        conn = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        sql_stmt = 'Select * from mytable'
+        database.single_query(sql_stmt, self.dbconnect_info)
+        database.single_query(sql_stmt, self.dbconnect_info)
+        database.psycopg2_connect.assert_called_once()
+        self.assertEqual(2, conn.commit.call_count)
+        conn.close.assert_not_called()
+        stats = database.get_pool_stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_pool_discards_broken_connection(self):
+        """
+        Tests that a connection that was closed while idle is not handed out
+        """
+        conn1 = self.mock_connection()
+        conn2 = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn1, conn2])
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn1, con)
+        conn1.closed = 2
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn2, con)
+        conn2.get_transaction_status = Mock(return_value=TRANSACTION_STATUS_UNKNOWN)
+        conn3 = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn3])
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn3, con)
+        stats = database.get_pool_stats()
+        self.assertEqual(0, stats["hits"])
+        self.assertEqual(3, stats["misses"])
+        self.assertEqual(2, stats["discarded"])
+
+    def test_pool_max_lifetime(self):
+        """
+        Tests that idle connections past their lifetime are closed
+        """
+        os.environ["DATABASE_POOL_MAX_LIFETIME_SECS"] = "0"
+        try:
+            conn1 = self.mock_connection()
+            conn2 = self.mock_connection()
+            database.psycopg2_connect = Mock(side_effect=[conn1, conn2])
+            with database.get_connection(self.dbconnect_info):
+                pass
+            conn1.close.assert_called_once()
+            with database.get_connection(self.dbconnect_info) as con:
+                self.assertEqual(conn2, con)
+        finally:
+            del os.environ["DATABASE_POOL_MAX_LIFETIME_SECS"]
+
+    def test_pool_idle_eviction(self):
+        """
+        Tests that connections idle for too long are evicted down to min size
+        """
+        pool = database.ConnectionPool(self.dbconnect_info, min_size=1,
+                                       max_idle_secs=0)
+        conn1 = self.mock_connection()
+        conn2 = self.mock_connection()
+        conn3 = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn1, conn2, conn3])
+        con_a = pool.getconn()
+        con_b = pool.getconn()
+        pool.putconn(con_a)
+        pool.putconn(con_b)
+        con = pool.getconn()
+        self.assertEqual(conn2, con)
+        conn1.close.assert_called_once()
+        self.assertEqual(1, pool.stats["evicted"])
+
+    def test_pool_ping_after_idle(self):
+        """
+        Tests that a connection idle past the ping threshold is checked
+        """
+        pool = database.ConnectionPool(self.dbconnect_info, ping_after_secs=0)
+        conn1 = self.mock_connection()
+        conn1.cursor.return_value.execute = Mock(
+            side_effect=psycopg2.OperationalError("server closed the connection"))
+        conn2 = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn1, conn2])
+        pool.putconn(pool.getconn())
+        self.assertEqual(conn2, pool.getconn())
+        self.assertEqual(1, pool.stats["discarded"])
+
+    def test_pool_exhausted(self):
+        """
+        Tests that checking out more than max_size connections fails
+        """
+        pool = database.ConnectionPool(self.dbconnect_info, max_size=1)
+        database.psycopg2_connect = Mock(side_effect=[self.mock_connection()])
+        pool.getconn()
+        try:
+            pool.getconn()
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual("connection pool exhausted, 1 connections in use", str(err))
+
+    def test_pool_connects_outside_lock(self):
+        """
+        Tests that the pool lock isn't held while connecting, and that a
+        connection being opened counts against max_size
+        """
+        pool = database.ConnectionPool(self.dbconnect_info, max_size=1)
+
+        def connect(**kwargs):
+            self.assertFalse(pool._lock.locked())   #pylint: disable-msg=protected-access
+            with self.assertRaises(DbError):
+                pool.getconn()
+            return self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=connect)
+        pool.getconn()
+        database.psycopg2_connect.assert_called_once()
+
+    def test_pool_stale_password(self):
+        """
+        Tests that a pool is closed and forgotten once the password changes,
+        or when it fails to authenticate, and that its checked out
+        connections are closed when they are returned
+        """
+        conn1 = self.mock_connection()
+        conn2 = self.mock_connection()
+        conn3 = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn1, conn2, conn3])
+        old_pool = database.get_pool(self.dbconnect_info)
+        with database.get_connection(self.dbconnect_info):
+            pass
+        in_use = old_pool.getconn()
+        self.assertEqual(conn1, in_use)
+
+        rotated = dict(self.dbconnect_info, db_pw="rotatedpw")
+        new_pool = database.get_pool(rotated)
+        self.assertIsNot(old_pool, new_pool)
+        self.assertEqual([new_pool], list(database._POOLS.values()))  #pylint: disable-msg=protected-access
+        old_pool.putconn(in_use)
+        conn1.close.assert_called_once()
+
+        with database.get_connection(rotated) as con:
+            self.assertEqual(conn2, con)
+        database.invalidate_db_connect_info(rotated)
+        conn2.close.assert_called_once()
+        self.assertEqual({}, database._POOLS)  #pylint: disable-msg=protected-access
+
+    def test_pool_rollback_on_return(self):
+        """
+        Tests that a connection returned mid-transaction is rolled back
+        """
+        conn = self.mock_connection()
+        conn.get_transaction_status = Mock(return_value=psycopg2.extensions.
+                                           TRANSACTION_STATUS_INTRANS)
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        try:
+            with database.get_connection(self.dbconnect_info):
+                raise ValueError("oops")
+        except DbError as err:
+            self.assertEqual("Database Error. oops", str(err))
+        conn.rollback.assert_called_once()
+
+    def test_transaction(self):
+        """
+        Tests that statements share one transaction, and that the caller's
+        exceptions roll back and keep their type
+        """
+        conn = self.mock_connection()
+        cursor = MagicMock()
+        cursor.fetchall = Mock(side_effect=[[{"request_id": UUID1}], [], []])
+        conn.cursor = Mock(return_value=cursor)
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        with database.transaction(self.dbconnect_info) as cur:
+            rows = database.multi_query("SELECT request_id FROM mytable", (), cur)
+            database.multi_query("UPDATE mytable SET col = %s", ("a",), cur)
+        self.assertEqual([{"request_id": UUID1}], rows)
+        self.assertEqual(2, cursor.execute.call_count)
+        conn.commit.assert_called_once()
+        try:
+            with database.transaction(self.dbconnect_info) as cur:
+                database.multi_query("UPDATE mytable SET col = %s", ("b",), cur)
+                raise ValueError("oops")
+        except ValueError as err:
+            self.assertEqual("oops", str(err))
+        conn.rollback.assert_called_once()
+        conn.commit.assert_called_once()
+
+    def test_is_retryable(self):
+        """
+        Tests which errors are classified as transient
+        """
+        self.assertTrue(database.is_retryable(psycopg2.OperationalError(
+            "server closed the connection unexpectedly")))
+        self.assertTrue(database.is_retryable(psycopg2.InterfaceError("connection already closed")))
+        self.assertFalse(database.is_retryable(psycopg2.OperationalError(
+            'FATAL:  password authentication failed for user "druser"')))
+        self.assertFalse(database.is_retryable(psycopg2.OperationalError(
+            'FATAL:  database "nosuchdatabase" does not exist')))
+        self.assertFalse(database.is_retryable(psycopg2.ProgrammingError("syntax error")))
+        self.assertFalse(database.is_retryable(ValueError("oops")))
+        self.assertTrue(database.is_retryable(DbError("lost", retryable=True)))
+        self.assertFalse(database.is_retryable(DbError("Internal database error")))
+
+    def test_backoff_delays(self):
+        """
+        Tests that the delays grow, are jittered, and stop at the deadline
+        """
+        os.environ["DATABASE_RETRY_DEADLINE_SECS"] = "10"
+        os.environ["DATABASE_RETRY_BASE_SECS"] = "1"
+        os.environ["DATABASE_RETRY_MAX_SECS"] = "4"
+        try:
+            database.random.uniform = Mock(side_effect=lambda low, high: high)
+            delays = list(itertools.islice(database.backoff_delays(), 10))
+        finally:
+            database.random.uniform = self.mock_uniform
+            os.environ.pop("DATABASE_RETRY_BASE_SECS")
+            os.environ.pop("DATABASE_RETRY_MAX_SECS")
+        self.assertEqual([1, 2, 4, 4, 4, 4, 4, 4, 4, 4], delays)
+        database.time.monotonic = Mock(side_effect=[100, 100, 105, 111])
+        try:
+            self.assertEqual(2, len(list(database.backoff_delays())))
+        finally:
+            database.time.monotonic = self.mock_monotonic
+
+    def test_single_query_retry(self):
+        """
+        Tests that a lost connection is retried on a new connection
+        """
+        os.environ["DATABASE_RETRY_DEADLINE_SECS"] = "5"
+        os.environ["DATABASE_RETRY_MAX_SECS"] = "0"
+        conn1 = self.mock_connection()
+        conn1.cursor.return_value.execute = Mock(
+            side_effect=psycopg2.OperationalError("server closed the connection unexpectedly"))
+        conn1.rollback = Mock(side_effect=psycopg2.InterfaceError("connection already closed"))
+        conn2 = self.mock_connection()
+        conn2.cursor.return_value.fetchall = Mock(return_value=[{"column1": 1}])
+        database.psycopg2_connect = Mock(side_effect=[conn1, conn2])
+        try:
+            rows = database.single_query('Select * from mytable', self.dbconnect_info)
+        finally:
+            os.environ.pop("DATABASE_RETRY_MAX_SECS")
+        self.assertEqual([{"column1": 1}], rows)
+        self.assertEqual(2, database.psycopg2_connect.call_count)
+        conn2.commit.assert_called_once()
+
+    def test_commit_failure_not_retried(self):
+        """
+        Tests that a commit that fails is not run again, as it may have been applied
+        """
+        os.environ["DATABASE_RETRY_DEADLINE_SECS"] = "5"
+        conn = self.mock_connection()
+        conn.commit = Mock(side_effect=psycopg2.OperationalError(
+            "server closed the connection unexpectedly"))
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        try:
+            database.single_query('Insert into mytable values (1)', self.dbconnect_info)
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual("Database Error. server closed the connection unexpectedly",
+                             str(err))
+            self.assertFalse(err.retryable)
+        database.psycopg2_connect.assert_called_once()
+
+    def test_circuit_breaker(self):
+        """
+        Tests that the breaker fails fast after consecutive failures, and
+        closes again after a successful call
+        """
+        os.environ["DATABASE_BREAKER_THRESHOLD"] = "2"
+        database.psycopg2_connect = Mock(side_effect=psycopg2.OperationalError(
+            "could not connect to server: Connection refused"))
+        for _ in range(2):
+            try:
+                database.single_query('Select * from mytable', self.dbconnect_info)
+                self.fail("expected DbError")
+            except DbError as err:
+                self.assertNotIsInstance(err, database.CircuitOpenError)
+        try:
+            database.single_query('Select * from mytable', self.dbconnect_info)
+            self.fail("expected CircuitOpenError")
+        except database.CircuitOpenError as err:
+            self.assertIn("The database is unavailable", str(err))
+        self.assertEqual(2, database.psycopg2_connect.call_count)
+
+        breaker = database.get_circuit_breaker(self.dbconnect_info)
+        breaker.opened_at -= breaker.cooldown_secs
+        database.psycopg2_connect = Mock(side_effect=[self.mock_connection()])
+        self.assertEqual([], database.single_query('Select * from mytable',
+                                                   self.dbconnect_info))
+        self.assertIsNone(breaker.opened_at)
+        self.assertEqual(0, breaker.failures)
+
+    def test_query_deadline(self):
+        """
+        Tests that nested deadlines keep the earliest, and deadlines from a lambda context
+        """
+        self.assertIsNone(database.remaining_secs())
+        now = time.monotonic()
+        with database.query_deadline(now + 10):
+            self.assertAlmostEqual(10, database.remaining_secs(), delta=1)
+            with database.query_deadline(now + 20):
+                self.assertAlmostEqual(10, database.remaining_secs(), delta=1)
+            with database.query_deadline(now + 5):
+                self.assertAlmostEqual(5, database.remaining_secs(), delta=1)
+            with database.query_deadline(None):
+                self.assertAlmostEqual(10, database.remaining_secs(), delta=1)
+        self.assertIsNone(database.remaining_secs())
+
+        context = Mock()
+        context.get_remaining_time_in_millis = Mock(return_value=30000)
+        self.assertAlmostEqual(now + 25, database.deadline_from_context(context, 5), delta=1)
+        self.assertIsNone(database.deadline_from_context(None))
+
+    def test_single_query_deadline(self):
+        """
+        Tests the statement and connect timeouts set from a deadline, and the
+        QueryTimeout raised when the statement runs into it
+        """
+        conn = self.mock_connection()
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        database.single_query('Select * from mytable', self.dbconnect_info,
+                              deadline=time.monotonic() + 10)
+        self.assertIn(database.psycopg2_connect.call_args[1]["connect_timeout"], (9, 10))
+        execute = conn.cursor.return_value.execute
+        self.assertEqual("SET LOCAL statement_timeout = %s", execute.call_args_list[0][0][0])
+        self.assertGreater(execute.call_args_list[0][0][1][0], 9000)
+
+        execute.side_effect = [None, QueryCanceled("canceling statement due to statement timeout")]
+        try:
+            database.single_query('Select * from mytable', self.dbconnect_info,
+                                  deadline=time.monotonic() + 10)
+            self.fail("expected QueryTimeout")
+        except database.QueryTimeout as err:
+            self.assertEqual("Database Error. canceling statement due to statement timeout",
+                             str(err))
+            self.assertFalse(err.retryable)
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn, con)
+
+        database.psycopg2_connect = Mock()
+        try:
+            database.single_query('Select * from mytable', self.dbconnect_info,
+                                  deadline=time.monotonic() - 1)
+            self.fail("expected QueryTimeout")
+        except database.QueryTimeout as err:
+            self.assertEqual("Database Error. The query deadline has passed", str(err))
+        database.psycopg2_connect.assert_not_called()
+
+    def test_statement_timeout_per_transaction(self):
+        """
+        Tests that the statement_timeout is set once per transaction, and set
+        again for a new transaction, a new deadline, or once the time left
+        has fallen by more than the slack
+        """
+        conn = self.mock_connection()
+        cursor = conn.cursor.return_value
+        cursor.connection = conn
+        deadline = time.monotonic() + 10
+        with database.query_deadline(deadline):
+            database.multi_query("SELECT 1", None, cursor)
+            conn.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+            database.multi_query("SELECT 2", None, cursor)
+            with database.query_deadline(deadline - 1):
+                database.multi_query("SELECT 3", None, cursor)
+            database._TIMEOUTS[conn] = (deadline, 20000)
+            database.multi_query("SELECT 4", None, cursor)
+            conn.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+            database.multi_query("SELECT 5", None, cursor)
+        self.assertEqual(["SET LOCAL statement_timeout = %s", "SELECT 1", "SELECT 2",
+                          "SET LOCAL statement_timeout = %s", "SELECT 3",
+                          "SET LOCAL statement_timeout = %s", "SELECT 4",
+                          "SET LOCAL statement_timeout = %s", "SELECT 5"],
+                         [str(call[0][0]) if isinstance(call[0][0], str) else call[0][0].string
+                          for call in cursor.execute.call_args_list])
+
+    def test_batch_query(self):
+        """
+        Tests that statements are sent a page at a time, and that a statement
+        that returns rows ends its page
+        """
+        conn = self.mock_connection()
+        cursor = conn.cursor.return_value
+        cursor.mogrify = Mock(side_effect=lambda stmt, params: (
+            stmt % params if params else stmt).encode())
+
+        def execute(batch):
+            cursor.description = [("a",)] if b"SELECT" in batch else None
+        cursor.execute = Mock(side_effect=execute)
+        cursor.fetchall = Mock(return_value=[{"a": 1}])
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        statements = [("INSERT INTO t VALUES (%s)", (1,)),
+                      ("INSERT INTO t VALUES (%s)", (2,)),
+                      ("UPDATE t SET a = 3", None),
+                      ("SELECT a FROM t WHERE a = %s", (1,)),
+                      ("DELETE FROM t -- all of them", None)]
+        result = database.batch_query(statements, self.dbconnect_info, page_size=2)
+        self.assertEqual([None, None, None, [{"a": 1}], None], result)
+        self.assertEqual([b"INSERT INTO t VALUES (1);\nINSERT INTO t VALUES (2)",
+                          b"UPDATE t SET a = 3;\nSELECT a FROM t WHERE a = 1",
+                          b"DELETE FROM t -- all of them"],
+                         [call[0][0] for call in cursor.execute.call_args_list])
+        cursor.fetchall.assert_called_once()
+        conn.commit.assert_called_once()
+
+    def test_prepared_query(self):
+        """
+        Tests that a statement is prepared once per connection and then only
+        executed, and run plainly on a connection where prepared statements
+        don't persist
+        """
+        conn = self.mock_connection()
+        cursor = conn.cursor.return_value
+        cursor.connection = conn
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        sql_stmt = "SELECT * FROM t WHERE a = %s AND b LIKE '%%x'"
+        for params in [(1,), (2,)]:
+            database.single_query(sql_stmt, self.dbconnect_info, params, prepare_as="t_by_a")
+        self.assertEqual([("SAVEPOINT prepare_t_by_a; "
+                           "PREPARE t_by_a AS SELECT * FROM t WHERE a = $1 AND b LIKE '%x'; "
+                           "RELEASE SAVEPOINT prepare_t_by_a",),
+                          ("EXECUTE t_by_a (%s)", (1,)), ("EXECUTE t_by_a (%s)", (2,))],
+                         [(getattr(call[0][0], "string", call[0][0]),) + call[0][1:]
+                          for call in cursor.execute.call_args_list])
+
+        cursor.execute = Mock(side_effect=[InvalidSqlStatementName("not there"), None])
+        try:
+            database.single_query(sql_stmt, self.dbconnect_info, (3,), prepare_as="t_by_a")
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertTrue(err.retryable)
+        database.single_query(sql_stmt, self.dbconnect_info, (3,), prepare_as="t_by_a")
+        self.assertEqual((sql_stmt, (3,)), (cursor.execute.call_args[0][0].string,
+                                            cursor.execute.call_args[0][1]))
+
+        # another connection still prepares
+        other = self.mock_connection().cursor.return_value
+        other.connection = Mock(get_transaction_status=Mock(return_value=TRANSACTION_STATUS_IDLE))
+        database.multi_query(sql_stmt, (4,), other, prepare_as="t_by_a")
+        self.assertIn("PREPARE t_by_a", other.execute.call_args_list[0][0][0])
+
+    def test_prepared_query_in_transaction(self):
+        """
+        Tests that a failed PREPARE is rolled back to its savepoint and the
+        statement run plainly, that a missing prepared statement after others
+        in the transaction isn't retryable, and that a statement with a
+        placeholder in a quoted literal is run plainly
+        """
+        cursor = self.mock_cursor()
+        cursor.execute = Mock(side_effect=[psycopg2.errors.DuplicatePreparedStatement("there"),
+                                           None, None, None])
+        database.multi_query("SELECT * FROM t WHERE a = %s", (1,), cursor, prepare_as="t_by_a")
+        self.assertEqual(["ROLLBACK TO SAVEPOINT prepare_t_by_a", "SELECT * FROM t WHERE a = %s"],
+                         [getattr(call[0][0], "string", call[0][0])
+                          for call in cursor.execute.call_args_list[1:]])
+        database.multi_query("SELECT * FROM t WHERE a = %s", (2,), cursor, prepare_as="t_by_a")
+        self.assertEqual(("SELECT * FROM t WHERE a = %s", (2,)),
+                         (cursor.execute.call_args[0][0].string, cursor.execute.call_args[0][1]))
+
+        cursor = self.mock_cursor()
+        cursor.connection.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+        database._PREPARED[cursor.connection] = {"t_by_a"}
+        cursor.execute = Mock(side_effect=InvalidSqlStatementName("not there"))
+        with self.assertRaises(DbError) as context:
+            database.multi_query("SELECT * FROM t WHERE a = %s", (1,), cursor,
+                                 prepare_as="t_by_a")
+        self.assertFalse(context.exception.retryable)
+
+        cursor = self.mock_cursor()
+        sql_stmt = "SELECT * FROM t WHERE day > now() - INTERVAL '%s' day"
+        database.multi_query(sql_stmt, (3,), cursor, prepare_as="t_since")
+        self.assertEqual([sql_stmt], [call[0][0].string
+                                      for call in cursor.execute.call_args_list])
+        self.assertIsNone(database._number_placeholders("SELECT 1 -- %s"))
+        self.assertEqual('SELECT "a%s", $1 /* 50% */',
+                         database._number_placeholders('SELECT "a%%s", %s /* 50%% */'))
+
+    def test_copy_rows(self):
+        """
+        Tests that rows are streamed to COPY as csv
+        """
+        cursor = Mock()
+        copied = []
+        def copy_expert(stmt, stream, size):
+            chunk = stream.read(size)
+            while chunk:
+                copied.append(chunk)
+                chunk = stream.read(size)
+        cursor.copy_expert = Mock(side_effect=copy_expert)
+        rows = iter([(1, "a,b", None), (2, 'say "hi"', datetime.date(2019, 7, 31))])
+        count = database.copy_rows("dr.mytable", ["id", "txt", "day"], rows, cursor)
+        self.assertEqual(2, count)
+        self.assertEqual('1,"a,b",\n2,"say ""hi""",2019-07-31\n', "".join(copied))
+        self.assertIn('FROM STDIN WITH (FORMAT csv)', repr(cursor.copy_expert.call_args[0][0]))
+
+        def bad_rows():
+            yield (1, "a", None)
+            raise ValueError("bad row")
+        try:
+            database.copy_rows("mytable", ["id", "txt", "day"], bad_rows(), cursor)
+            self.fail("expected ValueError")
+        except ValueError as err:
+            self.assertEqual("bad row", str(err))
+
+    def test_copy_query(self):
+        """
+        Tests that the rows of a query are written to a file with COPY TO STDOUT
+        """
+        conn = self.mock_connection()
+        cursor = conn.cursor.return_value
+        cursor.mogrify = Mock(return_value=b"SELECT * FROM mytable WHERE column2 = 'a'")
+        cursor.copy_expert = Mock(side_effect=lambda stmt, out, size:
+                                  out.write("column1\n1\n2\n"))
+        cursor.rowcount = 2
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        out = io.StringIO()
+        count = database.copy_query("SELECT * FROM mytable WHERE column2 = %s",
+                                    self.dbconnect_info, out, ("a",))
+        self.assertEqual(2, count)
+        self.assertEqual("column1\n1\n2\n", out.getvalue())
+        self.assertEqual("COPY (SELECT * FROM mytable WHERE column2 = 'a') TO STDOUT "
+                         "WITH (FORMAT csv, HEADER)", cursor.copy_expert.call_args[0][0])
+        conn.commit.assert_called_once()
+
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        cursor.copy_expert = Mock(side_effect=psycopg2.ProgrammingError("no such table"))
+        with self.assertRaises(DbError):
+            database.copy_query("SELECT * FROM mytable", self.dbconnect_info, out,
+                                header=False)
+        self.assertIn("WITH (FORMAT csv)", cursor.copy_expert.call_args[0][0])
+        conn.rollback.assert_called()
+
+    def test_stream_query(self):
+        """
+        Tests that rows are yielded from a named cursor, itersize at a time
+        """
+        conn = self.mock_connection()
+        rows = [{"column1": 1}, {"column1": 2}, {"column1": 3}]
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter(rows)
+        conn.cursor = Mock(return_value=cursor)
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        sql_stmt = 'Select * from mytable where column2 = %s'
+        result = database.stream_query(sql_stmt, self.dbconnect_info, ("a",), itersize=2)
+        conn.cursor.assert_not_called()
+        self.assertEqual(rows, list(result))
+        self.assertTrue(conn.cursor.call_args[1]["name"].startswith("stream_"))
+        self.assertEqual(psycopg2.extras.RealDictCursor,
+                         conn.cursor.call_args[1]["cursor_factory"])
+        self.assertEqual(2, cursor.itersize)
+        conn.commit.assert_called_once()
+        cursor.close.assert_called_once()
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn, con)
+
+    def test_stream_query_closed_early(self):
+        """
+        Tests that closing the generator early rolls back and returns the connection
+        """
+        conn = self.mock_connection()
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter([{"column1": 1}, {"column1": 2}])
+        conn.cursor = Mock(return_value=cursor)
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        result = database.stream_query('Select * from mytable', self.dbconnect_info)
+        self.assertEqual({"column1": 1}, next(result))
+        result.close()
+        conn.commit.assert_not_called()
+        conn.rollback.assert_called()
+        cursor.close.assert_called_once()
+        with database.get_connection(self.dbconnect_info) as con:
+            self.assertEqual(conn, con)
+
+    def test_stream_query_error(self):
+        """
+        Tests a database error while streaming
+        """
+        conn = self.mock_connection()
+        cursor = MagicMock()
+        cursor.execute = Mock(side_effect=psycopg2.ProgrammingError("relation does not exist"))
+        conn.cursor = Mock(return_value=cursor)
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        exp_err = 'Database Error. Internal database error, please contact LP DAAC User Services'
+        try:
+            list(database.stream_query('Select * from mytable', self.dbconnect_info))
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual(exp_err, str(err))
+        conn.rollback.assert_called()
+
+    def test_listen(self):
+        """
+        Tests yielding notifications, and None while idle, until the connection is lost
+        """
+        os.environ["DATABASE_LISTEN_HEARTBEAT_SECS"] = "0"
+        conn = self.mock_connection()
+        cursor = MagicMock()
+        cursor.__enter__.return_value = cursor
+        conn.cursor = Mock(return_value=cursor)
+        notify = collections.namedtuple("Notify", ["pid", "channel", "payload"])
+        conn.notifies = [notify(1, "request_status", "a"), notify(1, "request_status", "b")]
+        conn.poll = Mock(side_effect=[
+            None, psycopg2.OperationalError("server closed the connection unexpectedly")])
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        database.select.select = Mock(side_effect=[([conn], [], []), ([], [], []),
+                                                   ([conn], [], [])])
+        result = database.listen("request_status", self.dbconnect_info, poll_secs=0.5)
+        self.assertEqual(["a", "b", None], list(itertools.islice(result, 3)))
+        self.assertTrue(conn.autocommit)
+        self.assertEqual("SELECT 1", cursor.execute.call_args[0][0])
+        self.assertEqual(0.5, database.select.select.call_args[0][3])
+        try:
+            next(result)
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertTrue(err.retryable)
+        conn.close.assert_called_once()
+
+    def test_query_stats(self):
+        """
+        Tests that the in memory sink aggregates timings by statement
+        """
+        conn = self.mock_connection()
+        conn.cursor.return_value.fetchall = Mock(return_value=[{"column1": 1}])
+        database.psycopg2_connect = Mock(side_effect=[conn])
+        stats = database.QueryStats()
+        database.clear_query_sinks()
+        database.add_query_sink(stats)
+        database.single_query('Select * from mytable where column1 = %s', self.dbconnect_info,
+                              (1,))
+        database.single_query("""Select *
+                                 from mytable
+                                 where column1 = %s""", self.dbconnect_info, (2,))
+        database.single_query('Select 1', self.dbconnect_info)
+        summary = stats.summary()
+        fingerprint, statement = database.fingerprint('Select * from mytable where column1 = %s')
+        self.assertEqual(statement, summary[fingerprint]["statement"])
+        self.assertEqual(2, summary[fingerprint]["count"])
+        self.assertLessEqual(summary[fingerprint]["p50"], summary[fingerprint]["p95"])
+        self.assertEqual(3, summary["connect"]["count"])
+        self.assertEqual(3, len(summary))
+
+        database.remove_query_sink(stats)
+        stats.reset()
+        database.single_query('Select 1', self.dbconnect_info)
+        self.assertEqual({}, stats.summary())
+
+    def test_query_sink_failure(self):
+        """
+        Tests that a failing sink doesn't fail the query
+        """
+        database.psycopg2_connect = Mock(side_effect=[self.mock_connection()])
+        database.clear_query_sinks()
+        database.add_query_sink(Mock(side_effect=ValueError("bad sink")))
+        self.assertEqual([], database.single_query('Select 1', self.dbconnect_info))
+
+    def test_query_sinks_from_env(self):
+        """
+        Tests that the sinks named in DATABASE_QUERY_SINKS are used
+        """
+        os.environ["DATABASE_QUERY_SINKS"] = "log, emf,unknown"
+        database._QUERY_SINKS = None            #pylint: disable-msg=protected-access
+        self.assertEqual([database.log_query_sink, database.emf_query_sink],
+                         database.get_query_sinks())
+
+    def test_emf_query_sink(self):
+        """
+        Tests the CloudWatch embedded metric format line for a query event
+        """
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            database.emf_query_sink({"event": "query", "fingerprint": "abc123",
+                                     "statement": "Select 1", "execute_secs": 0.012,
+                                     "fetch_secs": 0.003, "rows": 7})
+        line = json.loads(out.getvalue())
+        metrics = line["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual("DisasterRecovery/Database", metrics["Namespace"])
+        self.assertEqual([["event", "fingerprint"]], metrics["Dimensions"])
+        self.assertIn({"Name": "execute_ms", "Unit": "Milliseconds"}, metrics["Metrics"])
+        self.assertIn({"Name": "rows", "Unit": "Count"}, metrics["Metrics"])
+        self.assertEqual(12.0, line["execute_ms"])
+        self.assertEqual(3.0, line["fetch_ms"])
+        self.assertEqual(7, line["rows"])
+        self.assertEqual("abc123", line["fingerprint"])
+
+    def test_slow_query_logged(self):
+        """
+        Tests that a query over the threshold is logged with a digest of its params
+        """
+        os.environ["DATABASE_SLOW_QUERY_SECS"] = "0"
+        database.psycopg2_connect = Mock(side_effect=[self.mock_connection()])
+        with self.assertLogs(database.LOGGER, level="WARNING") as logs:
+            database.single_query('Select * from mytable where pw = %s', self.dbconnect_info,
+                                  ("secretvalue",))
+        self.assertEqual(1, len(logs.output))
+        self.assertIn("slow query", logs.output[0])
+        self.assertIn("sql: Select * from mytable where pw = %s", logs.output[0])
+        self.assertNotIn("secretvalue", logs.output[0])
+
+    def test_read_db_connect_info_cached(self):
+        """
+        Tests that the parameter store is read once, in one batch
+        """
+        ssm_cli = database.get_ssm_client()
+        self.assertEqual(1, ssm_cli.get_parameters.call_count)
+        ssm_cli.get_parameters.assert_called_with(Names=["drdb-host", "drdb-user-pass"],
+                                                  WithDecryption=True)
+        db_params = {}
+        db_params["db_host"] = {"ssm": "drdb-host"}
+        db_params["db_port"] = {"env": "DATABASE_PORT"}
+        db_params["db_name"] = {"env": "DATABASE_NAME"}
+        db_params["db_user"] = {"env": "DATABASE_USER"}
+        db_params["db_pw"] = {"ssm": "drdb-user-pass"}
+        dbconnect_info = database.read_db_connect_info(db_params)
+        self.assertEqual(self.dbconnect_info, dbconnect_info)
+        self.assertEqual("my.db.host.gov", dbconnect_info["db_host"])
+        self.assertEqual(50, dbconnect_info["db_port"])
+        self.assertEqual("unittestdbpw", dbconnect_info["db_pw"])
+        self.assertEqual(1, ssm_cli.get_parameters.call_count)
+        ssm_cli.get_parameter.assert_not_called()
+
+        database.invalidate_db_connect_info()
+        database.read_db_connect_info(db_params)
+        self.assertEqual(2, ssm_cli.get_parameters.call_count)
+
+    def test_read_db_connect_info_ttl(self):
+        """
+        Tests that cached parameter store values expire
+        """
+        os.environ["DATABASE_CONNECT_INFO_TTL_SECS"] = "0"
+        database.invalidate_db_connect_info()
+        try:
+            ssm_cli = database.get_ssm_client()
+            database.get_db_connect_info("ssm", "drdb-host")
+            database.get_db_connect_info("ssm", "drdb-host")
+            self.assertEqual(3, ssm_cli.get_parameters.call_count)
+        finally:
+            del os.environ["DATABASE_CONNECT_INFO_TTL_SECS"]
+
+    def test_read_db_connect_info_not_found(self):
+        """
+        Tests a parameter that isn't in the parameter store
+        """
+        database.invalidate_db_connect_info()
+        try:
+            database.get_db_connect_info("ssm", "noexist")
+            self.fail("expected DbError")
+        except DbError as err:
+            self.assertEqual("Parameters not found in parameter store: ['noexist']", str(err))
+
+    def test_reader_connect_info(self):
+        """
+        Tests that a read replica gets its own pool and circuit breaker
+        """
+        self.assertIs(self.dbconnect_info, database.reader_connect_info(self.dbconnect_info))
+        dbconnect_info = dict(self.dbconnect_info, db_reader_host="my.reader.host.gov")
+        reader_info = database.reader_connect_info(dbconnect_info)
+        self.assertEqual("my.reader.host.gov", reader_info["db_host"])
+        self.assertEqual(self.dbconnect_info["db_host"], dbconnect_info["db_host"])
+        self.assertIsNot(database.get_pool(dbconnect_info), database.get_pool(reader_info))
+        self.assertIsNot(database.get_circuit_breaker(dbconnect_info),
+                         database.get_circuit_breaker(reader_info))
+
+    def test_auth_failure_invalidates_connect_info(self):
+        """
+        Tests that a failed login makes the next lookup re-read the parameter store
+        """
+        ssm_cli = database.get_ssm_client()
+        database.psycopg2_connect = Mock(side_effect=psycopg2.OperationalError(
+            'FATAL:  password authentication failed for user "unittestdbuser"'))
+        try:
+            database.single_query('Select * from mytable', self.dbconnect_info)
+            self.fail("expected DbError")
+        except DbError:
+            pass
+        database.get_db_connect_info("ssm", "drdb-host")
+        self.assertEqual(2, ssm_cli.get_parameters.call_count)
+
+    @staticmethod
+    def mock_get_parameters(Names, WithDecryption):      #pylint: disable-msg=invalid-name
+        """
+        mocks a batched read from the parameter store
+        """
+        values = {"drdb-host": os.environ["DATABASE_HOST"],
+                  "drdb-user-pass": os.environ["DATABASE_PW"]}
+        result = {"Parameters": [], "InvalidParameters": []}
+        for name in Names:
+            if name in values:
+                result["Parameters"].append({"Name": name, "Value": values[name]})
+            else:
+                result["InvalidParameters"].append(name)
+        return result
+
+    def mock_cursor(self):
+        """
+        builds a mock cursor of its own idle connection
+        """
+        conn = self.mock_connection()
+        cursor = conn.cursor.return_value
+        cursor.connection = conn
+        return cursor
+
+    @staticmethod
+    def mock_connection():
+        """
+        builds a mock connection that looks open and idle
+        """
+        conn = Mock()
+        conn.closed = 0
+        conn.get_transaction_status = Mock(return_value=TRANSACTION_STATUS_IDLE)
+        conn.cursor.return_value.fetchall = Mock(return_value=[])
+        return conn
+
     @staticmethod
     def build_row(column1, column2, column3):
         """
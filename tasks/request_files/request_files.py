@@ -3,8 +3,9 @@ Name: request_files.py
 Description:  Lambda function that makes a restore request from glacier for each input file.
 """
 
+import asyncio
 import os
-import time
+import uuid
 import boto3
 from botocore.exceptions import ClientError
 
@@ -59,6 +60,8 @@ def task(event, context):              #pylint: disable-msg=unused-argument
         raise RestoreRequestError(
             f'request: {event} does not contain a config value for glacier-bucket')
 
+    request_group_key = event['config'].get('request_group_key')
+
     gran = {}
     granules = event['input']['granules']
     if len(granules) > 1:
@@ -83,18 +86,21 @@ def task(event, context):              #pylint: disable-msg=unused-argument
                 files.append(afile)
         gran['recover_files'] = files
 
-    gran = process_granules(s3, gran, glacier_bucket, exp_days)
+    gran = process_granules(s3, gran, glacier_bucket, exp_days, request_group_key)
 
     # Cumulus expects response (payload.granules) to be a list of granule objects.
     return { 'granules': [ gran ] }
 
-def process_granules(s3, gran, glacier_bucket, exp_days):        # pylint: disable-msg=invalid-name
+def process_granules(s3, gran, glacier_bucket, exp_days,        # pylint: disable-msg=invalid-name
+                     request_group_key=None):
     """Call restore_object for the files in the granule_list
         Args:
             gran (list):
             s3 (object): An instance of boto3 s3 client
             glacier_bucket (string): The S3 glacier bucket name
             file_key (string): The key of the Glacier object
+            request_group_key (string, optional): Identifies the workflow run, see
+                get_request_group_id
         Returns:
             gran: updated granules list, indicating if the restore request for each file
                   was successful, including an error message for any that were not.
@@ -119,31 +125,14 @@ def process_granules(s3, gran, glacier_bucket, exp_days):        # pylint: disab
     except KeyError:
         retrieval_type = 'Standard'
 
-    attempt = 1
-    request_group_id = requests_db.request_id_generator()
-    granule_id = gran['granuleId']
-    while attempt <= retries:
-        for afile in gran['recover_files']:
-            if not afile['success']:
-                try:
-                    obj = {}
-                    obj["request_group_id"] = request_group_id
-                    obj["granule_id"] = granule_id
-                    obj["glacier_bucket"] = glacier_bucket
-                    obj["key"] = afile['key']
-                    obj["dest_bucket"] = afile['dest_bucket']
-                    obj["days"] = exp_days
-                    request_id = restore_object(s3, obj, attempt, retries, retrieval_type)
-                    afile['success'] = True
-                    afile['err_msg'] = ''
-                    LOGGER.info("restore {} from {} attempt {} successful. Job: {}",
-                                afile["key"], glacier_bucket, attempt, request_id)
-                except ClientError as err:
-                    afile['err_msg'] = str(err)
+    try:
+        concurrency = int(os.environ['RESTORE_REQUEST_CONCURRENCY'])
+    except KeyError:
+        concurrency = 10
 
-        attempt = attempt + 1
-        if attempt <= retries:
-            time.sleep(retry_sleep_secs)
+    asyncio.run(restore_files(s3, gran, glacier_bucket, exp_days, retries,
+                              retry_sleep_secs, retrieval_type, request_group_key,
+                              concurrency))
 
     for afile in gran['recover_files']:
         # if any file failed, the whole granule will fail
@@ -153,6 +142,84 @@ def process_granules(s3, gran, glacier_bucket, exp_days):        # pylint: disab
             raise RestoreRequestError(f'One or more files failed to be requested. {gran}')
     return gran
 
+async def restore_files(s3, gran, glacier_bucket, exp_days,    # pylint: disable-msg=invalid-name,too-many-arguments
+                        retries, retry_sleep_secs, retrieval_type, request_group_key=None,
+                        concurrency=10):
+    """Calls restore_object for the files in the granule, retrying the ones that failed,
+    and records the jobs of each attempt in the database.
+    The restore requests, which block, are made in the default executor, up to concurrency
+    of them at a time. The jobs of an attempt are written to the database in the background,
+    in the order of the files, overlapping with the restore requests of the next attempt, and
+    all of the writes are waited for at the end.
+        Args:
+            s3 (object): An instance of boto3 s3 client
+            gran (dict): The granule, with the 'recover_files' to restore
+            glacier_bucket (string): The S3 glacier bucket name
+            exp_days (number): The number of days the restored files will be accessible
+            retries (number): The number of attempts to make for a failed restore request
+            retry_sleep_secs (number): The number of seconds to sleep between attempts
+            retrieval_type (string): Glacier Tier. 'Standard'|'Bulk'|'Expedited'.
+            request_group_key (string, optional): Identifies the workflow run, see
+                get_request_group_id
+            concurrency (number, optional, default = 10): The most restore requests
+                to have in flight at once
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    attempt = 1
+    granule_id = gran['granuleId']
+    request_group_id = get_request_group_id(request_group_key, granule_id)
+    submits = []
+
+    async def restore_file(afile, attempt, file_jobs):
+        obj = {}
+        obj["request_group_id"] = request_group_id
+        obj["granule_id"] = granule_id
+        obj["glacier_bucket"] = glacier_bucket
+        obj["key"] = afile['key']
+        obj["dest_bucket"] = afile['dest_bucket']
+        obj["days"] = exp_days
+        try:
+            async with semaphore:
+                await loop.run_in_executor(None, restore_object, s3, obj,
+                                           attempt, retries, retrieval_type, file_jobs)
+            afile['success'] = True
+            afile['err_msg'] = ''
+            LOGGER.info("restore {} from {} attempt {} successful.",
+                        afile["key"], glacier_bucket, attempt)
+        except ClientError as err:
+            afile['err_msg'] = str(err)
+
+    while attempt <= retries:
+        # each file's job is collected on its own, so the jobs keep the order of the files
+        file_jobs = [(afile, []) for afile in gran['recover_files'] if not afile['success']]
+        await asyncio.gather(*[restore_file(afile, attempt, found)
+                               for afile, found in file_jobs])
+        jobs = [job for _, found in file_jobs for job in found]
+
+        submits.append(asyncio.ensure_future(submit_jobs(jobs)))
+        attempt = attempt + 1
+        if attempt <= retries:
+            await asyncio.sleep(retry_sleep_secs)
+
+    await asyncio.gather(*submits)
+
+def get_request_group_id(request_group_key, granule_id):
+    """Returns the request_group_id for the jobs of a granule. With a request_group_key
+    it is derived from the key and the granule_id, so a retry of the same workflow run
+    records its jobs under the same request_group_id, and they update the jobs of the
+    earlier try instead of adding new ones. Without one, a new request_group_id is made.
+        Args:
+            request_group_key (string): Identifies the workflow run, such as its
+                execution name, or None
+            granule_id (string): The id of the granule being restored
+        Returns:
+            string: The request_group_id (uuid).
+    """
+    if not request_group_key:
+        return requests_db.request_id_generator()
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{request_group_key}/{granule_id}"))
+
 def object_exists(s3_cli, glacier_bucket, file_key):
     """Check to see if an object exists in S3 Glacier.
         Args:
@@ -170,7 +237,25 @@ def object_exists(s3_cli, glacier_bucket, file_key):
         LOGGER.error(err)
         raise
 
-def restore_object(s3_cli, obj, attempt, retries, retrieval_type='Standard'):
+async def submit_jobs(jobs):
+    """Records the jobs for the restore requests of an attempt in the database,
+    in a single insert. A job that is already recorded for the file in the
+    request group, by an earlier try, is updated instead.
+        Args:
+            jobs (list(dict)): The jobs collected by restore_object
+    """
+    if not jobs:
+        return
+    try:
+        # the request_ids are those of the jobs as recorded, an existing job keeps its own
+        request_ids = await requests_db.submit_requests_async(jobs, on_conflict="update")
+        LOGGER.info(f"{len(request_ids)} jobs recorded: {request_ids}")
+    except requests_db.DatabaseError as err:
+        LOGGER.error("Failed to log requests in database. Error {}. Requests: {}",
+                     str(err), jobs)
+
+def restore_object(s3_cli, obj, attempt, retries,      #pylint: disable-msg=too-many-arguments
+                   retrieval_type='Standard', jobs=None):
     """Restore an archived S3 Glacier object in an Amazon S3 bucket.
         Args:
             s3_cli (object): An instance of boto3 s3 client
@@ -188,11 +273,16 @@ def restore_object(s3_cli, obj, attempt, retries, retrieval_type='Standard'):
             retries (number): The number of retries that will be attempted
             retrieval_type (string, optional, default=Standard): Glacier Tier.
                 Valid values are 'Standard'|'Bulk'|'Expedited'.
+            jobs (list, optional): When given, the job for the request is appended
+                to this list, to be recorded in bulk with submit_jobs, instead of
+                being written to the database one at a time.
         Returns:
-            uuid: request_Id.
+            uuid: The request_id of the job as it was recorded, which is that of the
+                existing job when there is one, or None when the job was appended to
+                jobs, or was not recorded.
     """
     data = requests_db.create_data(obj, "restore", "inprogress", None, None)
-    request_id = data["request_id"]
+    request_id = None
     request = {'Days': obj["days"],
                'GlacierJobParameters': {'Tier': retrieval_type}}
     # Submit the request
@@ -200,29 +290,45 @@ def restore_object(s3_cli, obj, attempt, retries, retrieval_type='Standard'):
         s3_cli.restore_object(Bucket=obj["glacier_bucket"],
                               Key=obj["key"],
                               RestoreRequest=request)
-        try:
-            requests_db.submit_request(data)
-            LOGGER.info(f"Job {request_id} created.")
-        except requests_db.DatabaseError as err:
-            LOGGER.error("Failed to log request in database. Error {}. Request: {}",
-                         str(err), data)
+        request_id = record_job(data, jobs)
     except ClientError as c_err:
         # NoSuchBucket, NoSuchKey, or InvalidObjectState error == the object's
         # storage class was not GLACIER
         LOGGER.error("{}. bucket: {} file: {}", c_err, obj["glacier_bucket"], obj["key"])
         if attempt == retries:
-            try:
-                data["err_msg"] = str(c_err)
-                data["job_status"] = "error"
-                requests_db.submit_request(data)
-                LOGGER.info(f"Job {request_id} created.")
-            except requests_db.DatabaseError as err:
-                LOGGER.error("Failed to log request in database. Error {}. Request: {}",
-                             str(err), data)
+            data["err_msg"] = str(c_err)
+            data["job_status"] = "error"
+            record_job(data, jobs)
 
         raise c_err
     return request_id
 
+def record_job(data, jobs=None):
+    """Records the job for a restore request in the database, or appends it to jobs
+    when the caller is collecting them for submit_jobs.
+        Args:
+            data (dict): The job, as created by requests_db.create_data
+            jobs (list, optional): The jobs being collected by the caller
+        Returns:
+            uuid: The request_id of the job as it was recorded, that of the existing job
+                when there is one, or None when it was appended to jobs, was already
+                complete or error, or could not be recorded.
+    """
+    if jobs is not None:
+        jobs.append(data)
+        return None
+    try:
+        request_id = requests_db.submit_request(data, on_conflict="update")
+    except requests_db.DatabaseError as err:
+        LOGGER.error("Failed to log request in database. Error {}. Request: {}",
+                     str(err), data)
+        return None
+    if request_id:
+        LOGGER.info(f"Job {request_id} recorded.")
+    else:
+        LOGGER.info(f"Job for {data['object_key']} already finished, left as it is.")
+    return request_id
+
 def handler(event, context):      #pylint: disable-msg=unused-argument
     """Lambda handler. Initiates a restore_object request from glacier for each file of a granule.
     Note that this function is set up to accept a list of granules, (because Cumulus sends a list),
@@ -239,6 +345,8 @@ def handler(event, context):      #pylint: disable-msg=unused-argument
                 attempts to retry a restore_request that failed to submit.
             RESTORE_RETRY_SLEEP_SECS (number, optional, default = 0): The number of seconds
                 to sleep between retry attempts.
+            RESTORE_REQUEST_CONCURRENCY (number, optional, default = 10): The most
+                restore requests to make at once.
             RESTORE_RETRIEVAL_TYPE (string, optional, default = 'Standard'): the Tier
                 for the restore request. Valid valuesare 'Standard'|'Bulk'|'Expedited'.
             DATABASE_PORT (string): the database port. The standard is 5432.
@@ -251,6 +359,9 @@ def handler(event, context):      #pylint: disable-msg=unused-argument
             event (dict): A dict with the following keys:
                 glacierBucket (string) :  The name of the glacier bucket from which the files
                     will be restored.
+                config.request_group_key (string, optional): Identifies the workflow run,
+                    '{$.cumulus_meta.execution_name}' in the workflows. A retried run then
+                    updates the jobs it recorded before, instead of adding new ones.
                 granules (list(dict)): A list of dict with the following keys:
                     granuleId (string): The id of the granule being restored.
                     keys (list(string)): list of keys (glacier keys) for the granule
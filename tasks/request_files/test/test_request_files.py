@@ -4,8 +4,9 @@ Name: test_request_files.py
 Description:  Unit tests for request_files.py.
 """
 import os
+import threading
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 
 import boto3
 from botocore.exceptions import ClientError
@@ -45,6 +46,8 @@ class TestRequestFiles(unittest.TestCase):
         self.mock_error = CumulusLogger.error
         self.mock_single_query = database.single_query
         self.mock_generator = requests_db.request_id_generator
+        self.mock_submit_requests = requests_db.submit_requests_async
+        self.mock_submit_request = requests_db.submit_request
         os.environ["DATABASE_HOST"] = "my.db.host.gov"
         os.environ["DATABASE_PORT"] = "54"
         os.environ["DATABASE_NAME"] = "sndbx"
@@ -56,6 +59,8 @@ class TestRequestFiles(unittest.TestCase):
 
     def tearDown(self):
         requests_db.request_id_generator = self.mock_generator
+        requests_db.submit_requests_async = self.mock_submit_requests
+        requests_db.submit_request = self.mock_submit_request
         database.single_query = self.mock_single_query
         CumulusLogger.error = self.mock_error
         CumulusLogger.info = self.mock_info
@@ -141,7 +146,7 @@ class TestRequestFiles(unittest.TestCase):
         except requests_db.DatabaseError as err:
             self.fail(str(err))
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.head_object.assert_any_call(Bucket='my-dr-fake-glacier-bucket',
                                            Key=FILE1)
         s3_cli.head_object.assert_any_call(Bucket='my-dr-fake-glacier-bucket',
@@ -256,7 +261,7 @@ class TestRequestFiles(unittest.TestCase):
         except requests_db.DatabaseError as err:
             self.fail(f"failed insert does not throw exception. {str(err)}")
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.head_object.assert_any_call(Bucket='my-dr-fake-glacier-bucket',
                                            Key=FILE1)
         restore_req_exp = {'Days': 5, 'GlacierJobParameters': {'Tier': 'Standard'}}
@@ -280,6 +285,118 @@ class TestRequestFiles(unittest.TestCase):
         self.assertEqual(exp_gran, result)
         database.single_query.assert_called()  #called 1 times
 
+    def test_process_granules_one_insert_per_attempt(self):
+        """
+        Test that the jobs for the files restored in an attempt are recorded in one insert
+        """
+        gran = {"granuleId": "MOD09GQ.A0219114.N5aUCG.006.0656338553321",
+                "recover_files": [{"key": FILE1, "dest_bucket": PROTECTED_BUCKET,
+                                   "success": False, "err_msg": ""},
+                                  {"key": FILE2, "dest_bucket": PROTECTED_BUCKET,
+                                   "success": False, "err_msg": ""},
+                                  {"key": FILE4, "dest_bucket": PUBLIC_BUCKET,
+                                   "success": False, "err_msg": ""}]}
+        s3_cli = Mock()
+        # the restores of an attempt run at once, so FILE2 is failed by key, not by call order
+        failures = [ClientError({'Error': {'Code': 'NoSuchBucket'}}, 'restore_object')]
+
+        def restore_object(Key, **kwargs):      #pylint: disable-msg=invalid-name,unused-argument
+            if Key == FILE2 and failures:
+                raise failures.pop()
+
+        s3_cli.restore_object = Mock(side_effect=restore_object)
+        CumulusLogger.info = Mock()
+        CumulusLogger.error = Mock()
+        requests_db.request_id_generator = Mock(side_effect=[REQUEST_GROUP_ID_EXP_1,
+                                                             REQUEST_ID1, REQUEST_ID2,
+                                                             REQUEST_ID3, REQUEST_ID4])
+        submitted = []
+        requests_db.submit_requests_async = AsyncMock(
+            side_effect=lambda jobs, on_conflict: submitted.append(list(jobs)) or [
+                job["request_id"] for job in jobs])
+        result = request_files.process_granules(s3_cli, gran, 'my-dr-fake-glacier-bucket', 5)
+        self.assertEqual(2, requests_db.submit_requests_async.call_count)
+        # the jobs are recorded in the order of the files
+        self.assertEqual([FILE1, FILE4], [job["object_key"] for job in submitted[0]])
+        self.assertEqual([FILE2], [job["object_key"] for job in submitted[1]])
+        self.assertEqual(REQUEST_ID4, submitted[1][0]["request_id"])
+        requests_db.submit_requests_async.assert_called_with(submitted[1],
+                                                             on_conflict="update")
+        for afile in result['recover_files']:
+            self.assertTrue(afile['success'])
+
+    def test_process_granules_concurrent(self):
+        """
+        Test that the restore requests of an attempt are made at once, up to
+        RESTORE_REQUEST_CONCURRENCY of them
+        """
+        gran = {"granuleId": "MOD09GQ.A0219114.N5aUCG.006.0656338553321",
+                "recover_files": [{"key": key, "dest_bucket": PROTECTED_BUCKET,
+                                   "success": False, "err_msg": ""}
+                                  for key in (FILE1, FILE2, FILE3, FILE4)]}
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+        # each restore waits for another one to be in flight with it
+        barrier = threading.Barrier(2, timeout=5)
+
+        def restore_object(**kwargs):
+            with lock:
+                in_flight.append(kwargs["Key"])
+                most_in_flight.append(len(in_flight))
+            barrier.wait()
+            with lock:
+                in_flight.remove(kwargs["Key"])
+
+        s3_cli = Mock()
+        s3_cli.restore_object = Mock(side_effect=restore_object)
+        CumulusLogger.info = Mock()
+        CumulusLogger.error = Mock()
+        requests_db.submit_requests_async = AsyncMock(
+            side_effect=lambda jobs, on_conflict: [job["request_id"] for job in jobs])
+        os.environ['RESTORE_REQUEST_CONCURRENCY'] = '2'
+        try:
+            result = request_files.process_granules(s3_cli, gran, 'my-dr-fake-glacier-bucket', 5)
+        finally:
+            del os.environ['RESTORE_REQUEST_CONCURRENCY']
+        self.assertEqual(4, s3_cli.restore_object.call_count)
+        self.assertEqual(2, max(most_in_flight))
+        self.assertTrue(all(afile['success'] for afile in result['recover_files']))
+        jobs = requests_db.submit_requests_async.call_args[0][0]
+        self.assertEqual([FILE1, FILE2, FILE3, FILE4], [job["object_key"] for job in jobs])
+
+    def test_record_job_existing(self):
+        """
+        Test that the request_id of the job as recorded is logged and returned, the
+        existing job's when a retry updates it
+        """
+        data = {"request_id": REQUEST_ID3, "object_key": FILE1}
+        CumulusLogger.info = Mock()
+        requests_db.submit_request = Mock(return_value=REQUEST_ID1)
+        self.assertEqual(REQUEST_ID1, request_files.record_job(data))
+        requests_db.submit_request.assert_called_once_with(data, on_conflict="update")
+        CumulusLogger.info.assert_called_with(f"Job {REQUEST_ID1} recorded.")
+
+        requests_db.submit_request = Mock(return_value=None)
+        self.assertIsNone(request_files.record_job(data))
+        CumulusLogger.info.assert_called_with(
+            f"Job for {FILE1} already finished, left as it is.")
+
+    def test_get_request_group_id(self):
+        """
+        Test a retried workflow run gets the request_group_id of its earlier try
+        """
+        requests_db.request_id_generator = Mock(return_value=REQUEST_GROUP_ID_EXP_1)
+        group_id = request_files.get_request_group_id("execution-1", "granxyz")
+        self.assertEqual(group_id, request_files.get_request_group_id("execution-1", "granxyz"))
+        self.assertNotEqual(group_id, request_files.get_request_group_id("execution-2",
+                                                                         "granxyz"))
+        self.assertNotEqual(group_id, request_files.get_request_group_id("execution-1",
+                                                                         "granabc"))
+        requests_db.request_id_generator.assert_not_called()
+        self.assertEqual(REQUEST_GROUP_ID_EXP_1, request_files.get_request_group_id(None,
+                                                                                    "granxyz"))
+
     def test_task_two_granules(self):
         """
         Test two granules with one file each - successful.
@@ -368,7 +485,7 @@ class TestRequestFiles(unittest.TestCase):
             os.environ['RESTORE_REQUEST_RETRIES'] = '3'
             self.assertEqual(exp_gran, result)
 
-            boto3.client.assert_called_with('ssm')
+            boto3.client('ssm').get_parameters.assert_called_once()
             s3_cli.head_object.assert_called_with(Bucket='some_bucket',
                                                   Key=FILE1)
             restore_req_exp = {'Days': 5, 'GlacierJobParameters': {'Tier': 'Standard'}}
@@ -425,7 +542,7 @@ class TestRequestFiles(unittest.TestCase):
             self.assertEqual(exp_gran, result)
             os.environ['RESTORE_EXPIRE_DAYS'] = '3'
             del os.environ['RESTORE_RETRIEVAL_TYPE']
-            boto3.client.assert_called_with('ssm')
+            boto3.client('ssm').get_parameters.assert_called_once()
             s3_cli.head_object.assert_called_with(Bucket='some_bucket',
                                                   Key=FILE1)
             restore_req_exp = {'Days': 5, 'GlacierJobParameters': {'Tier': 'Expedited'}}
@@ -504,7 +621,7 @@ class TestRequestFiles(unittest.TestCase):
             self.assertEqual(exp_err, str(err))
         del os.environ['RESTORE_RETRY_SLEEP_SECS']
         del os.environ['RESTORE_RETRIEVAL_TYPE']
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.head_object.assert_called_with(Bucket='some_bucket',
                                               Key=FILE1)
         restore_req_exp = {'Days': 5, 'GlacierJobParameters': {'Tier': 'Standard'}}
@@ -584,7 +701,7 @@ class TestRequestFiles(unittest.TestCase):
         except request_files.RestoreRequestError as err:
             self.assertEqual(exp_err, str(err))
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.head_object.assert_any_call(Bucket='some_bucket',
                                            Key=FILE1)
         s3_cli.restore_object.assert_any_call(
@@ -689,7 +806,7 @@ class TestRequestFiles(unittest.TestCase):
         result = request_files.task(exp_event, self.context)
         self.assertEqual(exp_gran, result)
 
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.restore_object.assert_any_call(
             Bucket='some_bucket',
             Key=FILE1,
@@ -208,7 +208,7 @@ class TestRequestFilesPostgres(unittest.TestCase):
         except request_files.RestoreRequestError as err:
             self.assertEqual(exp_err, str(err))
         del os.environ['RESTORE_RETRY_SLEEP_SECS']
-        boto3.client.assert_called_with('ssm')
+        boto3.client('ssm').get_parameters.assert_called_once()
         s3_cli.head_object.assert_called_with(Bucket='some_bucket',
                                               Key=FILE1)
         restore_req_exp = {'Days': 5, 'GlacierJobParameters': {'Tier': 'Standard'}}
@@ -4,10 +4,15 @@ Name: request_status.py
 Description:  Queries the request_status table.
 """
 import logging
+import os
+import tempfile
+import boto3
 import requests_db
 
 # Set Global Variables
 _LOG = logging.getLogger(__name__)
+# the size of the parts of an export uploaded to s3, the most held in memory at once
+EXPORT_PART_SIZE = 8 * 1024 * 1024
 
 class BadRequestError(Exception):
     """
@@ -46,6 +51,17 @@ def task(event, context):    #pylint: disable-msg=unused-argument
     if function == "clear":
         result = requests_db.delete_all_requests()
 
+    if function == "purge":
+        result = purge_requests(event)
+
+    if function == "export":
+        result = export_requests(event)
+
+    if function == "maintain_partitions":
+        result = requests_db.maintain_partitions(event.get('months_ahead', 3),
+                                                 event.get('retain_months'),
+                                                 event.get('detach', False))
+
     return result
 
 def query_requests(event):
@@ -68,6 +84,10 @@ def query_requests(event):
         object_key = event['object_key']
     except KeyError:
         object_key = None
+    try:
+        job_status = event['job_status']
+    except KeyError:
+        job_status = None
 
     if request_id:
         result = requests_db.get_job_by_request_id(request_id)
@@ -81,12 +101,178 @@ def query_requests(event):
                 if object_key:
                     result = requests_db.get_jobs_by_object_key(object_key)
                 else:
-                    result = requests_db.get_all_requests()
+                    result = query_page(event, job_status)
     return result
 
+def query_page(event, job_status):
+    """
+    Queries the database for all requests, or those with a job_status. When
+    the event has a page_size or a cursor, one page of them is returned,
+    with the cursor for the next page.
+    """
+    try:
+        page_size = event['page_size']
+    except KeyError:
+        page_size = None
+    try:
+        cursor = event['cursor']
+    except KeyError:
+        cursor = None
+
+    if page_size is None and cursor is None:
+        if job_status:
+            return requests_db.get_jobs_by_status(job_status)
+        return requests_db.get_all_requests()
+
+    if page_size is None:
+        page_size = 100
+    if job_status:
+        jobs, next_cursor = requests_db.get_jobs_by_status_page(
+            job_status, page_size=page_size, cursor=cursor)
+    else:
+        jobs, next_cursor = requests_db.get_all_requests_page(page_size, cursor)
+    return {"jobs": jobs, "next_cursor": next_cursor}
+
+def purge_requests(event):
+    """
+    Deletes the finished jobs last updated more than days_old days ago, see
+    requests_db.purge_requests(). When the event has an archive_bucket, the
+    purged jobs are first written to a gzipped JSONL file, which is uploaded
+    to archive_key in that bucket, even if the purge fails part way.
+    """
+    try:
+        days_old = event['days_old']
+    except KeyError:
+        raise BadRequestError("Missing 'days_old' in input data")
+    statuses = event.get('statuses', ["complete", "error"])
+    batch_size = event.get('batch_size')
+    archive_bucket = event.get('archive_bucket')
+    if not archive_bucket:
+        return requests_db.purge_requests(days_old, statuses, batch_size)
+
+    archive_key = event.get('archive_key')
+    if not archive_key:
+        archive_key = f"request_status/purged_{requests_db.get_utc_now_iso()}.jsonl.gz"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_path = os.path.join(tmp_dir, "purged.jsonl.gz")
+        try:
+            result = requests_db.purge_requests(days_old, statuses, batch_size, archive_path)
+        finally:
+            if os.path.exists(archive_path):
+                boto3.client('s3').upload_file(archive_path, archive_bucket, archive_key)
+    result["archive"] = f"s3://{archive_bucket}/{archive_key}"
+    return result
+
+def export_requests(event):
+    """
+    Exports the requests, optionally filtered by status and request_time, to
+    a gzipped JSONL or CSV file in s3, see requests_db.export_requests(). The
+    file is uploaded in parts of EXPORT_PART_SIZE bytes as it is written, so
+    the lambda never holds more than a part of it.
+    """
+    try:
+        export_bucket = event['export_bucket']
+    except KeyError:
+        raise BadRequestError("Missing 'export_bucket' in input data")
+    file_format = event.get('file_format', "jsonl")
+    export_key = event.get('export_key')
+    if not export_key:
+        export_key = f"request_status/export_{requests_db.get_utc_now_iso()}.{file_format}.gz"
+    with S3MultipartUpload(export_bucket, export_key) as upload:
+        result = requests_db.export_requests(upload, file_format,
+                                             event.get('statuses'),
+                                             event.get('start_time'),
+                                             event.get('end_time'))
+    result["export"] = f"s3://{export_bucket}/{export_key}"
+    return result
+
+class S3MultipartUpload:
+    """
+    A binary file, open for writing, that is uploaded to s3 with a multipart
+    upload. The data written is sent a part of part_size bytes at a time, and
+    the last part when it is closed. Leaving the with block on an exception
+    aborts the upload, so no partial object is made.
+    """
+    def __init__(self, bucket, key, part_size=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or EXPORT_PART_SIZE
+        self.closed = False
+        self._s3 = boto3.client('s3')
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = self._s3.create_multipart_upload(
+            Bucket=bucket, Key=key)["UploadId"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):     #pylint: disable-msg=no-self-use
+        """
+        Returns True, the upload is written to.
+        """
+        return True
+
+    def write(self, data):
+        """
+        Adds data to the upload, sending each full part.
+        """
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        """
+        Does nothing, the data is sent a whole part at a time.
+        """
+
+    def close(self):
+        """
+        Sends the last part and completes the upload.
+        """
+        if self.closed:
+            return
+        if self._buffer or not self._parts:
+            self._upload_part(self._buffer)
+            self._buffer = bytearray()
+        self._s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                           UploadId=self._upload_id,
+                                           MultipartUpload={"Parts": self._parts})
+        self.closed = True
+
+    def abort(self):
+        """
+        Aborts the upload, discarding the parts sent.
+        """
+        if self.closed:
+            return
+        self._s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                        UploadId=self._upload_id)
+        self.closed = True
+
+    def _upload_part(self, data):
+        """
+        Sends the next part of the upload.
+        """
+        part_number = len(self._parts) + 1
+        response = self._s3.upload_part(Bucket=self.bucket, Key=self.key,
+                                        UploadId=self._upload_id,
+                                        PartNumber=part_number, Body=bytes(data))
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
 def add_request(event):
     """
-    Adds a request to the database
+    Adds a request to the database. A request_group_id added again updates
+    its job, which is unique by request_group_id and object_key, unless the
+    job is already complete or error, when nothing is returned.
     """
     try:
         granule_id = event['granule_id']
@@ -111,17 +297,22 @@ def add_request(event):
     data["job_status"] = status
     if status == "error":
         data["err_msg"] = "error message goes here"
-    request_id = requests_db.submit_request(data)
-    result = requests_db.get_job_by_request_id(request_id)
-    return result
+    return requests_db.submit_request_returning(data, on_conflict="update")
 
-def handler(event, context):            #pylint: disable-msg=unused-argument
+def handler(event, context):
     """Lambda handler. Retrieves job(s) from the database.
 
         Environment Vars:
             DATABASE_PORT (string): the database port. The standard is 5432.
             DATABASE_NAME (string): the name of the database.
             DATABASE_USER (string): the name of the application user.
+            DATABASE_READER_HOST (string, optional): the host of a read replica
+                to run the queries on, instead of the primary drdb-host.
+            DATABASE_DEADLINE_MARGIN_SECS (number, optional, default = 3): A query
+                that would still be running this many seconds before the lambda
+                times out is cancelled, and raises requests_db.DatabaseTimeout.
+            DATABASE_PURGE_BATCH_SIZE (number, optional, default = 5000): The most
+                jobs the 'purge' function deletes in a transaction.
 
         Parameter Store:
             drdb-user-pass (string): the password for the application user (DATABASE_USER).
@@ -134,6 +325,52 @@ def handler(event, context):            #pylint: disable-msg=unused-argument
                 request_group_id (string): A request_group_id (uuid) to retrieve
                 request_id (string): A request_id to retrieve
                 object_key (string): An object_key to retrieve
+                job_status (string): A job_status to retrieve
+
+                When none of them, or only job_status, is given, the jobs can be
+                read a page at a time with these keys:
+
+                page_size (number, optional, default = 100): The most jobs to return.
+                cursor (string, optional): The next_cursor of the previous page.
+
+                The 'purge' function deletes the finished jobs that were last
+                updated more than days_old days ago, in batches, with these keys:
+
+                days_old (number): The age, in days, of the jobs to purge.
+                statuses (list(string), optional, default = ["complete", "error"]):
+                    The job_status values to purge.
+                batch_size (number, optional): The most jobs to delete in a
+                    transaction, see DATABASE_PURGE_BATCH_SIZE.
+                archive_bucket (string, optional): A bucket to upload the purged
+                    jobs to, as a gzipped JSONL file, which can be loaded back
+                    in with requests_db.load_requests_file().
+                archive_key (string, optional): The key of the archive file, by
+                    default request_status/purged_<utc now>.jsonl.gz
+
+                The 'export' function writes the jobs to a gzipped JSONL or CSV
+                file in s3, which can be loaded back in with
+                requests_db.load_requests_file(), with these keys:
+
+                export_bucket (string): The bucket to upload the file to.
+                export_key (string, optional): The key of the file, by default
+                    request_status/export_<utc now>.<file_format>.gz
+                file_format (string, optional, default = "jsonl"): "jsonl" or "csv".
+                statuses (list(string), optional): The job_status values to export.
+                start_time (string, optional): Export the jobs requested at or
+                    after this time.
+                end_time (string, optional): Export the jobs requested before
+                    this time.
+
+                The 'maintain_partitions' function makes the monthly partitions
+                of request_status, when it is partitioned, and removes old ones,
+                see requests_db.maintain_partitions(), with these keys:
+
+                months_ahead (number, optional, default = 3): The number of months
+                    after this one to make partitions for.
+                retain_months (number, optional): The number of months, including
+                    this one, to keep. The partitions of older months are removed.
+                detach (boolean, optional, default = false): Detach the old
+                    partitions, to be archived, rather than drop them.
 
                 Examples:
                     event: {'function': 'query'}
@@ -149,6 +386,24 @@ def handler(event, context):            #pylint: disable-msg=unused-argument
                     event: {'function': 'query',
                             'object_key': 'L0A_HR_RAW_product_0006-of-0420.h5'
                            }
+                    event: {'function': 'query',
+                            'job_status': 'error',
+                            'page_size': 50,
+                            'cursor': '<the next_cursor of the previous page>'
+                           }
+                    event: {'function': 'purge',
+                            'days_old': 90,
+                            'archive_bucket': 'my-archive-bucket'
+                           }
+                    event: {'function': 'export',
+                            'export_bucket': 'my-archive-bucket',
+                            'file_format': 'csv',
+                            'statuses': ['error'],
+                            'start_time': '2019-09-01'
+                           }
+                    event: {'function': 'maintain_partitions',
+                            'retain_months': 13
+                           }
 
             context (Object): None
 
@@ -181,10 +436,39 @@ def handler(event, context):            #pylint: disable-msg=unused-argument
                     }
                 ]
 
+            (dict): When a page is read, a dict with the following keys:
+                'jobs' (list(dict)): The page of jobs, as above.
+                'next_cursor' (string): The cursor to pass in the event for the
+                    next page, or null after the last page.
+
+            (dict): For 'purge', a dict with the following keys:
+                'deleted' (number): The number of jobs purged.
+                'batches' (number): The number of batches they were deleted in.
+                'secs' (number): The time the purge took.
+                'rows_per_sec' (number): The jobs purged per second.
+                'finished' (boolean): false if the purge stopped before the lambda
+                    timed out, and should be run again to finish.
+                'archive' (string): The s3 url of the archive, if there is one.
+
+            (dict): For 'export', a dict with the following keys:
+                'rows' (number): The number of jobs exported.
+                'secs' (number): The time the export took.
+                'rows_per_sec' (number): The jobs exported per second.
+                'export' (string): The s3 url of the file.
+
+            (dict): For 'maintain_partitions', a dict with the following keys:
+                'partitioned' (boolean): false if request_status is not partitioned.
+                'created' (list(string)): The partitions made.
+                'dropped' (list(string)): The partitions dropped.
+                'detached' (list(string)): The partitions detached.
+                'skipped' (list(string)): The partitions not made, or not
+                    removed, see the log for why.
+
         Raises:
             BadRequestError: An error occurred parsing the input.
     """
     logging.basicConfig(level=logging.INFO,
                         format='%(levelname)s: %(asctime)s: %(message)s')
-    result = task(event, context)
+    with requests_db.deadline(context):
+        result = task(event, context)
     return result
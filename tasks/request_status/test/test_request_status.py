@@ -3,6 +3,9 @@ Name: test_request_status.py
 
 Description:  Unit tests for request_status.py.
 """
+import contextlib
+import gzip
+import json
 import os
 import unittest
 from unittest.mock import Mock
@@ -34,9 +37,16 @@ class TestRequestStatus(unittest.TestCase):
         self.mock_utcnow = requests_db.get_utc_now_iso
         self.mock_request_group_id = requests_db.request_id_generator
         self.mock_single_query = database.single_query
+        self.mock_multi_query = database.multi_query
+        self.mock_transaction = database.transaction
+        self.mock_stream_query = database.stream_query
 
     def tearDown(self):
         database.single_query = self.mock_single_query
+        database.multi_query = self.mock_multi_query
+        database.transaction = self.mock_transaction
+        database.stream_query = self.mock_stream_query
+        request_status.EXPORT_PART_SIZE = 8 * 1024 * 1024
         requests_db.request_id_generator = self.mock_request_group_id
         requests_db.get_utc_now_iso = self.mock_utcnow
         boto3.client = self.mock_boto3_client
@@ -62,6 +72,13 @@ class TestRequestStatus(unittest.TestCase):
             loop = loop + 1
         ssm_cli = boto3.client('ssm')
         ssm_cli.get_parameter = Mock(side_effect=params)
+        ssm_values = {"drdb-host": os.environ['DATABASE_HOST'],
+                      "drdb-user-pass": os.environ['DATABASE_PW']}
+        ssm_cli.get_parameters = Mock(side_effect=lambda Names, WithDecryption: {
+            "Parameters": [{"Name": name, "Value": ssm_values[name]} for name in Names],
+            "InvalidParameters": []})
+        database.invalidate_db_connect_info()
+        database._SSM_CLIENT = ssm_cli         #pylint: disable-msg=protected-access
 
     def test_handler_add(self):
         """
@@ -77,12 +94,12 @@ class TestRequestStatus(unittest.TestCase):
         handler_input_event["function"] = "add"
         handler_input_event["error"] = req_err
 
-        qresult, ins_result = create_insert_request(REQUEST_ID1, REQUEST_GROUP_ID_EXP_1,
-                                                    granule_id, "object_key",
-                                                    "restore", "my_s3_bucket", status,
-                                                    utc_now_exp, None, req_err)
-        database.single_query = Mock(side_effect=[qresult, ins_result])
-        self.mock_ssm_get_parameter(2)
+        _, ins_result = create_insert_request(REQUEST_ID1, REQUEST_GROUP_ID_EXP_1,
+                                              granule_id, "object_key",
+                                              "restore", "my_s3_bucket", status,
+                                              utc_now_exp, None, req_err)
+        database.single_query = Mock(side_effect=[ins_result])
+        self.mock_ssm_get_parameter(1)
         try:
             result = request_status.handler(handler_input_event, None)
             self.fail("expected BadRequestError")
@@ -99,7 +116,13 @@ class TestRequestStatus(unittest.TestCase):
             result = request_status.handler(handler_input_event, None)
             expected = result_to_json(ins_result)
             self.assertEqual(expected, result)
-            database.single_query.assert_called()
+            # the job is written and read back in one statement
+            database.single_query.assert_called_once()
+            self.assertIn("RETURNING request_id, request_group_id",
+                          database.single_query.call_args[0][0])
+            # adding a request_group_id again updates its job
+            self.assertIn("ON CONFLICT ON CONSTRAINT uq_reqstat_reqgidkey DO UPDATE",
+                          database.single_query.call_args[0][0])
         except request_status.BadRequestError as err:
             self.fail(err)
         except requests_db.DbError as err:
@@ -127,6 +150,31 @@ class TestRequestStatus(unittest.TestCase):
             self.fail(str(err))
 
 
+    def test_task_query_page(self):
+        """
+        Test query all, and by job_status, a page at a time.
+        """
+        qresult, _ = create_select_requests([REQUEST_ID11, REQUEST_ID10, REQUEST_ID9])
+        exp_position = (qresult[1]["last_update_time"].isoformat(), REQUEST_ID10)
+        database.single_query = Mock(side_effect=[qresult[:3], qresult[2:3]])
+        self.mock_ssm_get_parameter(2)
+        result = request_status.task({"function": "query", "page_size": 2}, None)
+        self.assertEqual(result_to_json(qresult[:2]), result["jobs"])
+        self.assertEqual((3,), database.single_query.call_args[0][2])
+
+        event = {"function": "query", "job_status": "inprogress",
+                 "cursor": result["next_cursor"]}
+        result = request_status.task(event, None)
+        self.assertEqual({"jobs": result_to_json(qresult[2:3]), "next_cursor": None}, result)
+        self.assertEqual(("inprogress",) + exp_position + (101,),
+                         database.single_query.call_args[0][2])
+
+        try:
+            request_status.task({"function": "query", "cursor": "notacursor"}, None)
+            self.fail("expected BadRequestError")
+        except requests_db.BadRequestError as err:
+            self.assertIn("Invalid cursor notacursor", str(err))
+
     def test_task_query_granule_id(self):
         """
         Test query by granule_id.
@@ -278,5 +326,89 @@ class TestRequestStatus(unittest.TestCase):
             self.assertEqual("No granules found", str(err))
 
 
+    def test_task_purge(self):
+        """
+        Test purging the old jobs, and uploading the archive of them.
+        """
+        handler_input_event = {"function": "purge", "days_old": 90, "batch_size": 5,
+                               "archive_bucket": "my-archive-bucket",
+                               "archive_key": "purged/jobs.jsonl.gz"}
+        _, exp_result = create_select_requests([REQUEST_ID9, REQUEST_ID10])
+        self.mock_ssm_get_parameter(2)
+        database.transaction = Mock(side_effect=lambda dbconnect_info:
+                                    contextlib.nullcontext(Mock()))
+        database.multi_query = Mock(side_effect=[exp_result, []])
+        result = request_status.task(handler_input_event, None)
+        self.assertEqual(2, result["deleted"])
+        self.assertEqual(1, result["batches"])
+        self.assertTrue(result["finished"])
+        self.assertEqual("s3://my-archive-bucket/purged/jobs.jsonl.gz", result["archive"])
+        upload_args = boto3.client('s3').upload_file.call_args[0]
+        self.assertEqual(("my-archive-bucket", "purged/jobs.jsonl.gz"), upload_args[1:])
+
+        try:
+            request_status.task({"function": "purge"}, None)
+            self.fail("expected BadRequestError")
+        except request_status.BadRequestError as err:
+            self.assertEqual("Missing 'days_old' in input data", str(err))
+
+
+    def test_task_export(self):
+        """
+        Test exporting jobs to s3 in parts, and aborting the upload on an error.
+        """
+        handler_input_event = {"function": "export", "export_bucket": "my-archive-bucket",
+                               "export_key": "exports/jobs.jsonl.gz",
+                               "statuses": ["error"], "start_time": "2019-09-01"}
+        _, exp_result = create_select_requests([REQUEST_ID9, REQUEST_ID10, REQUEST_ID11])
+        self.mock_ssm_get_parameter(1)
+        s3_cli = boto3.client('s3')
+        s3_cli.create_multipart_upload = Mock(return_value={"UploadId": "upload-1"})
+        s3_cli.upload_part = Mock(side_effect=lambda **kwargs:
+                                  {"ETag": f"etag-{kwargs['PartNumber']}"})
+        request_status.EXPORT_PART_SIZE = 100
+        database.stream_query = Mock(return_value=iter(exp_result))
+        result = request_status.task(handler_input_event, None)
+        self.assertEqual(3, result["rows"])
+        self.assertEqual("s3://my-archive-bucket/exports/jobs.jsonl.gz", result["export"])
+        parts = s3_cli.upload_part.call_args_list
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(all(len(part[1]["Body"]) == 100 for part in parts[:-1]))
+        exported = gzip.decompress(b"".join(part[1]["Body"] for part in parts))
+        self.assertEqual(result_to_json(exp_result),
+                         [json.loads(line) for line in exported.decode().splitlines()])
+        complete_args = s3_cli.complete_multipart_upload.call_args[1]
+        self.assertEqual("upload-1", complete_args["UploadId"])
+        self.assertEqual(list(range(1, len(parts) + 1)),
+                         [part["PartNumber"] for part in complete_args["MultipartUpload"]["Parts"]])
+
+        self.mock_ssm_get_parameter(1)
+        s3_cli = boto3.client('s3')
+        s3_cli.create_multipart_upload = Mock(return_value={"UploadId": "upload-2"})
+        database.stream_query = Mock(side_effect=database.DbError("mock select failed"))
+        with self.assertRaises(requests_db.DatabaseError):
+            request_status.task(handler_input_event, None)
+        s3_cli.abort_multipart_upload.assert_called_once()
+        s3_cli.complete_multipart_upload.assert_not_called()
+
+        try:
+            request_status.task({"function": "export"}, None)
+            self.fail("expected BadRequestError")
+        except request_status.BadRequestError as err:
+            self.assertEqual("Missing 'export_bucket' in input data", str(err))
+
+
+    def test_task_maintain_partitions(self):
+        """
+        Test maintaining the partitions of an unpartitioned request_status.
+        """
+        handler_input_event = {"function": "maintain_partitions", "retain_months": 13}
+        self.mock_ssm_get_parameter(1)
+        database.single_query = Mock(return_value=[{"partitioned": False, "partitions": []}])
+        result = request_status.task(handler_input_event, None)
+        self.assertEqual({"partitioned": False, "created": [], "dropped": [], "detached": [],
+                          "skipped": []}, result)
+
+
 if __name__ == '__main__':
     unittest.main(argv=['start'])